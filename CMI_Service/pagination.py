@@ -0,0 +1,145 @@
+import base64
+import datetime
+import json
+
+from django.core.exceptions import ValidationError
+from django.db import connection
+from django.db.models import F, Q
+from drf_yasg import openapi
+
+
+# Encodes the values of the ordering fields of a row as an opaque cursor
+def encode_cursor(values):
+    values = [value.isoformat() if isinstance(value, datetime.datetime) else value for value in values]
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+
+# Decodes a cursor made by encode_cursor for the ordering fields of the model. Raises ValueError if it is invalid.
+def decode_cursor(model, order_by, cursor):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if not isinstance(values, list) or len(values) != len(order_by):
+            raise ValueError
+        return [model._meta.get_field(field.lstrip('-')).to_python(value) for field, value in zip(order_by, values)]
+    except (ValueError, TypeError, ValidationError):
+        raise ValueError('Invalid cursor: ' + cursor)
+
+
+# Filters the rows that come after the cursor values in the order_by order. The leading bound on the first field
+# lets the database range scan the index matching order_by, the rest breaks the ties.
+def filter_after_cursor(queryset, order_by, values):
+    after = None
+    for field, value in reversed(list(zip(order_by, values))):
+        name = field.lstrip('-')
+        past = Q(**{name + ('__lt' if field.startswith('-') else '__gt'): value})
+        after = past if after is None else past | (Q(**{name: value}) & after)
+
+    first = order_by[0]
+    bound = Q(**{first.lstrip('-') + ('__lte' if first.startswith('-') else '__gte'): values[0]})
+    return queryset.filter(bound & after)
+
+
+# Returns the rows after the cursor ordered by order_by and the cursor of the next page, None on the last page.
+# The last order_by field must be unique, usually the id, so every row has its own position. The page is fetched
+# with one extra row to tell whether there is a next one and the values of the ordering fields are selected as
+# annotations so fields left out by only() are never loaded row by row. Raises ValueError if the cursor or the
+# limit is invalid.
+def get_cursor_page(queryset, order_by, cursor, limit):
+    check_limit(limit)
+    queryset = queryset.order_by(*order_by)
+    if cursor:
+        queryset = filter_after_cursor(queryset, order_by, decode_cursor(queryset.model, order_by, cursor))
+
+    keys = ['cursor_key_%d' % i for i in range(len(order_by))]
+    rows = list(queryset.annotate(**{key: F(field.lstrip('-')) for key, field in zip(keys, order_by)})[:limit + 1])
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, encode_cursor([getattr(rows[-1], key) for key in keys])
+
+
+# Raises ValueError unless the page has room for at least one row
+def check_limit(limit):
+    if limit < 1:
+        raise ValueError('Invalid limit: ' + str(limit))
+
+
+# Pages the queryset ordered by order_by for the query parameters of the request, by cursor when the request has
+# one and by limit and offset otherwise. The page is fetched once and records is the number of rows fetched, the
+# total is only counted when asked for. Returns the rows of the page and the fields of the response other than the
+# data. Raises ValueError if the cursor, limit or offset is invalid.
+def paginate(queryset, order_by, request, limit, offset=0):
+    if is_cursor_request(request):
+        return paginate_by_cursor(queryset, order_by, request, limit)
+    return paginate_by_offset(queryset.order_by(*order_by), request, limit, offset)
+
+
+# Pages the queryset for the cursor and count query parameters of the request. An empty cursor is the first page.
+def paginate_by_cursor(queryset, order_by, request, limit):
+    rows, next_cursor = get_cursor_page(queryset, order_by, request.GET.get('cursor'), limit)
+    page = dict(records=len(rows), next_cursor=next_cursor)
+    page.update(get_total(queryset, request))
+    return rows, page
+
+
+# Pages the queryset for the count query parameter of the request. One extra row is fetched to tell whether there
+# is a next page so the total is not needed for next_offset, which is -1 on the last page. Raises ValueError if
+# the limit or the offset is invalid.
+def paginate_by_offset(queryset, request, limit, offset):
+    check_limit(limit)
+    if offset < 0:
+        raise ValueError('Invalid offset: ' + str(offset))
+    rows = list(queryset[offset:offset + limit + 1])
+    next_offset = offset + limit if len(rows) > limit else -1
+    rows = rows[:limit]
+    page = dict(records=len(rows), next_offset=next_offset)
+    page.update(get_total(queryset, request))
+    return rows, page
+
+
+# Returns the total asked for by the count query parameter of the request: total when it is true, estimated_total
+# when it is estimate and nothing otherwise
+def get_total(queryset, request):
+    count = request.GET.get('count', '').lower()
+    if count == 'true':
+        return dict(total=queryset.count())
+    elif count == 'estimate':
+        return dict(estimated_total=estimate_count(queryset))
+    return {}
+
+
+# Returns the planner's row estimate for an unfiltered queryset without counting the table, which is kept up to
+# date by autovacuum. Filtered querysets and tables that have not been analyzed yet are counted.
+def estimate_count(queryset):
+    if not queryset.query.where and not queryset.query.distinct:
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass',
+                           [queryset.model._meta.db_table])
+            row = cursor.fetchone()
+        if row is not None and row[0] > 0:
+            return row[0]
+    return queryset.count()
+
+
+# True when the request asks for cursor pagination rather than limit and offset
+def is_cursor_request(request):
+    return 'cursor' in request.GET.keys()
+
+
+# Swagger parameters for paginate, along with limit and offset
+def get_pagination_parameters():
+    return [
+        openapi.Parameter('limit', openapi.IN_QUERY, description='Limits the return count.',
+                          type=openapi.TYPE_INTEGER, default=''),
+        openapi.Parameter('offset', openapi.IN_QUERY,
+                          description='Offset to start at for the query.',
+                          type=openapi.TYPE_INTEGER, default=''),
+        openapi.Parameter('cursor', openapi.IN_QUERY,
+                          description='Pages by cursor rather than offset. Leave empty for the first page and pass '
+                                      'the next_cursor of the response for the next one.',
+                          type=openapi.TYPE_STRING, default=''),
+        openapi.Parameter('count', openapi.IN_QUERY,
+                          description='"true" also returns the total, "estimate" returns an estimate of the total '
+                                      'that is cheaper for unfiltered lists.',
+                          type=openapi.TYPE_STRING, default='', enum=['true', 'estimate']),
+    ]
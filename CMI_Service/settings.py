@@ -27,6 +27,9 @@ ALLOWED_HOSTS = ['*']
 
 MAX_RECORDS_TO_RETURN = 100
 
+# How long the map cluster counts for a tile are cached
+CLUSTER_CACHE_SECONDS = int(os.environ.get("CLUSTER_CACHE_SECONDS", default=300))
+
 # Application definition
 
 INSTALLED_APPS = [
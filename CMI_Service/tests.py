@@ -0,0 +1,71 @@
+from django.db import connection
+from django.test import TestCase, RequestFactory
+
+from CMI_Service.pagination import decode_cursor, encode_cursor, estimate_count, paginate
+from webarticles.models import Site
+
+factory = RequestFactory()
+
+
+class PaginationTest(TestCase):
+    """ Test Module for the list pagination """
+
+    def setUp(self):
+        self.sites = [Site.objects.create(name='Site %d' % i, domain='Domain %d' % i,
+                                          base_url='http://www.site%d.com' % i) for i in range(5)]
+
+    def test_offset_page_fetched_once(self):
+        with self.assertNumQueries(1):
+            sites, page = paginate(Site.objects.all(), ['id'], factory.get('/', {'offset': 1}), 2, 1)
+        self.assertEqual(sites, self.sites[1:3])
+        self.assertEqual(page, dict(records=2, next_offset=3))
+
+        sites, page = paginate(Site.objects.all(), ['id'], factory.get('/'), 2, 4)
+        self.assertEqual(sites, self.sites[4:])
+        self.assertEqual(page, dict(records=1, next_offset=-1))
+
+        # Past the end is an empty last page rather than an error
+        sites, page = paginate(Site.objects.all(), ['id'], factory.get('/'), 2, 10)
+        self.assertEqual(page, dict(records=0, next_offset=-1))
+
+        for limit, offset in [(0, 0), (-1, 0), (2, -1)]:
+            with self.assertRaises(ValueError):
+                paginate(Site.objects.all(), ['id'], factory.get('/'), limit, offset)
+
+    def test_total_only_when_asked(self):
+        sites, page = paginate(Site.objects.all(), ['-id'], factory.get('/', {'count': 'true'}), 2)
+        self.assertEqual(sites, self.sites[:-3:-1])
+        self.assertEqual(page, dict(records=2, next_offset=2, total=5))
+
+        sites, page = paginate(Site.objects.all(), ['id'], factory.get('/', {'cursor': '', 'count': 'true'}), 10)
+        self.assertEqual(page, dict(records=5, next_cursor=None, total=5))
+
+    def test_estimated_total(self):
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE ' + Site._meta.db_table)
+
+        with self.assertNumQueries(1):
+            self.assertEqual(estimate_count(Site.objects.all()), 5)
+
+        # Filtered lists are counted
+        with self.assertNumQueries(1):
+            self.assertEqual(estimate_count(Site.objects.filter(pk__in=[self.sites[0].pk, self.sites[1].pk])), 2)
+
+        sites, page = paginate(Site.objects.all(), ['id'], factory.get('/', {'count': 'estimate'}), 2)
+        self.assertEqual(page, dict(records=2, next_offset=2, estimated_total=5))
+
+    def test_cursor(self):
+        cursor = encode_cursor([self.sites[2].pk])
+        self.assertEqual(decode_cursor(Site, ['id'], cursor), [self.sites[2].pk])
+
+        sites, page = paginate(Site.objects.all(), ['id'], factory.get('/', {'cursor': cursor}), 10)
+        self.assertEqual(sites, self.sites[3:])
+        self.assertEqual(page, dict(records=2, next_cursor=None))
+
+        with self.assertRaises(ValueError):
+            decode_cursor(Site, ['id'], 'not-a-cursor')
+        with self.assertRaises(ValueError):
+            decode_cursor(Site, ['id', 'name'], cursor)
+        for limit in [0, -1]:
+            with self.assertRaises(ValueError):
+                paginate(Site.objects.all(), ['id'], factory.get('/', {'cursor': ''}), limit)
@@ -1,2 +1,33 @@
 import concurrent.futures
 
+from django.db import connection
+from tqdm import tqdm
+
+
+# Runs func for every item across a thread pool and shows the progress as items finish. Returns a dict of
+# item to result, items that raised are printed and left out. Each thread closes its own database connection
+# when its item is done.
+def run_concurrently(func, items, workers=8, description=None):
+    results = {}
+    failed = 0
+
+    def run(item):
+        try:
+            return func(item)
+        finally:
+            connection.close()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(run, item): item for item in items}
+        with tqdm(total=len(futures), desc=description) as progress:
+            for future in concurrent.futures.as_completed(futures):
+                item = futures[future]
+                try:
+                    results[item] = future.result()
+                except Exception as e:
+                    failed += 1
+                    print(e, ' item: ', item)
+                progress.update(1)
+                progress.set_postfix(done=len(results), failed=failed)
+
+    return results
@@ -0,0 +1,128 @@
+import heapq
+import itertools
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+# Spreads crawl requests across hosts. Each host has its own priority queue of items and its own pooled session,
+# only has one request in flight at a time and waits delay_seconds between requests, while the workers move on to
+# whichever other host is ready so different sites are crawled in parallel. handle(item, session) is called from
+# the worker threads for every item and can add more items.
+class CrawlScheduler:
+
+    def __init__(self, handle, workers=8, delay_seconds=1.0, user_agent=None):
+        self.handle = handle
+        self.workers = workers
+        self.delay_seconds = delay_seconds
+        self.user_agent = user_agent
+        self.queues = {}
+        self.ready = []
+        self.busy = set()
+        self.next_at = {}
+        self.sessions = {}
+        self.in_flight = 0
+        self.counter = itertools.count()
+        self.condition = threading.Condition()
+        self.stopping = False
+        self.threads = []
+        self.stats = dict(requests=0, failed=0)
+
+    # Queues an item for the host, lower priorities go first
+    def add(self, host, item, priority=0):
+        with self.condition:
+            queue = self.queues.setdefault(host, [])
+            if len(queue) <= 0 and host not in self.busy:
+                heapq.heappush(self.ready, (self.next_at.get(host, 0), next(self.counter), host))
+            heapq.heappush(queue, (priority, next(self.counter), item))
+            self.condition.notify()
+
+    # Returns the keep-alive session for the host, only used by the worker holding the host
+    def get_session(self, host):
+        session = self.sessions.get(host)
+        if session is None:
+            session = requests.Session()
+            session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=1))
+            session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=1))
+            if self.user_agent:
+                session.headers['User-Agent'] = self.user_agent
+            self.sessions[host] = session
+        return session
+
+    def start(self):
+        self.stopping = False
+        for i in range(self.workers):
+            thread = threading.Thread(target=self.work, name='crawl-worker-%d' % i, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    # Stops the workers once their current items are done
+    def stop(self):
+        with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        for session in self.sessions.values():
+            session.close()
+        self.sessions = {}
+
+    # True when nothing is queued or in flight
+    def is_idle(self):
+        with self.condition:
+            return len(self.ready) <= 0 and self.in_flight <= 0
+
+    def get_stats(self):
+        with self.condition:
+            return dict(self.stats, hosts=len(self.queues), queued=sum(len(q) for q in self.queues.values()),
+                        in_flight=self.in_flight)
+
+    # Takes the next item of the host that has been ready the longest, waiting out its delay
+    def next_item(self):
+        with self.condition:
+            while not self.stopping:
+                if len(self.ready) > 0:
+                    wait = self.ready[0][0] - time.time()
+                    if wait <= 0:
+                        host = heapq.heappop(self.ready)[2]
+                        item = heapq.heappop(self.queues[host])[2]
+                        self.busy.add(host)
+                        self.in_flight += 1
+                        return host, item, self.get_session(host)
+                    self.condition.wait(wait)
+                else:
+                    self.condition.wait(1)
+            return None
+
+    # Releases the host and queues it again after its delay if it has more items
+    def done(self, host, failed):
+        with self.condition:
+            self.in_flight -= 1
+            self.busy.discard(host)
+            self.stats['requests'] += 1
+            if failed:
+                self.stats['failed'] += 1
+            self.next_at[host] = time.time() + self.delay_seconds
+            if len(self.queues[host]) > 0:
+                heapq.heappush(self.ready, (self.next_at[host], next(self.counter), host))
+            self.condition.notify_all()
+
+    # Worker loop
+    def work(self):
+        while True:
+            next_item = self.next_item()
+            if next_item is None:
+                return
+
+            host, item, session = next_item
+            failed = False
+            try:
+                self.handle(item, session)
+            except Exception as e:
+                print('Error crawling: ', host, ' ', e)
+                failed = True
+            finally:
+                self.done(host, failed)
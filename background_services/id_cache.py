@@ -0,0 +1,58 @@
+import threading
+from collections import OrderedDict
+
+
+# Bounded least recently used map of a natural key (twitter id, hashtag text, expanded url) to a primary key,
+# or to any other small value such as coordinates. Safe to share between threads and counts hits and misses.
+class IdCache:
+
+    def __init__(self, name, max_size):
+        self.name = name
+        self.max_size = max_size
+        self.items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.items)
+
+    # Returns a dict of the keys found and a list of the keys that were not
+    def get_many(self, keys):
+        found = {}
+        missing = []
+        with self.lock:
+            for key in keys:
+                if key in self.items:
+                    self.items.move_to_end(key)
+                    found[key] = self.items[key]
+                else:
+                    missing.append(key)
+            self.hits += len(found)
+            self.misses += len(missing)
+        return found, missing
+
+    def get(self, key):
+        found, missing = self.get_many([key])
+        return found.get(key)
+
+    def set_many(self, items):
+        with self.lock:
+            for key, pk in items.items():
+                self.items[key] = pk
+                self.items.move_to_end(key)
+            while len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+
+    def set(self, key, pk):
+        self.set_many({key: pk})
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+    def get_stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return dict(size=len(self.items), hits=self.hits, misses=self.misses,
+                        hit_rate=round(self.hits / lookups, 3) if lookups else 0)
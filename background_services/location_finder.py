@@ -1,101 +1,374 @@
 import time
+import os
+import concurrent.futures
+import mmap
+import threading
+import unicodedata
+from datetime import timedelta
 
 import requests
+from tqdm import tqdm
 import urllib.parse
 from background_services.config import *
+from background_services.id_cache import IdCache
+from background_services.rate_limiter import TokenBucket
+from django.db import connection
+from django.utils.timezone import now
 
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "CMI_Service.settings")
+import django
+django.setup()
+from socialmediauser.geo import encode_geohash
+from socialmediauser.models import GeocodeCache, SocialMediaUser
 
-def get_coords(location, elapsed_time):
+# Returned when a provider has no result for the location
+NO_GEOCODE = 'No Geocode'
 
-    # try locationiq
-    lat, lon = get_coords_using_locationiq(location, elapsed_time)
+# Locations with no result are looked up again after this long
+NO_GEOCODE_TTL = timedelta(days=30)
 
+GEOCODE_CACHE_SIZE = 50000
+
+# Offline place name index tried before the cache and the providers
+GAZETTEER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gazetteer.tsv')
+
+# Distinct locations geocoded and written back per update
+GEOCODE_BATCH_SIZE = 500
+
+# Lookups running at once across all the providers
+GEOCODE_WORKERS = 8
+GEOCODE_TIMEOUT_SECONDS = 10
+
+# Normalized location to (lat, lon, expires), expires is None for found locations
+geocode_cache = IdCache('geocode', GEOCODE_CACHE_SIZE)
+
+
+def get_coords(location):
+    key = normalize_location(location)
+    if not key:
+        return NO_GEOCODE, NO_GEOCODE
+
+    coords = gazetteer.lookup(key)
+    if coords is not None:
+        return coords
+
+    cached = get_cached_coords([key])
+    if key in cached:
+        return cached[key]
+
+    lat, lon, provider = lookup_coords(location)
+    cache_coords(key, location, lat, lon, provider)
     return lat, lon
 
 
-def get_coords_using_here(location):
+# Geocodes many locations at once through the cache, the misses are looked up across GEOCODE_WORKERS threads so
+# every provider is kept busy up to its own rate. Returns a dict of normalized key to (lat, lon).
+def get_coords_many(locations, workers=GEOCODE_WORKERS):
+    spellings = {}
+    for location in locations:
+        spellings.setdefault(normalize_location(location), location)
+    coords = {key: (NO_GEOCODE, NO_GEOCODE) for key in spellings if not key}
+    for key in spellings:
+        if key and key not in coords:
+            found = gazetteer.lookup(key)
+            if found is not None:
+                coords[key] = found
+    coords.update(get_cached_coords([key for key in spellings if key not in coords]))
+
+    missing = [key for key in spellings if key not in coords]
+    if len(missing) > 0:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            results = executor.map(lambda key: lookup_coords(spellings[key]), missing)
+            # Cached from this thread so the workers never touch the database
+            for key, (lat, lon, provider) in zip(missing, results):
+                cache_coords(key, spellings[key], lat, lon, provider)
+                coords[key] = lat, lon
+
+    return coords
+
+
+# Tries the providers that have budget left first and fails over to the next one when a provider is rate limited,
+# errors or has no result. When every remaining provider is out of budget it waits for the first to refill.
+# Returns (lat, lon, provider), NO_GEOCODE when every provider answered without finding the location and None when
+# any of them could not answer, so the location is tried again rather than cached as not found.
+def lookup_coords(location):
+    lat = lon = NO_GEOCODE
+    remaining = list(GEOCODE_PROVIDERS)
+    while len(remaining) > 0:
+        provider = next((p for p in remaining if p.bucket.acquire(timeout=0)), None)
+        if provider is None:
+            provider = min(remaining, key=lambda p: p.get_wait())
+            provider.bucket.acquire()
+        remaining.remove(provider)
+
+        result = provider.geocode(location, provider.session)
+        if result[0] is None:
+            lat = lon = None
+        elif result[0] != NO_GEOCODE:
+            return result[0], result[1], provider.name
+    return lat, lon, None
+
+
+# Place name index stored as a text file that is memory mapped on first use. Each line holds a normalized name or
+# alias, its coordinates and the name of the place, tab separated. The lines are sorted by the utf-8 bytes of the
+# key so a lookup is a binary search over the mapped file, use write to rebuild it after adding places.
+class Gazetteer:
+
+    def __init__(self, path):
+        self.path = path
+        self.map = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        with self.lock:
+            if self.map is None:
+                with open(self.path, 'rb') as f:
+                    self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.map
+
+    # Returns the (lat, lon) of the normalized key or None if it is not in the index
+    def lookup(self, key):
+        data = self.map if self.map is not None else self.load()
+        target = key.encode('utf-8')
+        low, high = 0, len(data)
+        while low < high:
+            middle = (low + high) // 2
+            start = data.rfind(b'\n', 0, middle) + 1
+            end = data.find(b'\n', start)
+            if end == -1:
+                end = len(data)
+
+            fields = data[start:end].split(b'\t')
+            if fields[0] == target:
+                return float(fields[1]), float(fields[2])
+            if fields[0] < target:
+                low = end + 1
+            else:
+                high = start
+        return None
+
+    # Writes the index from (name, lat, lon, aliases) tuples, the first place listed wins a shared key
+    @staticmethod
+    def write(path, places):
+        lines = {}
+        for name, lat, lon, aliases in places:
+            for alias in [name] + list(aliases):
+                key = normalize_location(alias).encode('utf-8')
+                if key and key not in lines:
+                    lines[key] = b'\t'.join([key, str(lat).encode(), str(lon).encode(), name.encode('utf-8')])
+        with open(path, 'wb') as f:
+            for key in sorted(lines):
+                f.write(lines[key] + b'\n')
+
+
+gazetteer = Gazetteer(GAZETTEER_PATH)
+
+
+# Folds case, accents and other unicode variants, drops dots and apostrophes, turns other punctuation and
+# symbols into spaces and collapses the whitespace so "  Kyiv, UKRAINE " and "kyiv ukraine" or "U.S.A." and
+# "usa" share a key
+def normalize_location(location):
+    if location is None:
+        return ''
+    text = unicodedata.normalize('NFKD', str(location).casefold())
+    chars = []
+    for c in text:
+        category = unicodedata.category(c)
+        if category == 'Mn' or c in ".'\u2019":
+            continue
+        chars.append(' ' if category[0] in 'PSZC' else c)
+    return ' '.join(''.join(chars).split())
+
+
+# Returns a dict of normalized key to (lat, lon) for the keys in the in process or database cache. Locations
+# with no result are returned as NO_GEOCODE until they expire.
+def get_cached_coords(keys):
+    cached = {}
+    found, missing = geocode_cache.get_many(keys)
+    current = now()
+    for key, (lat, lon, expires) in found.items():
+        if expires is None or expires > current:
+            cached[key] = lat, lon
+        else:
+            missing.append(key)
+
+    if len(missing) > 0:
+        rows = {}
+        for row in GeocodeCache.objects.filter(key__in=missing):
+            if row.lat is not None:
+                rows[row.key] = (row.lat, row.lon, None)
+            elif row.updated_at + NO_GEOCODE_TTL > current:
+                rows[row.key] = (NO_GEOCODE, NO_GEOCODE, row.updated_at + NO_GEOCODE_TTL)
+        geocode_cache.set_many(rows)
+        cached.update({key: (lat, lon) for key, (lat, lon, expires) in rows.items()})
+
+    return cached
+
+
+# Geocodes the distinct locations of the users that have no coordinates yet, all users if none are provided.
+# Each normalized location is looked up once and the coordinates are written to every user with one of its
+# spellings by a single UPDATE per batch. Locations with no result are left without coordinates and are only
+# looked up again once the cached result expires. Returns the number of users updated.
+def geocode_user_locations(users=None, batch_size=GEOCODE_BATCH_SIZE):
+    if users is None:
+        users = SocialMediaUser.objects.all()
+    locations = users.filter(location__isnull=False, lat__isnull=True, lon__isnull=True) \
+        .order_by().values_list('location', flat=True).distinct()
+
+    # Spellings of each normalized location
+    spellings = {}
+    for location in locations.iterator():
+        spellings.setdefault(normalize_location(location), []).append(location)
+    keys = list(spellings.keys())
+
+    updated = 0
+    for i in tqdm(range(0, len(keys), batch_size), total=len(range(0, len(keys), batch_size))):
+        batch = keys[i:i + batch_size]
+        coords = get_coords_many([spellings[key][0] for key in batch])
+
+        rows = []
+        for key in batch:
+            lat, lon = coords[key]
+            if lat is None or lat == NO_GEOCODE:
+                continue
+            rows += [(location, lat, lon) for location in spellings[key]]
+        updated += update_user_coords(rows)
+
+    return updated
+
+
+# Sets the coordinates and geohash of every user without coordinates whose location matches, rows are
+# (location, lat, lon)
+def update_user_coords(rows):
+    if len(rows) <= 0:
+        return 0
+
+    values = ', '.join(['(%s, %s::double precision, %s::double precision, %s)'] * len(rows))
+    params = [value for location, lat, lon in rows for value in (location, lat, lon, encode_geohash(lat, lon))]
+    table = SocialMediaUser._meta.db_table
+    with connection.cursor() as cursor:
+        cursor.execute('UPDATE ' + table + ' AS u SET lat = v.lat, lon = v.lon, geohash = v.geohash '
+                       'FROM (VALUES ' + values + ') AS v (location, lat, lon, geohash) '
+                       'WHERE u.location = v.location AND u.lat IS NULL AND u.lon IS NULL', params)
+        return cursor.rowcount
+
+
+# Stores a provider result. Errors, returned as None, are not cached so they are retried on the next lookup.
+def cache_coords(key, location, lat, lon, provider=None):
+    if lat is None or lon is None:
+        return
+
+    if lat == NO_GEOCODE:
+        expires = now() + NO_GEOCODE_TTL
+        lat = lon = None
+    else:
+        expires = None
+
+    GeocodeCache.objects.update_or_create(key=key, defaults=dict(location=location, lat=lat, lon=lon,
+                                                                 provider=provider, updated_at=now()))
+    if expires is None:
+        geocode_cache.set(key, (lat, lon, None))
+    else:
+        geocode_cache.set(key, (NO_GEOCODE, NO_GEOCODE, expires))
+
+
+# A geocoding service with its own connection pool and request budget
+class GeocodeProvider:
+
+    def __init__(self, name, geocode, requests_per_second):
+        self.name = name
+        self.geocode = geocode
+        self.bucket = TokenBucket(requests_per_second, 1)
+        self.session = requests.Session()
+
+    # Seconds until the next request can be made
+    def get_wait(self):
+        with self.bucket.condition:
+            current = time.time()
+            self.bucket.refill(current)
+            return max(self.bucket.get_wait(1, current), 0)
+
+
+def get_coords_using_here(location, session=requests):
     text = urllib.parse.quote_plus(location)
     url = 'https://geocoder.ls.hereapi.com/6.2/geocode.json?apiKey=' + HERE_API_KEY + '&searchtext=' + text
-    # sending get request and saving the response as response object
-    r = requests.get(url=url)
+    try:
+        # sending get request and saving the response as response object
+        r = session.get(url=url, timeout=GEOCODE_TIMEOUT_SECONDS)
 
-    # extracting data in json format
-    data = r.json()
-    if 'Response' not in data.keys():
-        return None, None
+        # extracting data in json format
+        data = r.json()
+        if 'Response' not in data.keys():
+            return None, None
 
-    view = data['Response']['View']
+        view = data['Response']['View']
 
-    if len(view) <= 0:
+        if len(view) <= 0:
+            return NO_GEOCODE, NO_GEOCODE
+        else:
+            result = view[0]['Result'][0]['Location']['DisplayPosition']
+            return result['Latitude'], result['Longitude']
+    except Exception as e:
+        print('Error in get coords from here: ', e)
         return None, None
-    else:
-        result = view[0]['Result'][0]['Location']['DisplayPosition']
-        return result['Latitude'], result['Longitude']
 
 
-def get_coords_using_opencage(location):
-    url = 'https://api.opencagedata.com/geocode/v1/json?q=' + location + '&key=' + OPEN_CAGE_API_KEY
+def get_coords_using_opencage(location, session=requests):
+    text = urllib.parse.quote_plus(location)
+    url = 'https://api.opencagedata.com/geocode/v1/json?q=' + text + '&key=' + OPEN_CAGE_API_KEY
 
     # sending get request and saving the response as response object
     try:
-        r = requests.get(url=url)
+        r = session.get(url=url, timeout=GEOCODE_TIMEOUT_SECONDS)
 
         # extracting data in json format
         data = r.json()
+        if 'results' not in data.keys():
+            # Rate limited or the key ran out
+            return None, None
         if len(data['results']) > 0:
-            results = data['results']
             # Get the first one
-            results[0]['geometry']
+            results = data['results']
             return results[0]['geometry']['lat'], results[0]['geometry']['lng']
         else:
-            print(data)
-            return None, None
+            return NO_GEOCODE, NO_GEOCODE
     except Exception as e:
-        print(e)
+        print('Error in get coords from opencage: ', e)
         return None, None
 
 
-def get_coords_using_locationiq(location, elapsed_time):
+def get_coords_using_locationiq(location, session=requests):
     try:
-        if location == '' or location == ' ' or location == '  ' or location == '            ':
-            return 'No Geocode', 'No Geocode'
+        if not location.strip():
+            return NO_GEOCODE, NO_GEOCODE
 
         text = urllib.parse.quote_plus(location)
         url = 'https://us1.locationiq.com/v1/search.php?key=' + LOCATIONIQ_KEY + '&q=' + text + '&format=json'
 
-        # if elapsed time not reached wait
-        if elapsed_time < 1:
-            time.sleep(2)
-
         # sending get request and saving the response as response object
-        r = requests.get(url=url)
+        r = session.get(url=url, timeout=GEOCODE_TIMEOUT_SECONDS)
 
         # extracting data in json format
         data = r.json()
 
         if type(data) == dict:
-            if 'error' in data.keys():
-                if data['error'] == 'Unable to geocode':
-                    return 'No Geocode', 'No Geocode'
-                if data['error'] == 'Rate Limited Second':
-                    time.sleep(2)
-                    # sending get request and saving the response as response object
-                    r = requests.get(url=url)
-
-                    # extracting data in json format
-                    data = r.json()
-                    if type(data) == dict:
-                        if 'error' in data.keys():
-                            if data['error'] == 'Unable to geocode':
-                                return 'No Geocode', 'No Geocode'
+            if data.get('error') == 'Unable to geocode':
+                return NO_GEOCODE, NO_GEOCODE
+            # Rate limited, the next provider is tried
+            return None, None
 
         if len(data) <= 0:
-            return None, None
+            return NO_GEOCODE, NO_GEOCODE
         else:
             return float(data[0]['lat']), float(data[0]['lon'])
     except Exception as e:
-        #print('Error in get coords from location iq: ', data)
+        print('Error in get coords from location iq: ', e)
         return None, None
 
 
-
+# Providers in the order they are tried when they all have budget left, with the requests per second of each
+GEOCODE_PROVIDERS = [
+    GeocodeProvider('locationiq', get_coords_using_locationiq, 2),
+    GeocodeProvider('here', get_coords_using_here, 5),
+    GeocodeProvider('opencage', get_coords_using_opencage, 1),
+]
@@ -1,7 +1,17 @@
 import os
-from datetime import time
+import collections
+import concurrent.futures
+import hashlib
+import multiprocessing
+import queue
+import re
+import threading
+import urllib.parse
+from datetime import timedelta
 
 import newspaper
+import requests
+from newspaper.article import ArticleDownloadState, ArticleException
 from tqdm import tqdm
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "CMI_Service.settings")
@@ -11,8 +21,46 @@ django.setup()
 from newspaper import Article
 from webarticles.models import Article as WebArticle
 
-# Grabs the title from the html
 from webarticles.models import Site, Url
+from background_services.crawl_scheduler import CrawlScheduler
+from background_services.retry_policy import RetryPolicy
+from django.db import transaction
+from django.db.models import Q
+from django.utils.timezone import now
+
+# Downloads running at once and at once per domain
+DOWNLOAD_WORKERS = 16
+DOMAIN_CONCURRENCY = 2
+
+# Threads crawling the sites, each host gets one request at a time and waits CRAWL_DELAY_SECONDS between them
+CRAWL_WORKERS = 16
+CRAWL_DELAY_SECONDS = 1.0
+CRAWL_TIMEOUT_SECONDS = 30
+CRAWL_USER_AGENT = 'Mozilla/5.0 (compatible; CMI-Service news crawler)'
+
+# Scraped articles still linked from their site's index are fetched again, conditionally, once they are this old
+ARTICLE_REFRESH_SECONDS = 24 * 60 * 60
+
+# Processes parsing the downloaded pages
+PARSE_WORKERS = os.cpu_count() or 2
+
+# Urls downloaded and written to the database together
+SCRAPE_BATCH_SIZE = 100
+
+# Status codes of a download worth trying again, any other client error is down to the url itself
+RETRYABLE_STATUS_CODES = {408, 429}
+
+# Download attempts within a crawl, backing off the domain between them. Only errors the domain could be behind
+# are retried, a dead link is left to the url's own failure_count.
+DOWNLOAD_RETRY_POLICY = RetryPolicy(max_attempts=3, base_seconds=2.0, max_seconds=60.0,
+                                    is_retryable=lambda error: is_retryable_download_error(error))
+
+# Delay before a url that failed is scraped again by a later crawl, it is parked after SCRAPE_MAX_FAILURES
+URL_RETRY_POLICY = RetryPolicy(base_seconds=15 * 60.0, max_seconds=24 * 60 * 60.0)
+SCRAPE_MAX_FAILURES = 5
+
+
+# Grabs the title from the html
 
 
 def get_title(html):
@@ -39,15 +87,19 @@ def create_article_from_url(url):
     article = Article(url=url.expanded)
 
     # Create article
-    if WebArticle.objects.filter(expanded_url__icontains=url.expanded).exists():
-        rtn_article = WebArticle.objects.get(expanded_url__icontains=url.expanded)
+    if WebArticle.objects.filter(expanded_url__exact=url.expanded).exists():
+        rtn_article = WebArticle.objects.get(expanded_url__exact=url.expanded)
         if not url.article:
             url.article = rtn_article
         url.scraped = True
         url.save()
         return
 
-    rtn_article = get_article_from_article(article, url)
+    try:
+        rtn_article = get_article_from_article(article, url)
+    except Exception as e:
+        record_scrape_failures([(url, e)])
+        return
 
     # Now see if a site exists for this site if not then create one
     try:
@@ -56,7 +108,11 @@ def create_article_from_url(url):
         if url.canonical != article.canonical_link:
             url.canonical = article.canonical_link
             article = Article(url=url.canonical)
-            rtn_article = get_article_from_article(article, url)
+            try:
+                rtn_article = get_article_from_article(article, url)
+            except Exception as e:
+                record_scrape_failures([(url, e)])
+                return
             try:
                 site = Site.objects.get(base_url__exact=article.source_url)
             except:
@@ -74,18 +130,10 @@ def create_article_from_url(url):
     url.save()
 
 
-# Returns the main article data from the given url
+# Returns the main article data from the given url. The download is retried with backoff on the domain and the
+# error is raised once the attempts run out.
 def get_article_from_article(article, url):
-
-    keep_trying = True
-
-    while keep_trying:
-        try:
-            article.download()
-            keep_trying = False
-        except Exception as e:
-            print(e)
-            time.sleep(1)
+    DOWNLOAD_RETRY_POLICY.call(get_domain(article.url), download_article, article)
 
     article.parse()
     article.nlp()
@@ -102,40 +150,387 @@ def get_article_from_article(article, url):
     )
 
 
-def crawl_sites_getting_news_articles():
-    sites = Site.objects.all()
+# Crawls the sites marked for crawling. Building each site and downloading its articles goes through a
+# CrawlScheduler so the sites are crawled in parallel while each host gets one request at a time, crawl_delay
+# seconds apart, over a keep-alive session. Parsing and nlp run on a process pool and the articles are written
+# batch_size at a time. The database is only used from this thread.
+#
+# Index pages and articles are fetched with the ETag and Last-Modified from the last fetch. A site whose index
+# has not changed is not built again and only its urls due for a retry are scraped, an article whose page has
+# not changed is not parsed again.
+def crawl_sites_getting_news_articles(workers=CRAWL_WORKERS, crawl_delay=CRAWL_DELAY_SECONDS,
+                                      parse_workers=PARSE_WORKERS, batch_size=SCRAPE_BATCH_SIZE):
+    results = queue.Queue()
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=parse_workers,
+                                                mp_context=multiprocessing.get_context('spawn')) as parses:
+        # Runs on the scheduler threads, hands everything back to this thread through results
+        def handle(item, session):
+            if isinstance(item, Site):
+                crawl_site_index(item, session, results)
+                return
+
+            # Only a page that made it into an article can be skipped, so only ask for a 304 then
+            has_article = item.article_id is not None
+            try:
+                response = DOWNLOAD_RETRY_POLICY.call(get_domain(item.expanded), fetch_page, session, item.expanded,
+                                                      item.etag if has_article else None,
+                                                      item.last_modified if has_article else None)
+            except Exception as e:
+                results.put(('failed', item, e))
+                raise
+
+            content_hash = item.content_hash if response is None else get_content_hash(response.content)
+            unchanged = has_article and content_hash == item.content_hash
+            if response is not None:
+                item.etag, item.last_modified = get_validators(response)
+                item.content_hash = content_hash
+            item.fetched_at = now()
+            if unchanged:
+                results.put(('unchanged', item, None))
+            else:
+                results.put(('article', item, parses.submit(parse_article_html, item.expanded, response.text)))
+
+        scheduler = CrawlScheduler(handle, workers=workers, delay_seconds=crawl_delay, user_agent=CRAWL_USER_AGENT)
+        for site in Site.objects.filter(crawl=True):
+            scheduler.add(get_domain(site.base_url), site)
+        scheduler.start()
+
+        # Sites can share urls, each url is only queued once per crawl
+        queued = set()
+        parse_futures = {}
+        unchanged = []
+        failed = []
+        try:
+            while True:
+                # Idle is checked before the results so a result queued by the last item is never missed
+                idle = scheduler.is_idle()
+                try:
+                    kind, item, value = results.get(timeout=1)
+                except queue.Empty:
+                    if idle:
+                        break
+                    continue
 
-    for site in sites:
-        print('Crawling through: ', site.name)
+                if kind == 'site':
+                    # Sites stay at priority 0 so a host builds its site before downloading articles
+                    for url in get_site_urls_to_scrape(item, value):
+                        if url.pk not in queued:
+                            queued.add(url.pk)
+                            scheduler.add(get_domain(url.expanded), url, priority=1)
+                elif kind == 'article':
+                    parse_futures[value] = item
+                elif kind == 'unchanged':
+                    unchanged.append(item)
+                else:
+                    failed.append((item, value))
+
+                if len(parse_futures) + len(unchanged) + len(failed) >= batch_size:
+                    save_crawled_articles(parse_futures, unchanged, failed)
+                    parse_futures = {}
+                    unchanged = []
+                    failed = []
+            save_crawled_articles(parse_futures, unchanged, failed)
+        finally:
+            scheduler.stop()
+        print('Crawl stats: ', scheduler.get_stats())
+
+
+# Runs on the scheduler threads. Fetches the site's index page and builds the site if the page has changed since
+# the last crawl, puts ('site', site, article urls) in results or ('site', site, None) if it has not changed.
+def crawl_site_index(site, session, results):
+    print('Crawling through: ', site.name)
+    response = DOWNLOAD_RETRY_POLICY.call(get_domain(site.base_url), fetch_page, session, site.base_url,
+                                          site.index_etag, site.index_last_modified)
+    site.indexed_at = now()
+    if response is None or get_content_hash(response.content) == site.index_content_hash:
+        results.put(('site', site, None))
+        return
 
-        # Build site
-        paper = newspaper.build(site.base_url)
+    # The crawl compares the urls against the database rather than newspaper's own memo of seen articles
+    paper = newspaper.build(site.base_url, memoize_articles=False)
+    site.index_etag, site.index_last_modified = get_validators(response)
+    site.index_content_hash = get_content_hash(response.content)
+    results.put(('site', site, [article.url for article in paper.articles]))
+
+
+# Saves the site's index validators and returns the urls to scrape for it. These are the urls in article_urls
+# still to scrape, creating the ones that are new, and the scraped ones due for a refresh. When the index has not
+# changed article_urls is None and the site's urls due for a retry are returned.
+def get_site_urls_to_scrape(site, article_urls):
+    site.save(update_fields=['index_etag', 'index_last_modified', 'index_content_hash', 'indexed_at'])
+    if article_urls is None:
+        return link_existing_articles(list(get_urls_to_scrape().filter(site=site).order_by('pk')))
+
+    article_urls = list(dict.fromkeys(article_urls))
+    existing = set(Url.objects.filter(expanded__in=article_urls).values_list('expanded', flat=True))
+    Url.objects.bulk_create([Url(raw=article_url, expanded=article_url, site=site)
+                             for article_url in article_urls if article_url not in existing],
+                            ignore_conflicts=True)
+
+    urls = link_existing_articles(list(get_urls_to_scrape().filter(expanded__in=article_urls).order_by('pk')))
+    # Urls scraped before fetched_at was kept have never been refreshed
+    stale = Url.objects.filter(expanded__in=article_urls, scraped=True) \
+        .filter(Q(fetched_at__isnull=True) | Q(fetched_at__lt=now() - timedelta(seconds=ARTICLE_REFRESH_SECONDS)))
+    return urls + list(stale.order_by('pk'))
+
+
+# Waits for the parsed articles and stores them along with the urls whose page had not changed, parse_futures
+# maps each parse future to its url
+def save_crawled_articles(parse_futures, unchanged, failed):
+    parsed = []
+    for future in concurrent.futures.as_completed(parse_futures):
+        url = parse_futures[future]
+        try:
+            parsed.append((url, future.result()))
+        except Exception as e:
+            failed.append((url, e))
 
-        for article in tqdm(paper.articles, total=paper.size()):
+    save_scraped_articles(parsed)
+    for url in unchanged:
+        url.scraped = True
+        url.failure_count = 0
+        url.last_error = None
+        url.next_attempt_at = None
+    Url.objects.bulk_update(unchanged, ['scraped', 'failure_count', 'last_error', 'next_attempt_at', 'etag',
+                                        'last_modified', 'content_hash', 'fetched_at'])
+    record_scrape_failures(failed)
+
+
+# Downloads, parses and stores the unscraped urls. Downloads run on a thread pool with no more than domain_limit
+# at once per domain, parsing and nlp run on a process pool and the articles are written batch_size at a time.
+# The parse processes are spawned rather than forked so they never share the database connection.
+def crawl_unscraped_urls(download_workers=DOWNLOAD_WORKERS, parse_workers=PARSE_WORKERS,
+                         domain_limit=DOMAIN_CONCURRENCY, batch_size=SCRAPE_BATCH_SIZE):
+    unscraped_urls = list(get_urls_to_scrape().order_by('pk'))
+    domain_limits = collections.defaultdict(lambda: threading.Semaphore(domain_limit))
+
+    with tqdm(total=len(unscraped_urls)) as progress, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=download_workers) as downloads, \
+            concurrent.futures.ProcessPoolExecutor(max_workers=parse_workers,
+                                                   mp_context=multiprocessing.get_context('spawn')) as parses:
+        for i in range(0, len(unscraped_urls), batch_size):
+            batch = unscraped_urls[i:i + batch_size]
+            urls = link_existing_articles(batch)
+
+            # Parse each page as soon as it has downloaded
+            download_futures = {downloads.submit(download_html, url.expanded, domain_limits[get_domain(url.expanded)]):
+                                url for url in interleave_by_domain(urls)}
+            parse_futures = {}
+            failed = []
+            for future in concurrent.futures.as_completed(download_futures):
+                url = download_futures[future]
+                try:
+                    parse_futures[parses.submit(parse_article_html, url.expanded, future.result())] = url
+                except Exception as e:
+                    failed.append((url, e))
+
+            parsed = []
+            for future in concurrent.futures.as_completed(parse_futures):
+                url = parse_futures[future]
+                try:
+                    parsed.append((url, future.result()))
+                except Exception as e:
+                    failed.append((url, e))
+
+            save_scraped_articles(parsed)
+            record_scrape_failures(failed)
+            progress.update(len(batch))
+
+
+# Unscraped urls that are not parked and whose retry time has come
+def get_urls_to_scrape():
+    return Url.objects.filter(scraped=False, expanded__isnull=False, failure_count__lt=SCRAPE_MAX_FAILURES) \
+        .filter(Q(next_attempt_at__isnull=True) | Q(next_attempt_at__lte=now()))
+
+
+# Counts a failed scrape for each url and schedules the next attempt, failed is a list of (url, error). Urls
+# reaching SCRAPE_MAX_FAILURES are parked until someone resets their failure_count.
+def record_scrape_failures(failed):
+    for url, error in failed:
+        url.failure_count += 1
+        url.last_error = str(error) or error.__class__.__name__
+        if url.failure_count >= SCRAPE_MAX_FAILURES:
+            url.next_attempt_at = None
+            print('Parked url: ', url.expanded, ' ', url.last_error)
+        else:
+            url.next_attempt_at = now() + timedelta(seconds=URL_RETRY_POLICY.get_delay(url.failure_count))
+    Url.objects.bulk_update([url for url, error in failed], ['failure_count', 'last_error', 'next_attempt_at'])
+
+
+# True for server errors, timeouts and connection errors. newspaper only keeps the message of the requests error
+# so the status code is read from it, errors without one are taken to be connection errors.
+def is_retryable_download_error(error):
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        status_code = error.response.status_code
+    elif isinstance(error, requests.RequestException):
+        return True
+    else:
+        match = re.match(r'(\d{3}) (Client|Server) Error', str(error))
+        if match is None:
+            return True
+        status_code = int(match.group(1))
+    return status_code >= 500 or status_code in RETRYABLE_STATUS_CODES
+
+
+# Returns the lower case host of the url
+def get_domain(url):
+    return urllib.parse.urlsplit(url).netloc.lower()
+
+
+# Orders the urls so each domain comes up in turn rather than all of a domain's urls back to back
+def interleave_by_domain(urls):
+    by_domain = collections.defaultdict(collections.deque)
+    for url in urls:
+        by_domain[get_domain(url.expanded)].append(url)
+
+    interleaved = []
+    while len(by_domain) > 0:
+        for domain in list(by_domain.keys()):
+            interleaved.append(by_domain[domain].popleft())
+            if len(by_domain[domain]) <= 0:
+                del by_domain[domain]
+    return interleaved
+
+
+# Links the urls whose article has already been stored and marks them scraped. Returns the ones still to scrape.
+def link_existing_articles(urls):
+    articles = dict(WebArticle.objects.filter(expanded_url__in=[url.expanded for url in urls])
+                    .values_list('expanded_url', 'pk'))
+    linked = [url for url in urls if url.expanded in articles]
+    for url in linked:
+        url.article_id = articles[url.expanded]
+        url.scraped = True
+    Url.objects.bulk_update(linked, ['article', 'scraped'])
+    return [url for url in urls if url.expanded not in articles]
 
-            # See if url already exists in db
-            if Url.objects.filter(expanded__icontains=article.url):  # Exists
-                url = Url.objects.get(expanded__icontains=article.url)
-                if url.article and url.scraped:
-                    continue
-            else:  # Doesn't exist
-                url = Url.objects.create(raw=article.url, expanded=article.url, site=site)
 
-            # Now parse the url for the article and create one
-            article = get_article_from_article(article, url)
+# Downloads the page over the host's session, sending the validators from the last fetch. Returns None if the
+# page has not been modified and raises if the download failed.
+def fetch_page(session, url, etag=None, last_modified=None):
+    headers = {}
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+    response = session.get(url, headers=headers, timeout=CRAWL_TIMEOUT_SECONDS)
+    if response.status_code == 304:
+        return None
+    response.raise_for_status()
+    return response
+
+
+# Returns the (etag, last_modified) of the response to send with the next fetch, values too long to store are
+# dropped rather than truncated since a truncated validator never matches
+def get_validators(response):
+    etag = response.headers.get('ETag')
+    last_modified = response.headers.get('Last-Modified')
+    return etag if etag and len(etag) <= 255 else None, \
+        last_modified if last_modified and len(last_modified) <= 64 else None
+
+
+def get_content_hash(content):
+    return hashlib.sha256(content).hexdigest()
+
+
+# Downloads the page, raises if the download failed
+def download_article(article):
+    article.download()
+    if article.download_state != ArticleDownloadState.SUCCESS:
+        raise ArticleException(article.download_exception_msg)
+
+
+# Downloads the page holding one of the domain's slots, retried with backoff on the domain. Raises if every
+# attempt failed.
+def download_html(url, domain_limit):
+    article = Article(url=url)
+
+    def download():
+        with domain_limit:
+            download_article(article)
 
-            # Add the article and site to the url and mark it as scraped
-            if article:
-                url.article = article
-                url.scraped = True
-                url.save()
+    DOWNLOAD_RETRY_POLICY.call(get_domain(url), download)
+    return article.html
 
 
-def crawl_unscraped_urls():
-    unscraped_urls = Url.objects.filter(scraped=False)
+# Runs on the process pool. Parses the page and runs nlp, returns the fields needed to store the article.
+def parse_article_html(url, html):
+    article = Article(url=url)
+    article.download(input_html=html)
+    article.parse()
+    article.nlp()
+
+    og = article.meta_data.get('og')
+    return dict(
+        authors=article.authors,
+        keywords=article.keywords,
+        lang=article.meta_lang,
+        title=article.title,
+        meta=dict(article.meta_data),
+        text=article.text,
+        date_published=article.publish_date,
+        source_url=article.source_url,
+        site_name=og.get('site_name') if isinstance(og, dict) else None
+    )
+
+
+# Stores the parsed articles and their sites and marks the urls scraped in one transaction. parsed is a list of
+# (url, fields from parse_article_html).
+def save_scraped_articles(parsed):
+    if len(parsed) <= 0:
+        return
 
-    for url in tqdm(unscraped_urls, total=unscraped_urls.count()):
-        create_article_from_url(url)
+    with transaction.atomic():
+        sites = {}
+        for url, fields in parsed:
+            if fields['source_url'] not in sites:
+                sites[fields['source_url']] = get_or_create_site(fields['source_url'], fields['site_name'])
+
+        # Several urls can lead to the same article
+        articles = {}
+        for url, fields in parsed:
+            articles.setdefault(url.expanded, WebArticle(expanded_url=url.expanded, authors=fields['authors'],
+                                                         keywords=fields['keywords'], lang=fields['lang'],
+                                                         title=fields['title'][:255], meta=fields['meta'],
+                                                         text=fields['text'],
+                                                         date_published=fields['date_published']))
+
+        # Articles refreshed by a crawl already exist and are updated in place
+        article_ids = dict(WebArticle.objects.filter(expanded_url__in=articles.keys())
+                           .values_list('expanded_url', 'pk'))
+        for expanded_url, pk in article_ids.items():
+            articles[expanded_url].pk = pk
+        WebArticle.objects.bulk_update([articles[expanded_url] for expanded_url in article_ids],
+                                       ['authors', 'keywords', 'lang', 'title', 'meta', 'text', 'date_published'])
+        WebArticle.objects.bulk_create([article for expanded_url, article in articles.items()
+                                        if expanded_url not in article_ids], ignore_conflicts=True)
+        article_ids = dict(WebArticle.objects.filter(expanded_url__in=articles.keys())
+                           .values_list('expanded_url', 'pk'))
+
+        urls = []
+        for url, fields in parsed:
+            url.site = sites[fields['source_url']]
+            url.article_id = article_ids[url.expanded]
+            url.scraped = True
+            url.failure_count = 0
+            url.last_error = None
+            url.next_attempt_at = None
+            urls.append(url)
+        Url.objects.bulk_update(urls, ['site', 'article', 'scraped', 'failure_count', 'last_error',
+                                       'next_attempt_at', 'etag', 'last_modified', 'content_hash', 'fetched_at'])
+
+
+# Returns the site for the base url, creating it named after the og site name if there is none
+def get_or_create_site(base_url, site_name):
+    site = Site.objects.filter(base_url__exact=base_url).first()
+    if site is not None:
+        return site
+
+    # Names are unique, fall back on the url when another site already uses it
+    name = site_name or base_url
+    if Site.objects.filter(name__exact=name).exists():
+        name = base_url
+    return Site.objects.create(name=name, domain=base_url, base_url=base_url)
 
 
 # Start
@@ -8,8 +8,9 @@ import os
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "CMI_Service.settings")
 import pandas as pd
 from background_services.config import *
-from background_services.twitter_services import get_missing_twitter_ids, update_twitter_followers, get_past_tweets
-from background_services.location_finder import get_coords
+from background_services.twitter_services import get_missing_twitter_ids, update_twitter_followers, get_past_tweets, \
+    hydrate_stub_users
+from background_services.location_finder import geocode_user_locations
 
 
 
@@ -143,37 +144,7 @@ def process_key_influencers_excel_files():
 
 # Get the lat lon for users
 def get_lat_lon_for_influencers():
-    users = SocialMediaUser.objects.filter(location__isnull=False, lat__isnull=True, lon__isnull=True).count()
-
-    # Loop through users
-    elapsed_time = 30
-    for i in tqdm(range(users), total=users):
-        try:
-            user = SocialMediaUser.objects.filter(location__isnull=False, lat__isnull=True, lon__isnull=True)[:1].get()
-        except:
-            return
-
-        if user.lat and user.lon:
-            continue
-
-        # Get coords
-        start = datetime.datetime.now()
-        lat, lon = get_coords(user.location, elapsed_time)
-        if lon == 'No Geocode':
-            user.location = None
-            user.save()
-            continue
-        else:
-            user.lat = lat
-            user.lon = lon
-            user.save()
-
-        # Now loop through users again to see if any match the location
-        SocialMediaUser.objects.select_related().filter(location__icontains=user.location, lat__isnull=True,
-                                                        lon__isnull=True).update(lat=lat, lon=lon)
-
-        end = datetime.datetime.now()
-        elapsed_time = (end - start).seconds
+    print('Users geocoded: ', geocode_user_locations())
 
 
 # Find the various graph depths for users
@@ -225,14 +196,16 @@ if __name__ == '__main__':
     # get_missing_twitter_ids()
 
     # Update followers
-    start = 2
-    for i in range(start, SocialMediaUser.objects.filter(is_influencer=True).count()):
-        #update_twitter_followers(is_initial=True, pk=i) # 123
-        print('### Getting Tweets for User pk: ', i)
-        get_past_tweets(i) # 8
+    # update_twitter_followers(is_initial=True, pk=123)
+
+    # Get the tweets for all influencers, re runs only fetch what is new
+    get_past_tweets(-1)
 
     #get_past_tweets(2058)
 
+    # Fill in the users created from mentions
+    hydrate_stub_users()
+
     # get lat lons
     # get_lat_lon_for_influencers()
 
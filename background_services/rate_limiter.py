@@ -0,0 +1,165 @@
+import copy
+import threading
+import time
+
+# Twitter rate limits are counted over 15 minute windows
+RATE_LIMIT_WINDOW_SECONDS = 15 * 60
+
+# Requests per window with user auth for the endpoints we call, corrected from the response headers
+DEFAULT_RATE_LIMITS = {
+    'followers/ids': 15,
+    'friends/ids': 15,
+    'users/lookup': 900,
+    'users/show': 900,
+    'statuses/user_timeline': 900,
+}
+
+# Endpoint behind each tweepy api method
+API_ENDPOINTS = {
+    'followers_ids': 'followers/ids',
+    'friends_ids': 'friends/ids',
+    'lookup_users': 'users/lookup',
+    'get_user': 'users/show',
+    'user_timeline': 'statuses/user_timeline',
+}
+
+
+# Token bucket for a single endpoint. Refills continuously at capacity per window and is re-synced from the
+# rate limit headers, when the api reports nothing remaining it stays empty until the window resets.
+class TokenBucket:
+
+    def __init__(self, capacity, window_seconds=RATE_LIMIT_WINDOW_SECONDS):
+        self.capacity = capacity
+        self.window_seconds = window_seconds
+        self.tokens = capacity
+        self.updated = time.time()
+        self.blocked_until = 0
+        self.condition = threading.Condition()
+
+    def refill(self, now):
+        if self.blocked_until:
+            if now < self.blocked_until:
+                return
+            # New window
+            self.blocked_until = 0
+            self.tokens = self.capacity
+        else:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.capacity / self.window_seconds)
+        self.updated = now
+
+    # Seconds until the tokens are available
+    def get_wait(self, tokens, now):
+        if self.blocked_until:
+            return self.blocked_until - now
+        return (tokens - self.tokens) * self.window_seconds / self.capacity
+
+    # Blocks until the tokens are available and takes them. Returns False if timeout passed first.
+    def acquire(self, tokens=1, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+        with self.condition:
+            while True:
+                now = time.time()
+                self.refill(now)
+                if not self.blocked_until and self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return True
+
+                wait = self.get_wait(tokens, now)
+                if deadline is not None:
+                    if now >= deadline:
+                        return False
+                    wait = min(wait, deadline - now)
+                self.condition.wait(max(wait, 0.01))
+
+    # Syncs the bucket with the x-rate-limit headers
+    def update(self, limit, remaining, reset):
+        with self.condition:
+            now = time.time()
+            self.refill(now)
+            if limit:
+                self.capacity = limit
+            self.tokens = min(self.capacity, remaining)
+            if remaining <= 0 and reset > now:
+                self.blocked_until = reset
+            self.condition.notify_all()
+
+
+# Shared per endpoint token buckets for every job using the twitter api
+class RateLimiter:
+
+    def __init__(self, limits=None):
+        self.limits = dict(DEFAULT_RATE_LIMITS)
+        if limits:
+            self.limits.update(limits)
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def get_bucket(self, endpoint):
+        with self.lock:
+            if endpoint not in self.buckets:
+                self.buckets[endpoint] = TokenBucket(self.limits.get(endpoint, 15))
+            return self.buckets[endpoint]
+
+    def acquire(self, endpoint, tokens=1, timeout=None):
+        return self.get_bucket(endpoint).acquire(tokens, timeout)
+
+    # Updates the endpoint bucket from the headers of a requests response
+    def update_from_response(self, endpoint, response):
+        if response is None:
+            return
+        headers = response.headers
+        if 'x-rate-limit-remaining' not in headers:
+            return
+        try:
+            self.get_bucket(endpoint).update(int(headers.get('x-rate-limit-limit', 0)),
+                                             int(headers['x-rate-limit-remaining']),
+                                             int(headers.get('x-rate-limit-reset', 0)))
+        except ValueError:
+            pass
+
+    # Returns the remaining tokens for every endpoint used so far
+    def get_stats(self):
+        with self.lock:
+            buckets = dict(self.buckets)
+        return {endpoint: int(bucket.tokens) for endpoint, bucket in buckets.items()}
+
+
+# Wraps a tweepy api so every call to a known endpoint first takes a token from the shared rate limiter. tweepy
+# keeps the last response on the api object, so each thread calls through its own copy of the api and the bucket
+# is always updated from the headers of its own call.
+class RateLimitedAPI:
+
+    def __init__(self, api, limiter):
+        self.api = api
+        self.limiter = limiter
+        self.local = threading.local()
+
+    # The copy of the api used by the current thread
+    def get_api(self):
+        api = getattr(self.local, 'api', None)
+        if api is None:
+            api = copy.copy(self.api)
+            self.local.api = api
+        return api
+
+    def __getattr__(self, name):
+        method = getattr(self.api, name)
+        endpoint = API_ENDPOINTS.get(name)
+        if endpoint is None:
+            return method
+
+        def call(*args, **kwargs):
+            # tweepy.Cursor calls with create=True to get the method object without making a request
+            if kwargs.get('create'):
+                return method(*args, **kwargs)
+            api = self.get_api()
+            self.limiter.acquire(endpoint)
+            try:
+                return getattr(api, name)(*args, **kwargs)
+            finally:
+                self.limiter.update_from_response(endpoint, getattr(api, 'last_response', None))
+
+        # tweepy.Cursor needs to know how the method pages
+        if hasattr(method, 'pagination_mode'):
+            call.pagination_mode = method.pagination_mode
+        return call
@@ -0,0 +1,58 @@
+import random
+import threading
+import time
+
+
+# Capped exponential backoff with jitter. Failures are tracked per key, usually the domain, so every thread
+# calling a failing domain backs off from it together and a success resets it. Errors is_retryable turns down
+# are raised straight away and do not count against the key.
+class RetryPolicy:
+
+    def __init__(self, max_attempts=3, base_seconds=1.0, max_seconds=60.0, is_retryable=None):
+        self.max_attempts = max_attempts
+        self.is_retryable = is_retryable or (lambda error: True)
+        self.base_seconds = base_seconds
+        self.max_seconds = max_seconds
+        self.failures = {}
+        self.not_before = {}
+        self.lock = threading.Lock()
+
+    # Delay after the given number of failures in a row, between half and all of the capped exponential delay
+    def get_delay(self, failures):
+        delay = min(self.max_seconds, self.base_seconds * 2 ** max(failures - 1, 0))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    # Blocks until the key is out of its backoff
+    def wait(self, key):
+        with self.lock:
+            not_before = self.not_before.get(key, 0)
+        delay = not_before - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+    def record_success(self, key):
+        with self.lock:
+            self.failures.pop(key, None)
+            self.not_before.pop(key, None)
+
+    def record_failure(self, key):
+        with self.lock:
+            failures = self.failures.get(key, 0) + 1
+            self.failures[key] = failures
+            self.not_before[key] = time.time() + self.get_delay(failures)
+
+    # Calls func up to max_attempts times backing off the key between attempts, the last error is raised
+    def call(self, key, func, *args, **kwargs):
+        for attempt in range(1, self.max_attempts + 1):
+            self.wait(key)
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                if not self.is_retryable(e):
+                    raise
+                self.record_failure(key)
+                if attempt >= self.max_attempts:
+                    raise
+                continue
+            self.record_success(key)
+            return result
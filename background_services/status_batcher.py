@@ -0,0 +1,129 @@
+import queue
+import threading
+import time
+
+
+# Bounded in process queue between the twitter stream thread and the database. The stream thread only
+# enqueues, a worker thread drains the queue in micro-batches of up to batch_size statuses or whatever
+# arrived within batch_seconds and hands each batch to process_batch. When the queue is full the status
+# is passed to spill if one is provided, otherwise it is dropped. Both are counted in the stats which are
+# printed, or passed to report if one is provided, every report_seconds.
+class StatusBatcher:
+
+    def __init__(self, process_batch, max_size=10000, high_water_mark=8000, batch_size=100, batch_seconds=1.0,
+                 report_seconds=60, spill=None, report=None):
+        self.process_batch = process_batch
+        self.spill = spill
+        self.report = report
+        self.queue = queue.Queue(maxsize=max_size)
+        self.high_water_mark = high_water_mark
+        self.batch_size = batch_size
+        self.batch_seconds = batch_seconds
+        self.report_seconds = report_seconds
+        self.stats = dict(received=0, processed=0, batches=0, failed=0, dropped=0, spilled=0, max_depth=0,
+                          high_water_hits=0)
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.worker = None
+        self.above_high_water = False
+
+    # Starts the worker thread
+    def start(self):
+        if self.worker is not None and self.worker.is_alive():
+            return
+        self.stopping.clear()
+        self.worker = threading.Thread(target=self.run, name='status-batcher', daemon=True)
+        self.worker.start()
+
+    # Stops the worker thread after the queued statuses have been processed
+    def stop(self, timeout=None):
+        self.stopping.set()
+        if self.worker is not None:
+            self.worker.join(timeout)
+
+    # Called from the stream thread. Never blocks, returns False if the status did not make it into the queue.
+    def put(self, status):
+        try:
+            self.queue.put_nowait(status)
+        except queue.Full:
+            self.overflow(status)
+            return False
+
+        depth = self.queue.qsize()
+        with self.lock:
+            self.stats['received'] += 1
+            self.stats['max_depth'] = max(self.stats['max_depth'], depth)
+            if depth >= self.high_water_mark and not self.above_high_water:
+                self.above_high_water = True
+                self.stats['high_water_hits'] += 1
+                print('Status queue above high water mark: ', depth)
+            elif depth < self.high_water_mark:
+                self.above_high_water = False
+        return True
+
+    # Handles a status that did not fit in the queue
+    def overflow(self, status):
+        if self.spill is not None:
+            try:
+                self.spill(status)
+                with self.lock:
+                    self.stats['spilled'] += 1
+                return
+            except Exception as e:
+                print('Error spilling status: ', e)
+
+        with self.lock:
+            self.stats['dropped'] += 1
+
+    # Returns a copy of the stats with the current queue depth
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+        stats['depth'] = self.queue.qsize()
+        return stats
+
+    # Worker loop
+    def run(self):
+        last_report = time.time()
+        while not (self.stopping.is_set() and self.queue.empty()):
+            batch = self.next_batch()
+            if len(batch) > 0:
+                self.process(batch)
+
+            if time.time() - last_report >= self.report_seconds:
+                if self.report is not None:
+                    self.report(self.get_stats())
+                else:
+                    print('Status queue stats: ', self.get_stats())
+                last_report = time.time()
+
+    # Waits for the first status then collects more until the batch is full or batch_seconds have passed
+    def next_batch(self):
+        batch = []
+        try:
+            batch.append(self.queue.get(timeout=self.batch_seconds))
+        except queue.Empty:
+            return batch
+
+        deadline = time.time() + self.batch_seconds
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    # Hands the batch to process_batch, a failure only loses the batch and not the worker
+    def process(self, batch):
+        try:
+            self.process_batch(batch)
+            with self.lock:
+                self.stats['processed'] += len(batch)
+                self.stats['batches'] += 1
+        except Exception as e:
+            print('Error processing status batch: ', e)
+            with self.lock:
+                self.stats['failed'] += len(batch)
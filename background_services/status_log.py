@@ -0,0 +1,161 @@
+import json
+import os
+import struct
+import threading
+import time
+
+# Length prefix written before every record
+RECORD_HEADER = struct.Struct('>I')
+
+SEGMENT_SUFFIX = '.log'
+CHECKPOINT_FILE = 'checkpoint.json'
+
+
+# Append only log of raw status json split into numbered segment files. Each record is a length prefix
+# followed by the utf-8 json. Writes are flushed on every append and fsynced once fsync_records records or
+# fsync_seconds have gone by. A position is a (segment, offset) tuple pointing just past a record, the
+# checkpoint is the position up to which the records have been loaded into the database.
+class StatusLog:
+
+    def __init__(self, directory, segment_bytes=64 * 1024 * 1024, fsync_records=500, fsync_seconds=1.0,
+                 keep_segments=False):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.fsync_records = fsync_records
+        self.fsync_seconds = fsync_seconds
+        self.keep_segments = keep_segments
+        self.lock = threading.RLock()
+        self.unsynced_records = 0
+        self.last_sync = time.time()
+
+        os.makedirs(directory, exist_ok=True)
+        segments = self.get_segments()
+        self.segment = segments[-1] if segments else 0
+        self.file = open(self.get_segment_path(self.segment), 'ab')
+        self.recover()
+        self.checkpoint = self.load_checkpoint()
+
+    # Returns the sorted segment numbers on disk
+    def get_segments(self):
+        return sorted(int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(self.directory)
+                      if name.endswith(SEGMENT_SUFFIX))
+
+    def get_segment_path(self, segment):
+        return os.path.join(self.directory, '%020d%s' % (segment, SEGMENT_SUFFIX))
+
+    # Cuts off a record that was only partly written when the process died
+    def recover(self):
+        offset = 0
+        with open(self.get_segment_path(self.segment), 'rb') as f:
+            for record, position in self.read_segment(f, self.segment, 0):
+                offset = position[1]
+        if offset < self.file.tell():
+            print('Truncating partial record in status log segment: ', self.segment)
+            self.file.truncate(offset)
+            self.file.seek(offset)
+
+    # Position just past the last record written
+    def end_position(self):
+        with self.lock:
+            return self.segment, self.file.tell()
+
+    # Appends a single record and returns its position
+    def append(self, record):
+        return self.append_batch([record])[1]
+
+    # Appends the records and returns the (start, end) positions of the batch
+    def append_batch(self, records):
+        with self.lock:
+            if self.file.tell() >= self.segment_bytes:
+                self.roll()
+            start = self.end_position()
+            for record in records:
+                data = json.dumps(record).encode('utf-8')
+                self.file.write(RECORD_HEADER.pack(len(data)))
+                self.file.write(data)
+            self.file.flush()
+
+            self.unsynced_records += len(records)
+            if self.unsynced_records >= self.fsync_records or time.time() - self.last_sync >= self.fsync_seconds:
+                self.sync()
+            return start, self.end_position()
+
+    # Forces the written records to disk
+    def sync(self):
+        with self.lock:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.unsynced_records = 0
+            self.last_sync = time.time()
+
+    # Closes the current segment and starts the next one
+    def roll(self):
+        self.sync()
+        self.file.close()
+        self.segment += 1
+        self.file = open(self.get_segment_path(self.segment), 'ab')
+
+    def close(self):
+        with self.lock:
+            self.sync()
+            self.file.close()
+
+    # Reads up to max_records records from position. Returns a list of (record, position after record).
+    def read(self, position, max_records=None):
+        records = []
+        end = self.end_position()
+        for segment in self.get_segments():
+            if segment < position[0]:
+                continue
+            offset = position[1] if segment == position[0] else 0
+            with open(self.get_segment_path(segment), 'rb') as f:
+                for record in self.read_segment(f, segment, offset):
+                    if record[1] > end:
+                        return records
+                    records.append(record)
+                    if max_records and len(records) >= max_records:
+                        return records
+        return records
+
+    # Yields the (record, position) pairs from the open segment file starting at offset
+    def read_segment(self, f, segment, offset):
+        f.seek(offset)
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+            length = RECORD_HEADER.unpack(header)[0]
+            data = f.read(length)
+            if len(data) < length:
+                return
+            offset += RECORD_HEADER.size + length
+            yield json.loads(data.decode('utf-8')), (segment, offset)
+
+    # Records not yet loaded into the database
+    def get_backlog(self, max_records=None):
+        return self.read(self.checkpoint, max_records)
+
+    def is_caught_up(self):
+        return self.checkpoint == self.end_position()
+
+    def load_checkpoint(self):
+        try:
+            with open(os.path.join(self.directory, CHECKPOINT_FILE)) as f:
+                checkpoint = json.load(f)
+                return checkpoint['segment'], checkpoint['offset']
+        except FileNotFoundError:
+            segments = self.get_segments()
+            return (segments[0] if segments else 0), 0
+
+    # Saves the checkpoint and removes the segments that have been fully loaded
+    def save_checkpoint(self, position):
+        path = os.path.join(self.directory, CHECKPOINT_FILE)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(dict(segment=position[0], offset=position[1]), f)
+        os.replace(path + '.tmp', path)
+        self.checkpoint = tuple(position)
+
+        if not self.keep_segments:
+            for segment in self.get_segments():
+                if segment < self.checkpoint[0]:
+                    os.remove(self.get_segment_path(segment))
@@ -2,12 +2,13 @@
 import tweepy
 import time
 import os
-from tqdm import tqdm
+import threading
 import pandas as pd
 from background_services.config import *
 
 # Django imports so you can delete and add your Databricks imports
 from django.conf import settings
+from django.db import InterfaceError, OperationalError, close_old_connections
 from django.utils.timezone import make_aware
 # end Django imports
 
@@ -16,14 +17,17 @@ from vaderSentiment.vaderSentiment import SentimentIntensityAnalyzer
 
 from background_services.location_finder import get_coords_using_here, get_coords_using_opencage, \
     get_coords_using_locationiq
+from background_services.status_batcher import StatusBatcher
+from background_services.status_log import StatusLog
 
 # More django imports needs to be lower than background services to not add redundancies
 # Can also remove as needed since you will be using databricks
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "CMI_Service.settings")
 import django
 django.setup()
-from common.models import SocialMediaUser, SocialMediaPost
-from background_services.twitter_services import process_status, process_restatus, create_user_from_twitter_user
+from socialmediauser.models import SocialMediaUser
+from background_services.twitter_services import process_statuses, hydrate_stub_users, warm_id_caches, \
+    get_id_cache_stats
 # End more django imports and setup
 
 
@@ -33,12 +37,52 @@ KEYWORDS = ['trump', 'clinton', 'russia', 'ukraine', 'united states', 'usa']
 # Twitter influencers
 TWITTER_INFLUENCERS = []
 
+# Micro-batching between the stream and the database
+STREAM_QUEUE_SIZE = 10000
+STREAM_QUEUE_HIGH_WATER_MARK = 8000
+STREAM_BATCH_SIZE = 100
+STREAM_BATCH_SECONDS = 1.0
+
+STATUS_BATCHER = None
+
+# Every status is written to the status log before the database, the log is replayed after failures
+STATUS_LOG_DIRECTORY = os.environ.get('STATUS_LOG_DIRECTORY',
+                                      os.path.join(os.path.dirname(os.path.abspath(__file__)), 'status_log'))
+STATUS_REPLAY_BATCH_SIZE = 500
+STATUS_REPLAY_MAX_RECORDS = 5000
+
+STATUS_LOG = None
+
+# Statuses that fail to store even on their own are set aside here so the checkpoint can move past them
+STATUS_DEAD_LETTER_DIRECTORY = os.environ.get('STATUS_DEAD_LETTER_DIRECTORY',
+                                              os.path.join(STATUS_LOG_DIRECTORY, 'dead_letter'))
+
+DEAD_LETTER_LOG = None
+
+# Delay before reconnecting the stream, doubled on every failed attempt
+STREAM_RECONNECT_SECONDS = 5
+STREAM_MAX_RECONNECT_SECONDS = 320
+
+# How often the stub users created from mentions are hydrated and the most hydrated each time, 100 per lookup
+USER_HYDRATION_SECONDS = 300
+USER_HYDRATION_LIMIT = 10000
+
+USER_HYDRATOR = None
+
 
 # override tweepy.StreamListener to add logic to on_status
 class MyStreamListener(tweepy.StreamListener):
 
+    def __init__(self, batcher, status_log, api=None):
+        super().__init__(api)
+        self.batcher = batcher
+        self.status_log = status_log
+
+    # Written to the status log before anything else so a crash never loses a queued status, then only enqueued
+    # so the database never holds up the stream thread
     def on_status(self, status):
-        process_tweet(status)
+        start, end = self.status_log.append_batch([status._json])
+        self.batcher.put((status, start, end))
 
     def on_error(self, status_code):
         print('Error in Twitter stream: ', status_code)
@@ -46,34 +90,123 @@ class MyStreamListener(tweepy.StreamListener):
             # returning False in on_error disconnects the stream
             return False
 
+    # The stream is reconnected by start_streamer
     def on_exception(self, exception):
-        start_streamer()
-        return
+        print('Exception in Twitter stream: ', exception)
 
 
 def start_streamer():
     df = pd.DataFrame.from_records(SocialMediaUser.objects.filter(is_influencer=True).values())
     global TWITTER_INFLUENCERS
     TWITTER_INFLUENCERS = df[df['twitter_user_id'].notnull()]['twitter_user_id'].astype(int).astype(str).unique().tolist()
-    stream_listener = MyStreamListener()
+
+    # Load anything left in the status log by the last run
+    global STATUS_LOG, DEAD_LETTER_LOG
+    if STATUS_LOG is None:
+        STATUS_LOG = StatusLog(STATUS_LOG_DIRECTORY)
+        DEAD_LETTER_LOG = StatusLog(STATUS_DEAD_LETTER_DIRECTORY, keep_segments=True)
+        warm_id_caches()
+    try:
+        print('Replayed statuses: ', replay_status_log())
+    except Exception as e:
+        print('Error replaying status log: ', e)
+
+    # Statuses that do not fit in the queue are already in the status log, they are replayed from there
+    global STATUS_BATCHER
+    if STATUS_BATCHER is None:
+        STATUS_BATCHER = StatusBatcher(process_tweets, max_size=STREAM_QUEUE_SIZE,
+                                       high_water_mark=STREAM_QUEUE_HIGH_WATER_MARK, batch_size=STREAM_BATCH_SIZE,
+                                       batch_seconds=STREAM_BATCH_SECONDS, spill=lambda item: None,
+                                       report=report_stream_stats)
+    STATUS_BATCHER.start()
+
+    global USER_HYDRATOR
+    if USER_HYDRATOR is None:
+        USER_HYDRATOR = threading.Thread(target=run_user_hydrator, name='user-hydrator', daemon=True)
+        USER_HYDRATOR.start()
+
+    stream_listener = MyStreamListener(STATUS_BATCHER, STATUS_LOG)
     auth = tweepy.OAuthHandler(TWITTER_APP_KEY, TWITTER_APP_SECRET)
     auth.set_access_token(TWITTER_KEY, TWITTER_SECRET)
     api = tweepy.API(auth)
     stream = tweepy.Stream(auth=api.auth, listener=stream_listener)
-    stream.filter(follow=TWITTER_INFLUENCERS, is_async=True)
-
 
-def process_tweet(status):
-    try:
-        user = SocialMediaUser.objects.get(twitter_user_id=status.author.id)
-    except:
-        user = create_user_from_twitter_user(status.author)
-
-    if hasattr(status, 'retweeted_status'):
-        process_restatus(status, user)
+    # Reconnect in a loop rather than starting a new streamer from on_exception
+    delay = STREAM_RECONNECT_SECONDS
+    while True:
+        connected_at = time.time()
+        try:
+            stream.filter(follow=TWITTER_INFLUENCERS)
+        except Exception as e:
+            print('Twitter stream disconnected: ', e)
+
+        if time.time() - connected_at > STREAM_MAX_RECONNECT_SECONDS:
+            delay = STREAM_RECONNECT_SECONDS
+        time.sleep(delay)
+        delay = min(delay * 2, STREAM_MAX_RECONNECT_SECONDS)
+
+
+# Stores a micro-batch of (status, start, end) from the stream, each already in the status log at start to end.
+# If the batch does not pick up at the checkpoint, because earlier statuses did not fit in the queue or were not
+# stored, the log is replayed from the checkpoint instead so nothing is skipped.
+def process_tweets(batch):
+    close_old_connections()
+    contiguous = all(batch[i][1] == batch[i - 1][2] for i in range(1, len(batch)))
+    if STATUS_LOG.checkpoint == batch[0][1] and contiguous:
+        store_statuses([status for status, start, end in batch], batch[-1][2])
     else:
-        process_status(status, user)
-
+        replay_status_log(STATUS_REPLAY_MAX_RECORDS)
+
+
+# Loads the statuses in the status log past the checkpoint into the database, STATUS_REPLAY_BATCH_SIZE at a
+# time. Also used to backfill after an outage without going back to the api. Returns the number replayed.
+def replay_status_log(max_records=None):
+    replayed = 0
+    while max_records is None or replayed < max_records:
+        records = STATUS_LOG.get_backlog(STATUS_REPLAY_BATCH_SIZE)
+        if len(records) <= 0:
+            break
+        store_statuses([tweepy.models.Status.parse(None, record) for record, position in records], records[-1][1])
+        replayed += len(records)
+    return replayed
+
+
+# Stores the statuses and moves the checkpoint to position, just past the last of them. If the batch fails it is
+# retried one status at a time and those that still fail go to the dead letter log so a single bad status does not
+# hold up the stream. Losing the database raises before the checkpoint moves so the batch is replayed later.
+def store_statuses(statuses, position):
+    try:
+        process_statuses(statuses)
+    except (InterfaceError, OperationalError):
+        raise
+    except Exception as e:
+        print('Error storing statuses, retrying one at a time: ', e)
+        for status in statuses:
+            try:
+                process_statuses([status])
+            except (InterfaceError, OperationalError):
+                raise
+            except Exception as e:
+                print('Moved status to the dead letter log: ', status.id, ' ', e)
+                DEAD_LETTER_LOG.append(status._json)
+    STATUS_LOG.save_checkpoint(position)
+
+
+# Prints the queue stats along with the id cache hit rates
+def report_stream_stats(stats):
+    print('Status queue stats: ', stats)
+    print('Id cache stats: ', get_id_cache_stats())
+
+
+# Hydrates the stub users created from mentions off the stream thread
+def run_user_hydrator():
+    while True:
+        try:
+            close_old_connections()
+            hydrate_stub_users(limit=USER_HYDRATION_LIMIT)
+        except Exception as e:
+            print('Error hydrating users: ', e)
+        time.sleep(USER_HYDRATION_SECONDS)
 
 
 def sentiment_analyzer_scores(sentence):
@@ -87,23 +220,10 @@ def sentiment_analyzer_scores(sentence):
         return 'Negative'
 
 
+# Posts take their location from the author so geocode the authors
 def start_geocode_database():
-    posts = SocialMediaPost.objects.filter(lat__isnull=True, location__isnull=False)
-
-    print(len(posts))
-
-    for post in tqdm(posts, total=len(posts)):
-        lat, lon = location_finder.get_coords_using_locationiq(post.location)
-        time.sleep(0.5)
-        post.lat = lat
-        post.lon = lon
-        post.save()
-        if lat is not None and lon is not None:
-            similar_posts = SocialMediaPost.objects.filter(location__exact=post.location, lat__isnull=True)
-            for post_two in similar_posts:
-                post_two.lat = lat
-                post_two.lon = lon
-                post_two.save()
+    authors = SocialMediaUser.objects.filter(socialmediapost__isnull=False)
+    print('Authors geocoded: ', location_finder.geocode_user_locations(authors))
 
 
 # Start
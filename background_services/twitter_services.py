@@ -1,84 +1,111 @@
 import tweepy
 import os
+import functools
+import io
 import pandas as pd
 from background_services.config import *
-import time
+from background_services.rate_limiter import RateLimiter, RateLimitedAPI
+from background_services.background_worker import run_concurrently
+from background_services.id_cache import IdCache
 from tqdm import tqdm
-from django.db import transaction
+from django.db import connection, transaction
+from django.db.models import Count, F, Max
 from django.conf import settings
-from django.utils.timezone import make_aware
+from django.utils.timezone import make_aware, now
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "CMI_Service.settings")
 import django
 django.setup()
-from socialmediauser.models import SocialMediaUser
+from socialmediauser.models import SocialMediaUser, TwitterCrawlState
 from socialmediapost.models import SocialMediaPost, Hashtag
 from webarticles.models import Url
 
 auth = tweepy.OAuthHandler(TWITTER_APP_KEY, TWITTER_APP_SECRET)
 auth.set_access_token(TWITTER_KEY, TWITTER_SECRET)
-api = tweepy.API(auth, wait_on_rate_limit=True, wait_on_rate_limit_notify=True, retry_count=10, retry_delay=60)
 
+# Every call to the api takes its quota from the shared per endpoint rate limiter. tweepy still waits on a
+# rate limit error in case another process is using the same keys.
+rate_limiter = RateLimiter()
+api = RateLimitedAPI(tweepy.API(auth, wait_on_rate_limit=True, wait_on_rate_limit_notify=True, retry_count=10,
+                                retry_delay=60), rate_limiter)
 
-# Creates or updates users from the provided ids. Adds the influencer to the list of follows for each record.
-def update_create_user_data_from_ids_of_followers(id_list, influencer):
-    users_return = []
+# Number of influencer follower lists crawled at once
+FOLLOWER_WORKERS = 4
+# Follower ids per page, the most the api returns
+FOLLOWER_PAGE_SIZE = 5000
+# Rows per insert when creating the stub users for a page of followers
+FOLLOWER_INSERT_BATCH_SIZE = 5000
 
-    # If no ids exit
-    if len(id_list) <= 0:
-        return users_return
+# Number of influencer timelines fetched at once
+TIMELINE_WORKERS = 8
 
-    # First check to see if the ids are already in the database
-    # Try and add a way to update all users at once!
-    ids_to_get = []
-    users = SocialMediaUser.objects.filter(twitter_user_id__in=id_list)
-    with transaction.atomic():
-        for user in tqdm(users, total=len(users)):
-            user.twitter_follows.add(influencer)
-            users_return.append(user)
+# Most tweets user_timeline returns per request
+TIMELINE_PAGE_SIZE = 200
 
-    # Get the ids not in the database
-    if len(users) <= 0:
-        ids_to_get = id_list
-    else:
-        users_df = pd.DataFrame.from_records(users.values())
-        user_ids = users_df['twitter_user_id'].to_list()
-        ids_to_get = [x for x in id_list if x not in user_ids]
+# Entries kept in the id caches used by ingest
+USER_ID_CACHE_SIZE = 100000
+HASHTAG_ID_CACHE_SIZE = 50000
+URL_ID_CACHE_SIZE = 50000
 
-    if len(ids_to_get) <= 0:
-        return users_return
+# Twitter user id, hashtag text and expanded url to primary key
+user_id_cache = IdCache('users', USER_ID_CACHE_SIZE)
+hashtag_id_cache = IdCache('hashtags', HASHTAG_ID_CACHE_SIZE)
+url_id_cache = IdCache('urls', URL_ID_CACHE_SIZE)
 
-    iterations = int(len(ids_to_get) / 100)
+# Advisory lock taken by every transaction that inserts users or posts. twitter_user_id and post_id are not unique
+# so two workers storing the same author, mention or retweet would both find it missing and insert it twice.
+INGEST_LOCK_ID = 5301
 
-    elapsed_time = 3
-    for i in range(iterations + 1):
-        if elapsed_time < 3:
-            time.sleep(3 - elapsed_time)
+# Lookups a stub can be left out of before hydrate_stub_users stops asking for it
+USER_LOOKUP_MAX_FAILURES = 3
 
-        time_start = time.time()
+# Fields set by update_user_from_twitter_user
+HYDRATED_USER_FIELDS = ['name', 'twitter_screen_name', 'location', 'twitter_posts_count', 'is_stub']
 
-        if len(ids_to_get) > i * 100 + 100:
-            ids = ids_to_get[(i * 100):(i * 100 + 100)]
-        elif len(ids_to_get) == 1:
-            ids = ids_to_get
-        else:
-            ids = ids_to_get[(i * 100):-1]
 
-        if len(ids) <= 0:
-            return users_return
-
-        try:
-            twitter_users = api.lookup_users(user_ids=ids)
-            for y in tqdm(range(len(twitter_users)), total=len(twitter_users)):
-                tmp_follower = create_user_from_twitter_user(twitter_users[y])
-                tmp_follower.twitter_follows.add(influencer)
-                users_return.append(tmp_follower)
-        except Exception as e:
-            print(e, 'pk: ', influencer.pk)
-
-        elapsed_time = time.time() - time_start
+# Loads a page of follower ids for the influencer using a fixed number of statements however long the page.
+# Ids not in the db are created as stubs for hydrate_stub_users to fill in, then the follower keys are copied
+# into a temp table and from there into both the influencer's twitter_followers and each follower's
+# twitter_follows. Returns the number of followers that were not stored before.
+def update_create_user_data_from_ids_of_followers(id_list, influencer):
+    id_set = set(id_list)
+    if len(id_set) <= 0:
+        return 0
 
-    return users_return
+    with transaction.atomic():
+        users, missing = user_id_cache.get_many(id_set)
+        if len(missing) > 0:
+            lock_ingest()
+            found = dict(SocialMediaUser.objects.filter(twitter_user_id__in=missing)
+                         .values_list('twitter_user_id', 'pk'))
+            new_users = [SocialMediaUser(twitter_user_id=twitter_id, is_influencer=False, is_stub=True)
+                         for twitter_id in set(missing) - found.keys()]
+            for user in SocialMediaUser.objects.bulk_create(new_users, batch_size=FOLLOWER_INSERT_BATCH_SIZE):
+                found[user.twitter_user_id] = user.pk
+            cache_on_commit(user_id_cache, found)
+            users.update(found)
+
+        return copy_followers(influencer.pk, list(users.values()))
+
+
+# Adds the follower keys to the influencer's twitter_followers and the influencer to each follower's
+# twitter_follows. The keys are sent with COPY into a temp table and inserted from there skipping existing rows.
+# Returns the number of followers added.
+def copy_followers(influencer_pk, follower_pks):
+    followers = SocialMediaUser.twitter_followers.through._meta.db_table
+    follows = SocialMediaUser.twitter_follows.through._meta.db_table
+    data = io.StringIO(''.join('%d\n' % pk for pk in follower_pks))
+
+    with connection.cursor() as cursor:
+        cursor.execute('CREATE TEMP TABLE follower_pks (pk integer)')
+        cursor.copy_expert('COPY follower_pks FROM STDIN', data)
+        cursor.execute('INSERT INTO ' + followers + ' (from_socialmediauser_id, to_socialmediauser_id) '
+                       'SELECT DISTINCT %s, pk FROM follower_pks ON CONFLICT DO NOTHING', [influencer_pk])
+        added = cursor.rowcount
+        cursor.execute('INSERT INTO ' + follows + ' (from_socialmediauser_id, to_socialmediauser_id) '
+                       'SELECT DISTINCT pk, %s FROM follower_pks ON CONFLICT DO NOTHING', [influencer_pk])
+        cursor.execute('DROP TABLE follower_pks')
+    return added
 
 
 # Get the twitter ids from twitter
@@ -92,23 +119,9 @@ def get_missing_twitter_ids():
         if len(influencers) <= 0:
             return
 
-        iterations = int(len(influencers) / 100)
-
-        elapsed_time = 3
-        for i in range(iterations + 1):
-            if elapsed_time < 3:
-                time.sleep(3 - elapsed_time)
-
-            time_start = time.time()
-
-            if len(influencers) >= i * 100 + 100:
-                names = influencers[(i * 100):(i * 100 + 100)]
-            elif len(influencers) == 1:
-                names = influencers
-            else:
-                names = influencers[(i * 100):-1]
-
-            users = api.lookup_users(screen_names=names)
+        # Lookups are paced by the rate limiter
+        for i in range(0, len(influencers), 100):
+            users = api.lookup_users(screen_names=influencers[i:i + 100])
             for y in tqdm(range(len(users)), total=len(users)):
                 db_user = SocialMediaUser.objects.get(twitter_screen_name__iexact=users[y].screen_name)
                 if db_user:
@@ -117,103 +130,78 @@ def get_missing_twitter_ids():
                         db_user.location = users[y].location
                     db_user.twitter_posts = users[y].statuses_count
                     db_user.save()
-
-            elapsed_time = time.time() - time_start
     except Exception as e:
         print(e)
 
 
-# Updates the twitter followers and follows for the provided user key
-def update_twitter_followers_single(is_initial, pk):
-    elapsed_time = 60
-    # Save the ids to the user
+# Crawls the followers of the provided user key, one page of FOLLOWER_PAGE_SIZE ids at a time. The cursor of the
+# next page is saved with each page so an interrupted crawl resumes where it stopped. Once a pass has finished
+# the next run starts a new pass from the newest followers and stops at the first page with nothing new,
+# restart goes through every page again. Returns the number of followers added.
+def crawl_twitter_followers(pk, restart=False):
     user = SocialMediaUser.objects.get(pk=pk)
-    if user is None:
-        return
-
-    # First see how many followers the user has already
-    followers = user.get_follower_count()
-
-    # Now determine what page to start on based on 5000 limit
-    page = int(followers / 5000)
-
-    # Get the follower ids
+    state, created = TwitterCrawlState.objects.get_or_create(user=user, crawl=TwitterCrawlState.FOLLOWERS)
+
+    is_refresh = state.completed_at is not None and not restart
+    if state.next_cursor == 0 or restart:
+        state.next_cursor = -1
+        state.pages = 0
+    if state.next_cursor == -1:
+        state.started_at = now()
+    state.last_error = None
+    state.save()
+
+    added = 0
     try:
-        while True:
-            # Pause as needed for rate limiting
-            if elapsed_time < 60:
-                time.sleep(60 - elapsed_time)
-
-            follower_ids = api.followers_ids(page=page, user_id=user.twitter_user_id)
-
-            # Start timer
-            time_start = time.time()
-
-            if follower_ids:
-                # Now get the user info for all the followers
-                new_followers = update_create_user_data_from_ids_of_followers(follower_ids, user)
-
-                # Update users followers
-                user.twitter_followers.add(*new_followers)
-            else:
-                break
+        while state.next_cursor != 0:
+            follower_ids, cursors = api.followers_ids(user_id=user.twitter_user_id, cursor=state.next_cursor,
+                                                      count=FOLLOWER_PAGE_SIZE)
+
+            # The page and the cursor past it are saved together
+            with transaction.atomic():
+                page_added = update_create_user_data_from_ids_of_followers(follower_ids, user)
+                state.next_cursor = cursors[1]
+                state.pages += 1
+                if is_refresh and page_added == 0:
+                    # Followers come newest first, the rest are already stored
+                    state.next_cursor = 0
+                if state.next_cursor == 0:
+                    state.completed_at = now()
+                state.save()
+            added += page_added
+
+    except tweepy.error.TweepError as e:
+        print(e, ' pk: ', pk)
+        state.last_error = str(e)
+        state.save(update_fields=['last_error'])
 
-            page += 1
+    return added
 
-            elapsed_time = time.time() - time_start
 
-    except tweepy.error.RateLimitError as e:
-        print(e, ' pk: ', pk)
+# Updates the twitter followers and follows for the provided user key
+def update_twitter_followers_single(is_initial, pk):
+    crawl_twitter_followers(pk)
 
 
-# Updates the users twitter followers and follows for a list of records
-def update_twitter_followers_multi(pks):
-    pass
+# Updates the users twitter followers and follows for a list of records, several users at a time. The api calls
+# all go through the shared rate limiter.
+def update_twitter_followers_multi(pks, workers=FOLLOWER_WORKERS):
+    return run_concurrently(crawl_twitter_followers, pks, workers=workers, description='Followers')
 
 
-# Updates the followers and follows for all records
+# Updates the followers and follows for all influencers. The initial run only crawls the influencers whose
+# followers have not been through a finished pass yet.
 def update_twitter_followers_all(is_initial=False):
-    influencer_records = SocialMediaUser.objects.filter(twitter_user_id__isnull=False, is_influencer=True,
-                                                        twitter_followers=[]).values()
-    df = pd.DataFrame.from_records(influencer_records)
-    influencers = df[df['twitter_user_id'].notnull()]['twitter_user_id'].tolist()
+    influencers = SocialMediaUser.objects.filter(twitter_user_id__isnull=False, is_influencer=True)
+    if is_initial:
+        influencers = influencers.exclude(crawl_states__crawl=TwitterCrawlState.FOLLOWERS,
+                                          crawl_states__completed_at__isnull=False)
 
-    if len(influencers) <= 0:
+    pks = list(influencers.order_by('pk').values_list('pk', flat=True))
+    if len(pks) <= 0:
         return
 
-    elapsed_time = 60
-    for influencer_id in influencers:
-
-        # Save the ids to the user
-        user = SocialMediaUser.objects.get(twitter_user_id__exact=influencer_id)
-        if user is None:
-            continue
-
-        # Get the follower ids
-        try:
-            for follower_ids in tweepy.Cursor(api.followers_ids, user_id=influencer_id).pages():
-
-                # Pause as needed for rate limiting
-                if elapsed_time < 60:
-                    time.sleep(60 - elapsed_time)
-
-                # Start timer
-                time_start = time.time()
-
-                new_followers = [x for x in follower_ids if x not in user.twitter_followers]
-
-                # Now get the user info for all the followers
-                if is_initial:
-                    update_create_user_data_from_ids_of_followers(new_followers, influencer_id)
-
-                # Update users followers
-                user.twitter_followers += new_followers
-                user.save()
-
-                elapsed_time = time.time() - time_start
-
-        except tweepy.error.RateLimitError as e:
-            print(e)
+    update_twitter_followers_multi(pks)
 
 
 # Main entry to determine which twitter update function to run
@@ -236,17 +224,100 @@ def update_twitter_following():
 
 # creates a new user from the provided user object from tweepy
 def create_user_from_twitter_user(user):
-    new_user = SocialMediaUser(name=user.name,
-                               twitter_user_id=user.id,
-                               twitter_screen_name=user.screen_name,
-                               location=user.location,
-                               is_influencer=False,
-                               twitter_posts_count=user.statuses_count
-                               )
+    new_user = build_user_from_twitter_user(user)
     new_user.save()
     return new_user
 
 
+# Builds an unsaved user from the provided user object from tweepy
+def build_user_from_twitter_user(user):
+    return SocialMediaUser(name=user.name,
+                           twitter_user_id=user.id,
+                           twitter_screen_name=user.screen_name,
+                           location=user.location,
+                           is_influencer=False,
+                           twitter_posts_count=user.statuses_count
+                           )
+
+
+# Copies the profile from the tweepy user object onto an existing user
+def update_user_from_twitter_user(user, twitter_user):
+    user.name = twitter_user.name
+    user.twitter_screen_name = twitter_user.screen_name
+    user.location = twitter_user.location
+    user.twitter_posts_count = twitter_user.statuses_count
+    user.is_stub = False
+
+
+# Returns a dict of twitter id to user key for a dict of twitter id to tweepy user object. Users not in the
+# cache or the db are created with a single bulk insert. Stubs found in the db are filled in from the tweepy
+# user, stubs found in the cache are left to hydrate_stub_users.
+def get_or_create_user_ids_from_twitter_users(twitter_users):
+    users, missing = user_id_cache.get_many(twitter_users.keys())
+    if len(missing) <= 0:
+        return users
+
+    found = {}
+    stubs = []
+    for user in SocialMediaUser.objects.filter(twitter_user_id__in=missing):
+        found[user.twitter_user_id] = user.pk
+        if user.is_stub:
+            stubs.append(user)
+
+    # We have the full profile so fill in any stubs created from mentions
+    for user in stubs:
+        update_user_from_twitter_user(user, twitter_users[user.twitter_user_id])
+    SocialMediaUser.objects.bulk_update(stubs, HYDRATED_USER_FIELDS)
+
+    new_users = [build_user_from_twitter_user(twitter_users[twitter_id]) for twitter_id in missing
+                 if twitter_id not in found]
+    for user in SocialMediaUser.objects.bulk_create(new_users):
+        found[user.twitter_user_id] = user.pk
+
+    cache_on_commit(user_id_cache, found)
+    users.update(found)
+    return users
+
+
+# Waits for any other transaction inserting users or posts, in this or another process, to finish. Held until the
+# current transaction ends so the rows it checks for are only inserted once.
+def lock_ingest():
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT pg_advisory_xact_lock(%s)', [INGEST_LOCK_ID])
+
+
+# Adds the keys to the cache once the transaction commits so rows that are rolled back never end up in it
+def cache_on_commit(cache, items):
+    if len(items) > 0:
+        transaction.on_commit(lambda: cache.set_many(items))
+
+
+# Loads the influencers, the most used hashtags and the newest urls into the id caches. Called when the streamer
+# starts so most lookups skip the db from the first tweet. The most used are loaded last so they are evicted last.
+def warm_id_caches():
+    users = list(SocialMediaUser.objects.filter(twitter_user_id__isnull=False).order_by('-pk')
+                 .values_list('twitter_user_id', 'pk')[:USER_ID_CACHE_SIZE // 2])
+    users.reverse()
+    user_id_cache.set_many(dict(users))
+    user_id_cache.set_many(dict(SocialMediaUser.objects.filter(is_influencer=True, twitter_user_id__isnull=False)
+                                .values_list('twitter_user_id', 'pk')))
+
+    tags = list(Hashtag.objects.annotate(post_count=Count('posts')).order_by('-post_count')
+                .values_list('text', 'pk')[:HASHTAG_ID_CACHE_SIZE])
+    tags.reverse()
+    hashtag_id_cache.set_many(dict(tags))
+
+    urls = list(Url.objects.filter(expanded__isnull=False).order_by('-pk')
+                .values_list('expanded', 'pk')[:URL_ID_CACHE_SIZE // 2])
+    urls.reverse()
+    url_id_cache.set_many(dict(urls))
+
+
+# Returns the size and hit rate of each id cache
+def get_id_cache_stats():
+    return {cache.name: cache.get_stats() for cache in [user_id_cache, hashtag_id_cache, url_id_cache]}
+
+
 # Creates a new twitter user record in db based on the twitter id
 # Goes to twitter api and gets the info
 def create_user_from_twitter_id(twitter_id):
@@ -259,159 +330,320 @@ def create_user_from_twitter_id(twitter_id):
         return None
 
 
-# Main entry into getting previous tweets for all or single user
-def get_past_tweets(pk):
+# Main entry into getting previous tweets for all or single user. With refresh only the tweets newer than what
+# is stored are fetched.
+def get_past_tweets(pk, refresh=False):
     if isinstance(pk, list):
-        update_twitter_followers_multi(pk)
+        backfill_timelines(pk, refresh=refresh)
         return
 
     if pk == -1:  # all
-        start = 0
-        for i in range(start, SocialMediaUser.objects.filter(is_influencer=True).count()):
-            get_past_tweets_for_user(i)
+        backfill_timelines(list(SocialMediaUser.objects.filter(is_influencer=True, twitter_user_id__isnull=False)
+                                .order_by('pk').values_list('pk', flat=True)), refresh=refresh)
     else:
-        get_past_tweets_for_user(pk)
+        get_past_tweets_for_user(pk, refresh=refresh)
+
+
+# Gets the past tweets for the user keys across a thread pool. The rate limiter keeps all the threads within
+# the shared api budget and lock_ingest has them store their pages one at a time. Returns a dict of user key to
+# the number of tweets fetched.
+def backfill_timelines(pks, refresh=False, workers=TIMELINE_WORKERS):
+    return run_concurrently(functools.partial(get_past_tweets_for_user, refresh=refresh), pks, workers=workers,
+                            description='Refreshing timelines' if refresh else 'Timelines')
+
 
+# Daily refresh of the influencer timelines
+def refresh_timelines():
+    get_past_tweets(-1, refresh=True)
 
-# Get the past tweets from the provided user key. Used to pre-populate the db
-def get_past_tweets_for_user(pk):
+
+# Get the past tweets from the provided user key. Used to pre-populate the db. The first run pages back through
+# the whole timeline saving its place in twitter_max_id so an interrupted run picks up where it stopped. Once
+# the timeline is stored only tweets newer than twitter_since_id are requested. With refresh only the newer
+# tweets are requested even if the backfill has not finished. Returns the number of tweets.
+def get_past_tweets_for_user(pk, refresh=False):
     # Get the user to get tweets for
     user = SocialMediaUser.objects.get(pk=pk)
+    if user.twitter_user_id is None:
+        return 0
 
     print('Getting tweets for: ', user.twitter_screen_name)
 
-    elapsed_time = 1
-    for page in tweepy.Cursor(api.user_timeline, user_id=user.twitter_user_id, tweet_mode='extended').pages():
-
-        # Pause as needed for rate limiting
-        if elapsed_time < 0.6:
-            time.sleep(0.6 - elapsed_time)
+    # Users stored before the newest tweet was kept start from their newest stored post, in either mode, so a
+    # timeline that is already stored is not paged through again from the top
+    if user.twitter_since_id is None:
+        user.twitter_since_id = SocialMediaPost.objects.filter(author=user).aggregate(Max('post_id'))['post_id__max']
+
+    tweets = 0
+    newest_id = user.twitter_since_id
+
+    # Tweets newer than the newest stored. Every page down to since_id is read, the stream may have stored the
+    # newest tweets while older ones from an outage are still missing. since_id is only moved once all of them
+    # are in so a failed run does not leave a gap.
+    if user.twitter_since_id is not None:
+        for page in tweepy.Cursor(api.user_timeline, user_id=user.twitter_user_id, since_id=user.twitter_since_id,
+                                  count=TIMELINE_PAGE_SIZE, tweet_mode='extended').pages():
+            process_statuses(page, user)
+            tweets += len(page)
+            newest_id = max([newest_id] + [status.id for status in page])
+
+    # Older tweets, from the newest on the first run or from where the last run stopped
+    if not refresh and (user.twitter_since_id is None or user.twitter_max_id is not None):
+        if user.twitter_max_id is None:
+            cursor = tweepy.Cursor(api.user_timeline, user_id=user.twitter_user_id, count=TIMELINE_PAGE_SIZE,
+                                   tweet_mode='extended')
+        else:
+            cursor = tweepy.Cursor(api.user_timeline, user_id=user.twitter_user_id, max_id=user.twitter_max_id,
+                                   count=TIMELINE_PAGE_SIZE, tweet_mode='extended')
 
-        # Start timer
-        time_start = time.time()
+        for page in cursor.pages():
+            process_statuses(page, user)
+            tweets += len(page)
+            if user.twitter_since_id is None:
+                newest_id = max(status.id for status in page)
+                user.twitter_since_id = newest_id
+            user.twitter_max_id = min(status.id for status in page) - 1
+            user.save(update_fields=['twitter_since_id', 'twitter_max_id'])
 
-        for status in tqdm(page, total=len(page)):
-            # process status here
-            # Check to see if re post
-            if hasattr(status, 'retweeted_status'):
-                process_restatus(status, user)
-            else:
-                process_status(status, user)
+        # Reached the end of the timeline
+        user.twitter_max_id = None
 
-        elapsed_time = time.time() - time_start
+    user.twitter_since_id = newest_id
+    user.save(update_fields=['twitter_since_id', 'twitter_max_id'])
+    return tweets
 
 
 # Processes the re tweet and stores in db
 def process_restatus(status, user):
-    # Find the original message
-    try:
-        post = SocialMediaPost.objects.get(post_id=status.retweeted_status.id)
-        post.reposted_by.add(user)
-    except Exception as e:
-        # See if the original author is in the db
-        if SocialMediaUser.objects.filter(twitter_user_id=status.retweeted_status.author.id).exists():
-            original_user = SocialMediaUser.objects.get(twitter_user_id=status.retweeted_status.author.id)
-            new_post = process_status(status.retweeted_status, original_user)
-            new_post.reposted_by.add(user)
-        else:
-            # Need to crete the new user
-            new_user = create_user_from_twitter_user(status.retweeted_status.author)
-            new_post = process_status(status.retweeted_status, new_user)
-            new_post.reposted_by.add(user)
+    process_statuses([status], user)
 
 
 # Process the twitter status and saves to db
 def process_status(status, user):
-    # First check to see if post is already in db
-    if SocialMediaPost.objects.filter(post_id=status.id).exists():
-        return
-
-    # Datetime
-    settings.TIME_ZONE  # 'UTC'
-
-    # Created At
-    created_at = make_aware(status.created_at)
-
-    # Post ID
-    post_id = status.id
+    new_posts = process_statuses([status], user)
+    if len(new_posts) <= 0:
+        return None
+    return new_posts[0]
+
+
+# Stores a batch of tweepy statuses using a fixed number of bulk statements regardless of the batch size.
+# Re tweets store the original status and add the re tweeting user to its reposted_by. If user is provided
+# it is the author of every status in the batch (timelines), otherwise the author on each status is used
+# (stream). Returns the posts that were newly created.
+def process_statuses(statuses, user=None):
+    if len(statuses) <= 0:
+        return []
+
+    # Split the batch into the statuses to store and the re posts to record
+    originals = {}
+    reposts = []
+    twitter_users = {}
+    for status in statuses:
+        if user is None:
+            twitter_users[status.author.id] = status.author
+        if hasattr(status, 'retweeted_status'):
+            original = status.retweeted_status
+            twitter_users[original.author.id] = original.author
+            reposts.append((original.id, user.twitter_user_id if user else status.author.id))
+        else:
+            original = status
+        originals.setdefault(original.id, original)
 
-    # Reply to user id
-    in_reply_to_user_id = status.in_reply_to_user_id
+    with transaction.atomic():
+        # The api calls run in parallel but the statuses are stored one batch at a time
+        lock_ingest()
+
+        # Authors
+        users = get_or_create_user_ids_from_twitter_users(twitter_users)
+        if user is not None:
+            users[user.twitter_user_id] = user.pk
+
+        # Posts
+        posts = dict(SocialMediaPost.objects.filter(post_id__in=list(originals.keys())).values_list('post_id', 'pk'))
+        new_posts = [build_post_from_status(status, users[status.author.id]) for post_id, status in originals.items()
+                     if post_id not in posts]
+        new_posts = SocialMediaPost.objects.bulk_create(new_posts)
+        statuses_by_post = [(post, originals[post.post_id]) for post in new_posts]
+        for post in new_posts:
+            posts[post.post_id] = post.pk
+
+        # Entities are only stored for the new posts
+        process_user_mentions(statuses_by_post)
+        process_hashtags(statuses_by_post)
+        process_urls(statuses_by_post)
+
+        # Re posts
+        add_reposts({(posts[post_id], users[reposter_id]) for post_id, reposter_id in reposts})
+
+    return new_posts
+
+
+# Adds the (post pk, user pk) re posts and raises the repost_count of each post by the re posts that were not
+# already recorded, in one statement so concurrent batches never lose a count
+def add_reposts(reposts):
+    if len(reposts) <= 0:
+        return
 
-    # Reply to post id
-    in_reply_to_post_id = status.in_reply_to_status_id
+    values = ', '.join(['(%s, %s)'] * len(reposts))
+    params = [pk for repost in reposts for pk in repost]
+    with connection.cursor() as cursor:
+        cursor.execute('WITH added AS (INSERT INTO ' + SocialMediaPost.reposted_by.through._meta.db_table + ' '
+                       '(socialmediapost_id, socialmediauser_id) VALUES ' + values + ' '
+                       'ON CONFLICT DO NOTHING RETURNING socialmediapost_id) '
+                       'UPDATE ' + SocialMediaPost._meta.db_table + ' AS p SET repost_count = p.repost_count + a.count '
+                       'FROM (SELECT socialmediapost_id, COUNT(*) AS count FROM added '
+                       'GROUP BY socialmediapost_id) AS a WHERE p.id = a.socialmediapost_id', params)
 
-    # Lang
-    lang = status.lang
 
+# Builds an unsaved post from the provided tweepy status
+def build_post_from_status(status, author_id):
     # Reply Count
     if hasattr(status, 'reply_count'):
         reply_count = status.reply_count
     else:
         reply_count = 0
 
-    # Text
-    text = status.full_text
-
-    post = SocialMediaPost(
-        author=user,
-        created_at=created_at,
-        post_id=post_id,
-        in_reply_to_user_id=in_reply_to_user_id,
-        in_reply_to_post_id=in_reply_to_post_id,
-        lang=lang,
+    return SocialMediaPost(
+        author_id=author_id,
+        created_at=make_aware(status.created_at),
+        post_id=status.id,
+        in_reply_to_user_id=status.in_reply_to_user_id,
+        in_reply_to_post_id=status.in_reply_to_status_id,
+        lang=status.lang,
         reply_count=reply_count,
-        text=text,
-        service='Twitter'
+        text=get_status_text(status),
+        service='Twitter',
+        # The entities are only stored with the new post so their counts are known up front
+        mention_count=len({mention['id'] for mention in status.entities['user_mentions']}),
+        hashtag_count=len({tag['text'] for tag in status.entities['hashtags']})
     )
 
-    post.save()
 
-    # User Mentions
-    elapsed_time = 1
-    for mention in status.entities['user_mentions']:
+# Returns the full text of the status. Timelines are requested in extended mode while the stream
+# keeps the full text of long tweets under extended_tweet.
+def get_status_text(status):
+    if hasattr(status, 'full_text'):
+        return status.full_text
+    if hasattr(status, 'extended_tweet'):
+        return status.extended_tweet['full_text']
+    return status.text
+
 
-        # Pause as needed for rate limiting
-        if elapsed_time < 1:
-            time.sleep(1 - elapsed_time)
+# Adds the user mentions for a batch of (post, status) pairs. Mentioned users not in the db are created as
+# stubs from the mention itself, hydrate_stub_users fills in their profiles later.
+def process_user_mentions(statuses_by_post):
+    mentions = {}
+    for post, status in statuses_by_post:
+        for mention in status.entities['user_mentions']:
+            mentions.setdefault(mention['id'], mention)
 
-        # Start timer
-        time_start = time.time()
+    if len(mentions) <= 0:
+        return
 
-        # Check if user exists
+    users, missing = user_id_cache.get_many(mentions.keys())
+    if len(missing) > 0:
+        found = dict(SocialMediaUser.objects.filter(twitter_user_id__in=missing).values_list('twitter_user_id', 'pk'))
+        new_users = [build_user_from_mention(mentions[twitter_id]) for twitter_id in missing if twitter_id not in found]
+        for new_user in SocialMediaUser.objects.bulk_create(new_users):
+            found[new_user.twitter_user_id] = new_user.pk
+        cache_on_commit(user_id_cache, found)
+        users.update(found)
+
+    through = SocialMediaPost.user_mentions.through
+    through.objects.bulk_create([through(socialmediapost_id=post.pk, socialmediauser_id=users[mention['id']])
+                                 for post, status in statuses_by_post
+                                 for mention in status.entities['user_mentions']],
+                                ignore_conflicts=True)
+
+
+# Builds an unsaved stub user from a user mention entity
+def build_user_from_mention(mention):
+    return SocialMediaUser(name=mention.get('name'),
+                           twitter_user_id=mention['id'],
+                           twitter_screen_name=mention.get('screen_name'),
+                           is_influencer=False,
+                           is_stub=True
+                           )
+
+
+# Fills in the profiles of stub users from twitter, 100 ids per lookup. Ids the lookup leaves out count a failure
+# and are skipped once they reach USER_LOOKUP_MAX_FAILURES so dead accounts do not use up the rate limit. Returns
+# the number of users hydrated.
+def hydrate_stub_users(limit=None):
+    ids = SocialMediaUser.objects.filter(is_stub=True, twitter_user_id__isnull=False,
+                                         twitter_lookup_failures__lt=USER_LOOKUP_MAX_FAILURES) \
+        .order_by('twitter_user_id').values_list('twitter_user_id', flat=True).distinct()
+    if limit:
+        ids = ids[:limit]
+    ids = list(ids)
+
+    hydrated = 0
+    for i in range(0, len(ids), 100):
         try:
-            user_mention = SocialMediaUser.objects.get(twitter_user_id=mention['id'])
-        except:
-            # Create new user
-            user_mention = create_user_from_twitter_id(mention['id'])
+            twitter_users = api.lookup_users(user_ids=ids[i:i + 100])
+        except Exception as e:
+            print(e)
+            continue
 
-        if user_mention:
-            post.user_mentions.add(user_mention)
+        twitter_users = {x.id: x for x in twitter_users}
+        users = list(SocialMediaUser.objects.filter(is_stub=True, twitter_user_id__in=list(twitter_users.keys())))
+        for user in users:
+            update_user_from_twitter_user(user, twitter_users[user.twitter_user_id])
+        SocialMediaUser.objects.bulk_update(users, HYDRATED_USER_FIELDS)
+        hydrated += len(users)
 
-        elapsed_time = time.time() - time_start
+        # Suspended, deleted and protected accounts
+        missing = set(ids[i:i + 100]) - twitter_users.keys()
+        SocialMediaUser.objects.filter(is_stub=True, twitter_user_id__in=missing) \
+            .update(twitter_lookup_failures=F('twitter_lookup_failures') + 1)
+
+    return hydrated
 
-    # Hashtags
-    for tag in status.entities['hashtags']:
-        # See if the tag exists
-        try:
-            tag_obj = Hashtag.objects.get(text=tag['text'])
-        except:
-            # Create new user
-            tag_obj = Hashtag(text=tag['text'])
-            tag_obj.save()
-        tag_obj.posts.add(post)
-
-    # Urls
-    for url in status.entities['urls']:
-        try:
-            url_obj = Url.objects.get(expanded=url['expanded_url'])
-        except:
-            # Create new user
-            url_obj = Url(raw=url['url'], expanded=url['expanded_url'])
-            url_obj.save()
-        url_obj.posts.add(post)
 
-    return post
+# Adds the hashtags for a batch of (post, status) pairs
+def process_hashtags(statuses_by_post):
+    texts = set()
+    for post, status in statuses_by_post:
+        for tag in status.entities['hashtags']:
+            texts.add(tag['text'])
 
+    if len(texts) <= 0:
+        return
+
+    tags, missing = hashtag_id_cache.get_many(texts)
+    if len(missing) > 0:
+        Hashtag.objects.bulk_create([Hashtag(text=text) for text in missing], ignore_conflicts=True)
+        found = dict(Hashtag.objects.filter(text__in=missing).values_list('text', 'pk'))
+        cache_on_commit(hashtag_id_cache, found)
+        tags.update(found)
+
+    through = Hashtag.posts.through
+    through.objects.bulk_create([through(hashtag_id=tags[tag['text']], socialmediapost_id=post.pk)
+                                 for post, status in statuses_by_post for tag in status.entities['hashtags']],
+                                ignore_conflicts=True)
 
 
+# Adds the urls for a batch of (post, status) pairs
+def process_urls(statuses_by_post):
+    urls = {}
+    for post, status in statuses_by_post:
+        for url in status.entities['urls']:
+            if url['expanded_url']:
+                urls.setdefault(url['expanded_url'], url['url'])
+
+    if len(urls) <= 0:
+        return
+
+    url_ids, missing = url_id_cache.get_many(urls.keys())
+    if len(missing) > 0:
+        Url.objects.bulk_create([Url(raw=urls[expanded], expanded=expanded) for expanded in missing],
+                                ignore_conflicts=True)
+        found = dict(Url.objects.filter(expanded__in=missing).values_list('expanded', 'pk'))
+        cache_on_commit(url_id_cache, found)
+        url_ids.update(found)
+
+    through = Url.posts.through
+    through.objects.bulk_create([through(url_id=url_ids[url['expanded_url']], socialmediapost_id=post.pk)
+                                 for post, status in statuses_by_post for url in status.entities['urls']
+                                 if url['expanded_url'] in url_ids],
+                                ignore_conflicts=True)
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Max, Min
+
+from socialmediapost.models import SocialMediaPost, update_post_counts
+
+
+# Recomputes the repost, mention and hashtag counters of every post from the relations, a range of ids at a time
+# so each update stays short
+class Command(BaseCommand):
+    help = 'Recomputes the repost, mention and hashtag counts of the posts.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=10000, help='Post ids recomputed per update.')
+
+    def handle(self, *args, **options):
+        bounds = SocialMediaPost.objects.aggregate(first=Min('pk'), last=Max('pk'))
+        if bounds['first'] is None:
+            self.stdout.write('No posts to repair.')
+            return
+
+        repaired = 0
+        for start_pk in range(bounds['first'], bounds['last'] + 1, options['batch_size']):
+            repaired += update_post_counts(start_pk, start_pk + options['batch_size'])
+        self.stdout.write('Repaired the counts of %d posts.' % repaired)
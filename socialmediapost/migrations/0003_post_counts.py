@@ -0,0 +1,72 @@
+# Generated by Django 3.0.3 on 2020-03-07 11:30
+
+from django.db import migrations, models
+
+# Posts counted per update while filling in the counts of the existing posts
+BACKFILL_BATCH_SIZE = 10000
+
+
+# Fills in the counts of the posts stored before the counters were added, one range of ids at a time so no single
+# update has to hold every post. The sql is written out here rather than calling update_post_counts so later
+# changes to the models do not change what this migration runs.
+def backfill_post_counts(apps, schema_editor):
+    SocialMediaPost = apps.get_model('socialmediapost', 'SocialMediaPost')
+    Hashtag = apps.get_model('socialmediapost', 'Hashtag')
+    sql = ('UPDATE {posts} AS post SET repost_count = counts.reposts, mention_count = counts.mentions, '
+           'hashtag_count = counts.hashtags '
+           'FROM (SELECT post.id, '
+           '(SELECT COUNT(*) FROM {reposts} AS r WHERE r.socialmediapost_id = post.id) AS reposts, '
+           '(SELECT COUNT(*) FROM {mentions} AS m WHERE m.socialmediapost_id = post.id) AS mentions, '
+           '(SELECT COUNT(*) FROM {hashtags} AS h WHERE h.socialmediapost_id = post.id) AS hashtags '
+           'FROM {posts} AS post WHERE post.id >= %s AND post.id < %s) AS counts '
+           'WHERE post.id = counts.id AND (counts.reposts, counts.mentions, counts.hashtags) <> (0, 0, 0)').format(
+        posts=SocialMediaPost._meta.db_table,
+        reposts=SocialMediaPost._meta.get_field('reposted_by').remote_field.through._meta.db_table,
+        mentions=SocialMediaPost._meta.get_field('user_mentions').remote_field.through._meta.db_table,
+        hashtags=Hashtag._meta.get_field('posts').remote_field.through._meta.db_table)
+
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute('SELECT MIN(id), MAX(id) FROM ' + SocialMediaPost._meta.db_table)
+        first_pk, last_pk = cursor.fetchone()
+        if first_pk is None:
+            return
+        for start_pk in range(first_pk, last_pk + 1, BACKFILL_BATCH_SIZE):
+            cursor.execute(sql, [start_pk, start_pk + BACKFILL_BATCH_SIZE])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('socialmediapost', '0002_auto_20200225_1501'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='socialmediapost',
+            name='hashtag_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='socialmediapost',
+            name='mention_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='socialmediapost',
+            name='repost_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_post_counts, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='socialmediapost',
+            index=models.Index(fields=['repost_count', 'created_at', 'id'], name='socialmediapost_reposts_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='socialmediapost',
+            index=models.Index(fields=['mention_count', 'created_at', 'id'], name='socialmediapost_mentions_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='socialmediapost',
+            index=models.Index(fields=['hashtag_count', 'created_at', 'id'], name='socialmediapost_hashtags_idx'),
+        ),
+    ]
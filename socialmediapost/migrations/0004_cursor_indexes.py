@@ -0,0 +1,17 @@
+# Generated by Django 3.0.3 on 2020-03-07 15:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('socialmediapost', '0003_post_counts'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='socialmediapost',
+            index=models.Index(fields=['created_at', 'id'], name='socialmediapost_created_idx'),
+        ),
+    ]
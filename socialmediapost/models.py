@@ -1,5 +1,5 @@
 from django.contrib.postgres.fields import ArrayField, JSONField
-from django.db import models
+from django.db import connection, models
 
 from socialmediauser.models import SocialMediaUser
 
@@ -12,6 +12,14 @@ class SocialMediaPost(models.Model):
 
     class Meta:
         db_table = 'socialmediapost'
+        # Serve the list orderings, each ending in the id so the cursor pages are range scans, and the min and max
+        # filters on the counters
+        indexes = [
+            models.Index(fields=['created_at', 'id'], name='socialmediapost_created_idx'),
+            models.Index(fields=['repost_count', 'created_at', 'id'], name='socialmediapost_reposts_idx'),
+            models.Index(fields=['mention_count', 'created_at', 'id'], name='socialmediapost_mentions_idx'),
+            models.Index(fields=['hashtag_count', 'created_at', 'id'], name='socialmediapost_hashtags_idx'),
+        ]
 
     author = models.ForeignKey(SocialMediaUser, on_delete=models.CASCADE, null=True)
     created_at = models.DateTimeField(blank=True)
@@ -27,9 +35,14 @@ class SocialMediaPost(models.Model):
     text = models.TextField(blank=True)
     sentiment = models.CharField(max_length=20, null=True)
     service = models.CharField(max_length=20)
+    # Sizes of reposted_by, user_mentions and hashtag_posts kept up to date by ingest, update_post_counts
+    # recomputes them
+    repost_count = models.IntegerField(default=0)
+    mention_count = models.IntegerField(default=0)
+    hashtag_count = models.IntegerField(default=0)
 
     def get_repost_count(self):
-        return self.reposted_by.count()
+        return self.repost_count
 
 
 class Hashtag(models.Model):
@@ -47,4 +60,33 @@ class Hashtag(models.Model):
     posts = models.ManyToManyField(SocialMediaPost, blank=True, related_name='hashtag_posts')
 
 
+# Recomputes the counters of the posts with start_pk <= pk < end_pk, or of every post, from the relations. Only
+# the posts whose counters were wrong are written, returns how many there were.
+def update_post_counts(start_pk=None, end_pk=None):
+    where = []
+    params = []
+    if start_pk is not None:
+        where.append('post.id >= %s')
+        params.append(start_pk)
+    if end_pk is not None:
+        where.append('post.id < %s')
+        params.append(end_pk)
 
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'UPDATE {posts} AS post SET repost_count = counts.reposts, mention_count = counts.mentions, '
+            'hashtag_count = counts.hashtags '
+            'FROM (SELECT post.id, '
+            '(SELECT COUNT(*) FROM {reposts} AS r WHERE r.socialmediapost_id = post.id) AS reposts, '
+            '(SELECT COUNT(*) FROM {mentions} AS m WHERE m.socialmediapost_id = post.id) AS mentions, '
+            '(SELECT COUNT(*) FROM {hashtags} AS h WHERE h.socialmediapost_id = post.id) AS hashtags '
+            'FROM {posts} AS post {where}) AS counts '
+            'WHERE post.id = counts.id AND (post.repost_count, post.mention_count, post.hashtag_count) '
+            'IS DISTINCT FROM (counts.reposts, counts.mentions, counts.hashtags)'.format(
+                posts=SocialMediaPost._meta.db_table,
+                reposts=SocialMediaPost.reposted_by.through._meta.db_table,
+                mentions=SocialMediaPost.user_mentions.through._meta.db_table,
+                hashtags=Hashtag.posts.through._meta.db_table,
+                where='WHERE ' + ' AND '.join(where) if len(where) > 0 else ''),
+            params)
+        return cursor.rowcount
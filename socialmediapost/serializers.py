@@ -33,11 +33,6 @@ class SocialMediaPostFullNoRepostedUserInfoSerializer(serializers.ModelSerialize
     hashtags = HashtagSerializer(many=True, source='hashtag_posts')
     urls = UrlSerializer(many=True, source='url_posts')
 
-    def to_representation(self, instance):
-        ret = super().to_representation(instance)
-        ret['repost_count'] = instance.get_repost_count()
-        return ret
-
     class Meta:
         model = SocialMediaPost
         exclude = ['reposted_by']
@@ -58,12 +53,6 @@ class SocialMediaPostFullRepostedUserInfoHyperlinkedSerializer(serializers.Model
     hashtags = HashtagSerializer(many=True, source='hashtag_posts')
     urls = UrlSerializer(many=True, source='url_posts')
 
-    def to_representation(self, instance):
-        ret = super().to_representation(instance)
-        ret['repost_count'] = instance.get_repost_count()
-
-        return ret
-
     class Meta:
         model = SocialMediaPost
         fields = '__all__'
@@ -76,12 +65,6 @@ class SocialMediaPostFullRepostedUserInfoFullSerializer(serializers.ModelSeriali
     hashtags = HashtagSerializer(many=True, source='hashtag_posts')
     urls = UrlSerializer(many=True, source='url_posts')
 
-    def to_representation(self, instance):
-        ret = super().to_representation(instance)
-        ret['repost_count'] = instance.get_repost_count()
-
-        return ret
-
     class Meta:
         model = SocialMediaPost
         fields = '__all__'
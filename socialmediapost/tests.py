@@ -1,17 +1,34 @@
+import functools
+import tempfile
+import threading
 from datetime import datetime
+from io import StringIO
+from types import SimpleNamespace
+from unittest import mock
+
+import tweepy
 
 from django.contrib.postgres.search import SearchQuery, SearchVector
-from django.test import TestCase, Client
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection, connections
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, Client
 from django.urls import reverse
 from rest_framework import status
 from django.test.client import RequestFactory
+from django.test.utils import CaptureQueriesContext
+
+from background_services import tweet_streamer, twitter_services
+from background_services.status_batcher import StatusBatcher
+from background_services.status_log import StatusLog
 
 # initialize the APIClient app
-from socialmediapost.models import SocialMediaPost, Hashtag
+from socialmediapost.models import SocialMediaPost, Hashtag, update_post_counts
 from socialmediapost.serializers import SocialMediaPostHyperLinkListSerializer, \
     SocialMediaPostFullNoRepostedUserInfoSerializer, SocialMediaPostFullRepostedUserInfoHyperlinkedSerializer, \
     SocialMediaPostFullRepostedUserInfoFullSerializer
 from socialmediauser.models import SocialMediaUser
+from webarticles.models import Url
 
 client = Client()
 
@@ -221,6 +238,154 @@ class SocialMediaPostTest(TestCase):
         self.assertEqual(response.data, test_response)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
 
+    def test_get_posts_by_author_bbox(self):
+        self.retweeter.lat = 51.5
+        self.retweeter.lon = -0.1
+        self.retweeter.save()
+
+        # from api
+        response = client.get(reverse('socialmedia-post-list'), data={'bbox': '-1,51,1,52'})
+
+        context = {'request': RequestFactory().get('/')}
+
+        serializer = SocialMediaPostHyperLinkListSerializer([self.post_two], many=True, context=context)
+        test_response = dict(
+            records=1,
+            next_offset=-1,
+            data=serializer.data
+        )
+        self.assertEqual(response.data, test_response)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_clusters_sentiment(self):
+        cache.clear()
+        self.post_one.sentiment = 'Positive'
+        self.post_one.save()
+        self.post_two.sentiment = 'Negative'
+        self.post_two.save()
+
+        # from api
+        response = client.get(reverse('socialmedia-post-clusters'), data={'precision': 4, 'sentiment': 'true'})
+
+        test_response = dict(
+            records=1,
+            precision=4,
+            data=[dict(cell=self.author.geohash[:4], count=2, lat=10.10, lon=10.10,
+                       sentiment=dict(positive=1, neutral=0, negative=1))]
+        )
+        self.assertEqual(response.data, test_response)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_list_query_count(self):
+        for post in [self.post_one, self.post_two]:
+            post.reposted_by.add(self.author, self.retweeter)
+            post.user_mentions.add(self.author, self.retweeter)
+            self.hashtag.posts.add(post)
+            post.url_posts.add(Url.objects.create(raw='http://t.co/' + str(post.pk),
+                                                  expanded='http://example.com/' + str(post.pk)))
+        self.author.twitter_followers.add(self.retweeter)
+        update_post_counts()
+
+        def count_queries(data_type, limit):
+            with CaptureQueriesContext(connection) as queries:
+                response = client.get(reverse('socialmedia-post-list'), data={'data-type': data_type, 'limit': limit})
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            return len(queries), response.data['data']
+
+        # A full page takes as many queries as a page of one for every data type
+        for data_type in ['url', 'post', 'reposted_urls', 'full']:
+            single, data = count_queries(data_type, 1)
+            self.assertEqual(len(data), 1)
+            page, data = count_queries(data_type, 100)
+            self.assertEqual(single, page, data_type)
+            self.assertEqual(len(data), 2)
+            if data_type != 'url':
+                self.assertEqual([post['repost_count'] for post in data], [2, 2])
+                self.assertEqual([len(post['urls']) for post in data], [1, 1])
+            if data_type == 'full':
+                author = [user for user in data[0]['reposted_by'] if user['id'] == self.author.pk][0]
+                self.assertEqual(author['twitter_follower_count'], 1)
+
+    def test_retrieve_query_count(self):
+        self.post_one.user_mentions.add(self.author, self.retweeter)
+        self.hashtag.posts.add(self.post_one)
+
+        def count_queries(data):
+            with CaptureQueriesContext(connection) as queries:
+                response = client.get(reverse('socialmedia-post-detail', args=[self.post_one.pk]), data=data)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(len(response.data['data']['user_mentions']), 2)
+            return len(queries)
+
+        # Types without a plan of their own are serialized as a post and loaded like one
+        post = count_queries({'data-type': 'post'})
+        self.assertEqual(count_queries({}), post)
+        self.assertEqual(count_queries({'data-type': 'posts'}), post)
+
+    def test_order_and_filter_by_counts(self):
+        self.post_two.reposted_by.add(self.author, self.retweeter)
+        self.post_one.user_mentions.add(self.retweeter)
+        self.hashtag.posts.add(self.post_one)
+        update_post_counts()
+
+        def get_post_ids(data):
+            response = client.get(reverse('socialmedia-post-list'), data=dict(data, **{'data-type': 'post'}))
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            return [post['id'] for post in response.data['data']]
+
+        self.assertEqual(get_post_ids({'order-by': '-repost_count'}), [self.post_two.pk, self.post_one.pk])
+        self.assertEqual(get_post_ids({'order-by': 'repost_count'}), [self.post_one.pk, self.post_two.pk])
+        self.assertEqual(get_post_ids({'min-reposts': 1}), [self.post_two.pk])
+        self.assertEqual(get_post_ids({'max-reposts': 1, 'min-hashtags': 1}), [self.post_one.pk])
+        self.assertEqual(get_post_ids({'min-mentions': 2}), [])
+
+        response = client.get(reverse('socialmedia-post-list'), data={'order-by': 'text'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = client.get(reverse('socialmedia-post-list'), data={'min-reposts': 'many'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_repair_post_counts(self):
+        self.post_one.reposted_by.add(self.retweeter)
+        self.post_one.user_mentions.add(self.author, self.retweeter)
+        SocialMediaPost.objects.filter(pk=self.post_two.pk).update(hashtag_count=3)
+
+        call_command('repair_post_counts', batch_size=1, stdout=StringIO())
+        self.assertEqual(list(SocialMediaPost.objects.order_by('pk')
+                              .values_list('repost_count', 'mention_count', 'hashtag_count')),
+                         [(1, 2, 0), (0, 0, 0)])
+
+    def test_cursor_pagination(self):
+        # Posts created at the same time are told apart by id
+        post_three = SocialMediaPost.objects.create(author=self.author, created_at=self.post_one.created_at,
+                                                    post_id=3, text='Another post', service='Twitter')
+        post_three.reposted_by.add(self.author)
+        update_post_counts()
+
+        def walk(data):
+            ids = []
+            cursor = ''
+            while cursor is not None:
+                response = client.get(reverse('socialmedia-post-list'),
+                                      data=dict(data, **{'data-type': 'post', 'limit': 1, 'cursor': cursor}))
+                self.assertEqual(response.status_code, status.HTTP_200_OK)
+                self.assertEqual(response.data['records'], len(response.data['data']))
+                self.assertNotIn('total', response.data)
+                ids += [post['id'] for post in response.data['data']]
+                cursor = response.data['next_cursor']
+            return ids
+
+        self.assertEqual(walk({}), [self.post_two.pk, post_three.pk, self.post_one.pk])
+        self.assertEqual(walk({'order-by': 'created_at'}), [self.post_one.pk, post_three.pk, self.post_two.pk])
+        self.assertEqual(walk({'order-by': '-repost_count'}), [post_three.pk, self.post_two.pk, self.post_one.pk])
+
+        # The total is only counted when asked for
+        response = client.get(reverse('socialmedia-post-list'), data={'cursor': '', 'count': 'true', 'limit': 2})
+        self.assertEqual((response.data['records'], response.data['total']), (2, 3))
+        self.assertIsNotNone(response.data['next_cursor'])
+
+        response = client.get(reverse('socialmedia-post-list'), data={'cursor': 'not-a-cursor'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_get_all_from_empty_db(self):
         SocialMediaPost.objects.all().delete()
 
@@ -244,3 +409,243 @@ class SocialMediaPostTest(TestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
 
 
+# Returns the json of a tweet as the api sends it
+def get_status_json(post_id, author_id, mentions=(), hashtags=(), retweet=None):
+    json = dict(id=post_id, created_at='Sun Mar 01 10:00:00 +0000 2020', full_text='Tweet %d' % post_id, lang='en',
+                in_reply_to_user_id=None, in_reply_to_status_id=None,
+                user=dict(id=author_id, name='User %d' % author_id, screen_name='User%d' % author_id,
+                          location='Cloud City', statuses_count=1),
+                entities=dict(user_mentions=[dict(id=x, screen_name='User%d' % x) for x in mentions],
+                              hashtags=[dict(text=x) for x in hashtags], urls=[]))
+    if retweet is not None:
+        json['retweeted_status'] = retweet
+    return json
+
+
+def get_status(*args, **kwargs):
+    return tweepy.models.Status.parse(None, get_status_json(*args, **kwargs))
+
+
+# Stands in for tweepy.Cursor over a user timeline, newest first, count tweets per page
+class TimelineCursor:
+
+    def __init__(self, statuses, method, since_id=None, max_id=None, count=200, **kwargs):
+        statuses = [status for status in statuses if since_id is None or status.id > since_id]
+        statuses = [status for status in statuses if max_id is None or status.id <= max_id]
+        self.statuses = sorted(statuses, key=lambda status: -status.id)
+        self.count = count
+
+    def pages(self):
+        for i in range(0, len(self.statuses), self.count):
+            yield self.statuses[i:i + self.count]
+
+
+class TwitterIngestTest(TestCase):
+    """ Test Module for storing tweets """
+
+    def test_refresh_fills_gap_behind_stream(self):
+        user = SocialMediaUser.objects.create(name='User 1', is_influencer=True, twitter_user_id=1,
+                                              twitter_since_id=100)
+        timeline = [get_status(post_id, 1) for post_id in [101, 102, 103, 104]]
+
+        # The stream came back in time to store the newest two
+        twitter_services.process_statuses(timeline[2:], user)
+
+        cursor = functools.partial(TimelineCursor, timeline)
+        with mock.patch.object(twitter_services.tweepy, 'Cursor', cursor), \
+                mock.patch.object(twitter_services, 'TIMELINE_PAGE_SIZE', 2):
+            self.assertEqual(twitter_services.get_past_tweets_for_user(user.pk, refresh=True), 4)
+
+        user.refresh_from_db()
+        self.assertEqual(user.twitter_since_id, 104)
+        self.assertEqual(sorted(SocialMediaPost.objects.values_list('post_id', flat=True)), [101, 102, 103, 104])
+
+    def test_backfill_starts_from_stored_posts(self):
+        user = SocialMediaUser.objects.create(name='User 1', is_influencer=True, twitter_user_id=1)
+        timeline = [get_status(post_id, 1) for post_id in [101, 102, 103]]
+
+        # Stored before twitter_since_id was kept
+        twitter_services.process_statuses(timeline[:2], user)
+
+        cursor = functools.partial(TimelineCursor, timeline)
+        with mock.patch.object(twitter_services.tweepy, 'Cursor', cursor):
+            self.assertEqual(twitter_services.get_past_tweets_for_user(user.pk), 1)
+
+        user.refresh_from_db()
+        self.assertEqual((user.twitter_since_id, user.twitter_max_id), (103, None))
+
+    def test_ingest_keeps_counts(self):
+        original = get_status_json(30, 1, mentions=[5, 6, 6], hashtags=['One', 'Two', 'One'])
+        twitter_services.process_statuses([get_status(31, 2, retweet=original), get_status(32, 3, retweet=original)])
+
+        # The retweet of user 3 comes around again along with a new one
+        twitter_services.process_statuses([get_status(32, 3, retweet=original), get_status(33, 4, retweet=original),
+                                           get_status(33, 4, retweet=original)])
+
+        post = SocialMediaPost.objects.get(post_id=30)
+        self.assertEqual((post.repost_count, post.mention_count, post.hashtag_count), (3, 2, 2))
+        self.assertEqual(post.repost_count, post.reposted_by.count())
+        self.assertEqual(post.mention_count, post.user_mentions.count())
+        self.assertEqual(post.hashtag_count, post.hashtag_posts.count())
+
+        # Recomputing from the relations finds nothing to repair
+        self.assertEqual(update_post_counts(), 0)
+
+    def test_stream_dead_letter(self):
+        poison = get_status_json(11, 1)
+        del poison['entities']
+
+        with tempfile.TemporaryDirectory() as directory:
+            log = StatusLog(directory + '/log')
+            dead_letter = StatusLog(directory + '/dead_letter')
+            queued = []
+            listener = tweet_streamer.MyStreamListener(SimpleNamespace(put=queued.append), log)
+
+            # The test case holds its connection open in a transaction
+            with mock.patch.object(tweet_streamer, 'STATUS_LOG', log), \
+                    mock.patch.object(tweet_streamer, 'DEAD_LETTER_LOG', dead_letter), \
+                    mock.patch.object(tweet_streamer, 'close_old_connections'):
+                for status in [get_status(10, 1), tweepy.models.Status.parse(None, poison), get_status(12, 1)]:
+                    listener.on_status(status)
+                tweet_streamer.process_tweets(queued)
+                self.assertTrue(log.is_caught_up())
+                self.assertEqual([record['id'] for record, position in dead_letter.read((0, 0))], [11])
+
+                # The next batch is stored straight away rather than replaying the bad one again
+                queued.clear()
+                listener.on_status(get_status(13, 1))
+                tweet_streamer.process_tweets(queued)
+                self.assertTrue(log.is_caught_up())
+                self.assertEqual(len(dead_letter.read((0, 0))), 1)
+            log.close()
+            dead_letter.close()
+
+        self.assertEqual(sorted(SocialMediaPost.objects.values_list('post_id', flat=True)), [10, 12, 13])
+
+    def test_stream_logs_before_queueing(self):
+        with tempfile.TemporaryDirectory() as directory:
+            log = StatusLog(directory)
+            queued = []
+            listener = tweet_streamer.MyStreamListener(SimpleNamespace(put=queued.append), log)
+            with mock.patch.object(tweet_streamer, 'STATUS_LOG', log), \
+                    mock.patch.object(tweet_streamer, 'close_old_connections'):
+                # Received but lost from the queue, as when it is full or the process dies
+                listener.on_status(get_status(20, 1))
+                queued.clear()
+
+                # The next batch does not start at the checkpoint so the log is replayed from there
+                listener.on_status(get_status(21, 1))
+                tweet_streamer.process_tweets(queued)
+                self.assertTrue(log.is_caught_up())
+            log.close()
+
+        self.assertEqual(sorted(SocialMediaPost.objects.values_list('post_id', flat=True)), [20, 21])
+
+
+class ConcurrentIngestTest(TransactionTestCase):
+    """ Test Module for storing tweets from several threads """
+
+    # The rows are committed here so the id caches are filled, they would point other tests at flushed rows
+    def tearDown(self):
+        for cache in [twitter_services.user_id_cache, twitter_services.hashtag_id_cache,
+                      twitter_services.url_id_cache]:
+            cache.clear()
+
+    def test_no_duplicates(self):
+        barrier = threading.Barrier(4)
+
+        # Every thread sees the same author, mention and retweeted post for the first time
+        def store(reposter_id):
+            try:
+                for i in range(5):
+                    original = get_status_json(100 + i, 50 + i, mentions=[60 + i])
+                    barrier.wait(5)
+                    twitter_services.process_statuses([get_status(200 + reposter_id * 10 + i, reposter_id,
+                                                                  retweet=original)])
+            finally:
+                connections.close_all()
+
+        threads = [threading.Thread(target=store, args=(reposter_id,)) for reposter_id in range(1, 5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for i in range(5):
+            self.assertEqual(SocialMediaUser.objects.filter(twitter_user_id=50 + i).count(), 1)
+            self.assertEqual(SocialMediaUser.objects.filter(twitter_user_id=60 + i).count(), 1)
+            post = SocialMediaPost.objects.get(post_id=100 + i)
+            self.assertEqual((post.repost_count, post.reposted_by.count()), (4, 4))
+
+
+class StatusBatcherTest(SimpleTestCase):
+    """ Test Module for the status batcher """
+
+    def test_overflow(self):
+        spilled = []
+        batcher = StatusBatcher(lambda batch: None, max_size=3, high_water_mark=2, spill=spilled.append)
+
+        self.assertEqual([batcher.put(i) for i in range(5)], [True, True, True, False, False])
+        self.assertEqual(spilled, [3, 4])
+        stats = batcher.get_stats()
+        self.assertEqual((stats['received'], stats['spilled'], stats['dropped']), (3, 2, 0))
+        self.assertEqual((stats['depth'], stats['max_depth'], stats['high_water_hits']), (3, 3, 1))
+
+        # Without a spill, or when the spill fails, the status is dropped
+        for spill in [None, mock.Mock(side_effect=OSError('Disk full'))]:
+            batcher = StatusBatcher(lambda batch: None, max_size=1, spill=spill)
+            self.assertEqual([batcher.put(i) for i in range(2)], [True, False])
+            self.assertEqual((batcher.get_stats()['spilled'], batcher.get_stats()['dropped']), (0, 1))
+
+    def test_batches(self):
+        batches = []
+        batcher = StatusBatcher(batches.append, batch_size=2, batch_seconds=0.01)
+        for i in range(5):
+            batcher.put(i)
+
+        # The queued statuses are processed before the worker stops
+        batcher.start()
+        batcher.stop(5)
+        self.assertEqual(batches, [[0, 1], [2, 3], [4]])
+        stats = batcher.get_stats()
+        self.assertEqual((stats['processed'], stats['batches'], stats['depth']), (5, 3, 0))
+
+
+class StatusLogTest(SimpleTestCase):
+    """ Test Module for the status log """
+
+    def test_replay_from_checkpoint(self):
+        with tempfile.TemporaryDirectory() as directory:
+            log = StatusLog(directory, segment_bytes=1)
+            positions = [log.append({'id': i}) for i in range(4)]
+            self.assertEqual([record for record, position in log.get_backlog()], [{'id': i} for i in range(4)])
+
+            # Each record went into its own segment, the loaded ones are removed
+            log.save_checkpoint(positions[1])
+            self.assertEqual(log.get_segments(), [1, 2, 3])
+            log.close()
+
+            log = StatusLog(directory, segment_bytes=1)
+            self.assertEqual(log.checkpoint, positions[1])
+            self.assertEqual(log.get_backlog(), [({'id': 2}, positions[2]), ({'id': 3}, positions[3])])
+            self.assertEqual(log.get_backlog(max_records=1), [({'id': 2}, positions[2])])
+            self.assertFalse(log.is_caught_up())
+            log.save_checkpoint(positions[3])
+            self.assertTrue(log.is_caught_up())
+            log.close()
+
+    def test_truncates_torn_tail(self):
+        with tempfile.TemporaryDirectory() as directory:
+            log = StatusLog(directory)
+            position = log.append({'id': 1})
+            log.close()
+
+            # The process died part way through writing the next record
+            with open(log.get_segment_path(0), 'ab') as f:
+                f.write(b'\x00\x00\x00\x20{"id": ')
+
+            log = StatusLog(directory)
+            self.assertEqual(log.end_position(), position)
+            self.assertEqual(log.append({'id': 2})[0], position[0])
+            self.assertEqual([record for record, position in log.get_backlog()], [{'id': 1}, {'id': 2}])
+            log.close()
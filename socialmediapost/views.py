@@ -1,19 +1,66 @@
 from django.contrib.postgres.search import SearchQuery, SearchVector
+from django.core.cache import cache
+from django.db.models import Prefetch
 from django.shortcuts import render
 from drf_yasg import openapi
 from drf_yasg.utils import swagger_auto_schema
 from rest_framework import status, viewsets
+from rest_framework.decorators import action
 from rest_framework.views import APIView
 from rest_framework.response import Response
 
-from CMI_Service.settings import MAX_RECORDS_TO_RETURN
+from CMI_Service.pagination import get_pagination_parameters, paginate
+from CMI_Service.settings import MAX_RECORDS_TO_RETURN, CLUSTER_CACHE_SECONDS
+from socialmediauser.geo import filter_area_from_request, get_area_parameters, get_cluster_parameters, \
+    get_cluster_precision, get_clusters, get_clusters_cache_key
+from socialmediauser.models import SocialMediaUser, annotate_friend_counts
+from webarticles.models import Url
 
-from socialmediapost.models import SocialMediaPost
+from socialmediapost.models import SocialMediaPost, Hashtag
 from socialmediapost.serializers import SocialMediaPostHyperLinkListSerializer, \
     SocialMediaPostFullRepostedUserInfoFullSerializer, SocialMediaPostFullRepostedUserInfoHyperlinkedSerializer, \
     SocialMediaPostFullNoRepostedUserInfoSerializer
 
 
+# Counters the posts can be ordered by, the newest or oldest first among equal counts
+POST_ORDERINGS = ['created_at', 'repost_count', 'mention_count', 'hashtag_count']
+
+# Query parameter names of the min and max filters on each counter
+POST_COUNT_FILTERS = {'reposts': 'repost_count', 'mentions': 'mention_count', 'hashtags': 'hashtag_count'}
+
+
+# Applies the min and max query parameters of the counters. Raises ValueError if they are invalid.
+def filter_counts_from_request(posts, request):
+    for name, field in POST_COUNT_FILTERS.items():
+        for bound, lookup in [('min', 'gte'), ('max', 'lte')]:
+            value = request.GET.get(bound + '-' + name)
+            if value:
+                posts = posts.filter(**{field + '__' + lookup: int(value)})
+    return posts
+
+
+# Returns the order_by fields for the order-by query parameter. Ties are broken by created_at then id in the same
+# direction, which gives every post its own position for the cursor and matches the indexes. Raises ValueError if
+# it is invalid.
+def get_ordering_from_request(request):
+    order_by = request.GET.get('order-by') or '-created_at'
+    if order_by.lstrip('-') not in POST_ORDERINGS:
+        raise ValueError('Invalid order-by: ' + order_by)
+    direction = '-' if order_by.startswith('-') else ''
+    if order_by.lstrip('-') == 'created_at':
+        return [order_by, direction + 'id']
+    return [order_by, direction + 'created_at', direction + 'id']
+
+
+# Swagger parameters for filter_counts_from_request
+def get_count_parameters():
+    return [openapi.Parameter(bound + '-' + name, openapi.IN_QUERY,
+                              description='Only retrieve posts with at %s that many %s.' % (
+                                  'least' if bound == 'min' else 'most', name),
+                              type=openapi.TYPE_INTEGER, default='')
+            for name in POST_COUNT_FILTERS for bound in ['min', 'max']]
+
+
 class SocialMediaPostViewSet(viewsets.ViewSet):
     """
     Handles the view set for social media posts.
@@ -36,12 +83,12 @@ class SocialMediaPostViewSet(viewsets.ViewSet):
                              openapi.Parameter('author-id', openapi.IN_QUERY,
                                                description='Limits the posts returned to that of the author-id.',
                                                type=openapi.TYPE_INTEGER, default=''),
-                             openapi.Parameter('limit', openapi.IN_QUERY, description='Limits the return count.',
-                                               type=openapi.TYPE_INTEGER, default=''),
-                             openapi.Parameter('offset', openapi.IN_QUERY,
-                                               description='Offset to start at for the query.',
-                                               type=openapi.TYPE_INTEGER, default=''),
-                         ])
+                             openapi.Parameter('order-by', openapi.IN_QUERY,
+                                               description='Field to order the posts by, prefixed with - for '
+                                                           'descending.',
+                                               type=openapi.TYPE_STRING, default='-created_at',
+                                               enum=POST_ORDERINGS + ['-' + field for field in POST_ORDERINGS]),
+                         ] + get_pagination_parameters() + get_count_parameters() + get_area_parameters())
     def list(self, request):
         data_type = request.GET['data-type'] if 'data-type' in request.GET.keys() else None
         limit = int(request.GET['limit']) if 'limit' in request.GET.keys() else MAX_RECORDS_TO_RETURN
@@ -79,8 +126,21 @@ class SocialMediaPostViewSet(viewsets.ViewSet):
             else:
                 posts = SocialMediaPost.objects.all().order_by('-created_at')
 
-        total_counts = posts.count()
-        posts = posts[offset:offset + limit]
+        # Only those inside the map area of the author and within the counts
+        try:
+            posts = filter_area_from_request(posts, request, prefix='author__')
+            ordering = get_ordering_from_request(request)
+            posts = filter_counts_from_request(posts, request).order_by(*ordering)
+        except ValueError as e:
+            return Response(dict(error=str(e)), status=status.HTTP_400_BAD_REQUEST)
+
+        # The page is fetched once here and serialized from the rows
+        try:
+            posts = prepare_posts_for_data_type(posts, data_type if data_type in ['post', 'full', 'reposted_urls']
+                                                else 'url')
+            posts, page = paginate(posts, ordering, request, limit, offset)
+        except ValueError as e:
+            return Response(dict(error=str(e)), status=status.HTTP_400_BAD_REQUEST)
 
         many = True
 
@@ -96,18 +156,43 @@ class SocialMediaPostViewSet(viewsets.ViewSet):
         else:  # 'urls'
             serializer = SocialMediaPostHyperLinkListSerializer(posts, context={'request': request}, many=many)
 
-        next_offset = offset + limit
+        return Response(dict(page, data=serializer.data))
 
-        if total_counts <= next_offset:
-            next_offset = -1
-        elif posts.count == 0:
-            next_offset = -1
+    @swagger_auto_schema(operation_description="Retrieve the count of social media posts per geohash cell of "
+                                               "the author.",
+                         manual_parameters=[
+                             openapi.Parameter('author-id', openapi.IN_QUERY,
+                                               description='Only counts the posts of the author-id.',
+                                               type=openapi.TYPE_INTEGER, default=''),
+                             openapi.Parameter('sentiment', openapi.IN_QUERY,
+                                               description='If set to true will also count each sentiment per cell.',
+                                               type=openapi.TYPE_BOOLEAN, default=False),
+                         ] + get_cluster_parameters())
+    @action(detail=False, methods=['get'])
+    def clusters(self, request):
+        sentiment = request.GET.get('sentiment', '').lower() == 'true'
+
+        try:
+            precision = get_cluster_precision(request)
+            posts = SocialMediaPost.objects.all()
+            if 'author-id' in request.GET.keys():
+                posts = posts.filter(author_id__exact=int(request.GET['author-id']))
+            posts = filter_area_from_request(posts, request, prefix='author__')
+        except ValueError as e:
+            return Response(dict(error=str(e)), status=status.HTTP_400_BAD_REQUEST)
+
+        # Counted in the database once per tile and filters
+        key = get_clusters_cache_key('post', request)
+        clusters = cache.get(key)
+        if clusters is None:
+            clusters = get_clusters(posts, precision, prefix='author__', sentiment=sentiment)
+            cache.set(key, clusters, CLUSTER_CACHE_SECONDS)
 
         # Create return dict
         return_dict = dict(
-            records=posts.count(),
-            next_offset=next_offset,
-            data=serializer.data
+            records=len(clusters),
+            precision=precision,
+            data=clusters
         )
 
         return Response(return_dict)
@@ -130,9 +215,11 @@ class SocialMediaPostViewSet(viewsets.ViewSet):
     def retrieve(self, request, pk=None):
         data_type = request.GET['data-type'] if 'data-type' in request.GET.keys() else None
 
-        # Grab the user
+        # Grab the post
         try:
-            post = SocialMediaPost.objects.get(pk=pk)
+            post = prepare_posts_for_data_type(SocialMediaPost.objects.all(),
+                                               'reposted_urls' if data_type == 'friend_urls' else data_type or 'post') \
+                .get(pk=pk)
         except SocialMediaPost.DoesNotExist:
             return Response(status=status.HTTP_404_NOT_FOUND)
 
@@ -161,3 +248,25 @@ class SocialMediaPostViewSet(viewsets.ViewSet):
 
     def destroy(self, request, pk=None):
         Response({})
+
+
+# Loads only what the data type serializes. The related users, hashtags and urls are prefetched with just the
+# columns they show and the friend counts are annotated so the posts are serialized in a fixed number of queries
+# however many there are. 'url' only needs the key, any other type is loaded like 'post'.
+def prepare_posts_for_data_type(posts, data_type):
+    if data_type == 'url':
+        return posts.only('pk')
+
+    posts = posts.prefetch_related(
+        Prefetch('hashtag_posts', queryset=Hashtag.objects.only('pk', 'text')),
+        Prefetch('url_posts', queryset=Url.objects.only('pk', 'expanded')))
+    if data_type == 'full':
+        users = annotate_friend_counts(SocialMediaUser.objects.all())
+        return posts.prefetch_related(Prefetch('reposted_by', queryset=users),
+                                      Prefetch('user_mentions', queryset=users))
+
+    user_urls = SocialMediaUser.objects.only('pk')
+    posts = posts.prefetch_related(Prefetch('user_mentions', queryset=user_urls))
+    if data_type == 'reposted_urls':
+        posts = posts.prefetch_related(Prefetch('reposted_by', queryset=user_urls))
+    return posts
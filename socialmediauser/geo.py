@@ -0,0 +1,221 @@
+import math
+
+from django.db.models import Avg, Count, F, Q, Value
+from django.db.models.functions import ASin, Cos, Least, Power, Radians, Sin, Sqrt, Substr
+from drf_yasg import openapi
+
+GEOHASH_ALPHABET = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+# Length of the geohash stored for each user
+GEOHASH_PRECISION = 12
+
+# Most geohash cells used to cover a query area, more cells means a tighter cover but a longer query
+MAX_COVER_CELLS = 32
+
+EARTH_RADIUS_KM = 6371.0
+
+# Longest geohash prefix the clusters can be grouped by
+MAX_CLUSTER_PRECISION = 8
+
+# Sentiments counted per cluster
+SENTIMENTS = ['Positive', 'Neutral', 'Negative']
+
+
+# Encodes the coordinates as a geohash. Nearby points share a prefix so a prefix match on an indexed geohash column
+# finds the points in a cell.
+def encode_geohash(lat, lon, precision=GEOHASH_PRECISION):
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    chars = []
+    bits = 0
+    value = 0
+    is_lon = True
+    while len(chars) < precision:
+        coord_range, coord = (lon_range, lon) if is_lon else (lat_range, lat)
+        middle = (coord_range[0] + coord_range[1]) / 2
+        value <<= 1
+        if coord >= middle:
+            value |= 1
+            coord_range[0] = middle
+        else:
+            coord_range[1] = middle
+        is_lon = not is_lon
+
+        bits += 1
+        if bits == 5:
+            chars.append(GEOHASH_ALPHABET[value])
+            bits = 0
+            value = 0
+    return ''.join(chars)
+
+
+# Returns the (height, width) in degrees of a geohash cell
+def get_cell_size(precision):
+    lat_bits = 5 * precision // 2
+    lon_bits = 5 * precision - lat_bits
+    return 180.0 / 2 ** lat_bits, 360.0 / 2 ** lon_bits
+
+
+# Returns the geohash prefixes of the cells covering the box, using the longest prefixes that need no more than
+# max_cells cells. An empty list means the box needs no geohash filter.
+def cover_bbox(min_lat, min_lon, max_lat, max_lon, max_cells=MAX_COVER_CELLS):
+    for precision in range(GEOHASH_PRECISION, 0, -1):
+        height, width = get_cell_size(precision)
+        first_row = int((min_lat + 90) // height)
+        last_row = int((min(max_lat, 90 - height / 2) + 90) // height)
+        first_column = int((min_lon + 180) // width)
+        last_column = int((min(max_lon, 180 - width / 2) + 180) // width)
+        if (last_row - first_row + 1) * (last_column - first_column + 1) > max_cells:
+            continue
+
+        return sorted({encode_geohash(-90 + (row + 0.5) * height, -180 + (column + 0.5) * width, precision)
+                       for row in range(first_row, last_row + 1)
+                       for column in range(first_column, last_column + 1)})
+    return []
+
+
+# Returns the (min_lat, min_lon, max_lat, max_lon) box around a circle
+def get_radius_bbox(lat, lon, radius_km):
+    lat_delta = math.degrees(radius_km / EARTH_RADIUS_KM)
+    cos_lat = math.cos(math.radians(lat))
+    if lat + lat_delta >= 90 or lat - lat_delta <= -90 or cos_lat <= 0:
+        return max(lat - lat_delta, -90.0), -180.0, min(lat + lat_delta, 90.0), 180.0
+    lon_delta = min(math.degrees(radius_km / (EARTH_RADIUS_KM * cos_lat)), 180.0)
+    return lat - lat_delta, max(lon - lon_delta, -180.0), lat + lat_delta, min(lon + lon_delta, 180.0)
+
+
+# Parses a "min_lon,min_lat,max_lon,max_lat" string, raises ValueError if it is not a valid box
+def parse_bbox(value):
+    min_lon, min_lat, max_lon, max_lat = [float(x) for x in value.split(',')]
+    if not (-90 <= min_lat <= max_lat <= 90 and -180 <= min_lon <= max_lon <= 180):
+        raise ValueError('Invalid bbox: ' + value)
+    return min_lat, min_lon, max_lat, max_lon
+
+
+# Parses a "lat,lon" string and a radius in km, raises ValueError if they are not valid
+def parse_radius(near, radius):
+    lat, lon = [float(x) for x in near.split(',')]
+    radius_km = float(radius)
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180 and radius_km > 0):
+        raise ValueError('Invalid radius: ' + near + ' ' + radius)
+    return lat, lon, radius_km
+
+
+# Filters the queryset to the box using the geohash index and then the exact coordinates. prefix is the path to
+# the user from the queryset model, 'author__' for posts.
+def filter_bbox(queryset, min_lat, min_lon, max_lat, max_lon, prefix=''):
+    cells = cover_bbox(min_lat, min_lon, max_lat, max_lon)
+    if len(cells) > 0:
+        in_cells = Q()
+        for cell in cells:
+            in_cells |= Q(**{prefix + 'geohash__startswith': cell})
+        queryset = queryset.filter(in_cells)
+
+    return queryset.filter(**{prefix + 'lat__gte': min_lat, prefix + 'lat__lte': max_lat,
+                              prefix + 'lon__gte': min_lon, prefix + 'lon__lte': max_lon})
+
+
+# Filters the queryset to the circle, the box around it narrows the rows before the haversine distance is checked.
+# Rounding can take the half chord just over 1 for antipodal points, past what asin accepts, so it is capped.
+def filter_radius(queryset, lat, lon, radius_km, prefix=''):
+    queryset = filter_bbox(queryset, *get_radius_bbox(lat, lon, radius_km), prefix=prefix)
+
+    lat_field = Radians(F(prefix + 'lat'))
+    lon_field = Radians(F(prefix + 'lon'))
+    half_chord = Power(Sin((lat_field - math.radians(lat)) / 2), 2) + \
+        math.cos(math.radians(lat)) * Cos(lat_field) * Power(Sin((lon_field - math.radians(lon)) / 2), 2)
+    return queryset.annotate(distance_km=2 * EARTH_RADIUS_KM * ASin(Sqrt(Least(Value(1.0), half_chord)))) \
+        .filter(distance_km__lte=radius_km)
+
+
+# Applies the cell, bbox or near and radius-km query parameters of the request. Raises ValueError if they are
+# invalid.
+def filter_area_from_request(queryset, request, prefix=''):
+    cell = request.GET.get('cell')
+    bbox = request.GET.get('bbox')
+    near = request.GET.get('near')
+    radius = request.GET.get('radius-km')
+
+    if cell:
+        if len(cell) > GEOHASH_PRECISION or any(c not in GEOHASH_ALPHABET for c in cell):
+            raise ValueError('Invalid cell: ' + cell)
+        queryset = queryset.filter(**{prefix + 'geohash__startswith': cell})
+    if bbox:
+        queryset = filter_bbox(queryset, *parse_bbox(bbox), prefix=prefix)
+    if near or radius:
+        if not (near and radius):
+            raise ValueError('near and radius-km must be used together')
+        queryset = filter_radius(queryset, *parse_radius(near, radius), prefix=prefix)
+    return queryset
+
+
+# Swagger parameters for filter_area_from_request
+def get_area_parameters():
+    return [
+        openapi.Parameter('cell', openapi.IN_QUERY,
+                          description='Only retrieve those inside the geohash cell.',
+                          type=openapi.TYPE_STRING, default=''),
+        openapi.Parameter('bbox', openapi.IN_QUERY,
+                          description='Only retrieve those inside the box "min_lon,min_lat,max_lon,max_lat".',
+                          type=openapi.TYPE_STRING, default=''),
+        openapi.Parameter('near', openapi.IN_QUERY,
+                          description='Center "lat,lon" of the circle to retrieve, used with radius-km.',
+                          type=openapi.TYPE_STRING, default=''),
+        openapi.Parameter('radius-km', openapi.IN_QUERY,
+                          description='Radius in km of the circle around near to retrieve.',
+                          type=openapi.TYPE_NUMBER, default=''),
+    ]
+
+
+# Returns the geohash precision for the precision or zoom query parameters, zoom is the web map zoom level and is
+# mapped to the precision with cells about the size of a map tile. Raises ValueError if they are invalid.
+def get_cluster_precision(request):
+    precision = request.GET.get('precision')
+    zoom = request.GET.get('zoom')
+    if precision:
+        precision = int(precision)
+    elif zoom:
+        precision = (int(zoom) * 2 + 5) // 5
+    else:
+        precision = 3
+    if not 1 <= precision <= MAX_CLUSTER_PRECISION:
+        raise ValueError('Invalid precision: ' + str(precision))
+    return precision
+
+
+# Counts the rows of the queryset per geohash cell of the precision in the database, with the mean coordinates
+# of each cell and optionally the count of each sentiment. prefix is the path to the user from the queryset model.
+def get_clusters(queryset, precision, prefix='', sentiment=False):
+    counts = dict(count=Count('pk'), lat=Avg(prefix + 'lat'), lon=Avg(prefix + 'lon'))
+    if sentiment:
+        for name in SENTIMENTS:
+            counts[name.lower()] = Count('pk', filter=Q(sentiment=name))
+
+    cells = queryset.filter(**{prefix + 'geohash__isnull': False}) \
+        .annotate(cell=Substr(prefix + 'geohash', 1, precision)) \
+        .order_by('cell').values('cell').annotate(**counts)
+
+    clusters = []
+    for cell in cells:
+        cluster = dict(cell=cell['cell'], count=cell['count'], lat=cell['lat'], lon=cell['lon'])
+        if sentiment:
+            cluster['sentiment'] = {name.lower(): cell[name.lower()] for name in SENTIMENTS}
+        clusters.append(cluster)
+    return clusters
+
+
+# Cache key for the clusters of the request, the same tile and filters always share a key
+def get_clusters_cache_key(name, request):
+    return 'clusters:' + name + ':' + '&'.join(key + '=' + request.GET[key] for key in sorted(request.GET.keys()))
+
+
+# Swagger parameters for the cluster endpoints
+def get_cluster_parameters():
+    return [
+        openapi.Parameter('precision', openapi.IN_QUERY,
+                          description='Length of the geohash cells to group by, from 1 to 8.',
+                          type=openapi.TYPE_INTEGER, default=3),
+        openapi.Parameter('zoom', openapi.IN_QUERY,
+                          description='Map zoom level to pick the precision for when precision is not set.',
+                          type=openapi.TYPE_INTEGER, default=''),
+    ] + get_area_parameters()
@@ -0,0 +1,18 @@
+# Generated by Django 3.0.3 on 2020-03-02 10:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('socialmediauser', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='socialmediauser',
+            name='is_stub',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 3.0.3 on 2020-03-03 09:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('socialmediauser', '0002_socialmediauser_is_stub'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='socialmediauser',
+            name='twitter_max_id',
+            field=models.BigIntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='socialmediauser',
+            name='twitter_since_id',
+            field=models.BigIntegerField(null=True),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 3.0.3 on 2020-03-03 10:12
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('socialmediauser', '0003_auto_20200303_0915'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TwitterCrawlState',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('crawl', models.CharField(choices=[('followers', 'Followers')], max_length=20)),
+                ('next_cursor', models.BigIntegerField(default=-1)),
+                ('pages', models.IntegerField(default=0)),
+                ('started_at', models.DateTimeField(null=True)),
+                ('completed_at', models.DateTimeField(null=True)),
+                ('last_error', models.TextField(null=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='crawl_states', to='socialmediauser.SocialMediaUser')),
+            ],
+            options={
+                'db_table': 'twittercrawlstate',
+                'unique_together': {('user', 'crawl')},
+            },
+        ),
+    ]
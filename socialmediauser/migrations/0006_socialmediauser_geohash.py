@@ -0,0 +1,64 @@
+# Generated by Django 3.0.3 on 2020-03-05 11:02
+
+from django.db import migrations, models
+
+GEOHASH_ALPHABET = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+GEOHASH_BATCH_SIZE = 5000
+
+
+# Copy of socialmediauser.geo.encode_geohash as it was when this migration was written
+def encode_geohash(lat, lon, precision=12):
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    chars = []
+    bits = 0
+    value = 0
+    is_lon = True
+    while len(chars) < precision:
+        coord_range, coord = (lon_range, lon) if is_lon else (lat_range, lat)
+        middle = (coord_range[0] + coord_range[1]) / 2
+        value <<= 1
+        if coord >= middle:
+            value |= 1
+            coord_range[0] = middle
+        else:
+            coord_range[1] = middle
+        is_lon = not is_lon
+
+        bits += 1
+        if bits == 5:
+            chars.append(GEOHASH_ALPHABET[value])
+            bits = 0
+            value = 0
+    return ''.join(chars)
+
+
+# Writes the geohashes GEOHASH_BATCH_SIZE users at a time so the users are never all held in memory
+def set_geohashes(apps, schema_editor):
+    SocialMediaUser = apps.get_model('socialmediauser', 'SocialMediaUser')
+    users = []
+    for user in SocialMediaUser.objects.filter(lat__isnull=False, lon__isnull=False).only('lat', 'lon') \
+            .iterator(chunk_size=GEOHASH_BATCH_SIZE):
+        user.geohash = encode_geohash(user.lat, user.lon)
+        users.append(user)
+        if len(users) >= GEOHASH_BATCH_SIZE:
+            SocialMediaUser.objects.bulk_update(users, ['geohash'])
+            users = []
+    SocialMediaUser.objects.bulk_update(users, ['geohash'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('socialmediauser', '0005_geocodecache'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='socialmediauser',
+            name='geohash',
+            field=models.CharField(db_index=True, max_length=12, null=True),
+        ),
+        migrations.RunPython(set_geohashes, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.0.3 on 2020-03-08 10:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('socialmediauser', '0006_socialmediauser_geohash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='socialmediauser',
+            name='twitter_lookup_failures',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+    ]
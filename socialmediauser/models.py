@@ -1,5 +1,9 @@
 from django.contrib.postgres.fields import ArrayField, JSONField
 from django.db import models
+from django.db.models import Count, IntegerField, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+from socialmediauser.geo import encode_geohash
 
 
 class SocialMediaCountry(models.Model):
@@ -39,10 +43,84 @@ class SocialMediaUser(models.Model):
     twitter_posts_count = models.IntegerField(null=True)
     network_graph = JSONField(null=True)
     country = models.ForeignKey(SocialMediaCountry, on_delete=models.DO_NOTHING, null=True)
+    # True while the user only has the id and names from a mention, the profile is filled in later
+    is_stub = models.BooleanField(default=False)
+    # Lookups that left the stub out, suspended, deleted and protected accounts, it is given up on after a few
+    twitter_lookup_failures = models.PositiveSmallIntegerField(default=0)
+    # Newest tweet stored from the timeline, only newer tweets are requested on the next run
+    twitter_since_id = models.BigIntegerField(null=True)
+    # Where an unfinished timeline backfill resumes from, null once the whole timeline has been stored
+    twitter_max_id = models.BigIntegerField(null=True)
+    # Geohash of lat and lon kept up to date on save, its index serves the bbox and radius queries
+    geohash = models.CharField(max_length=12, null=True, db_index=True)
+
+    def save(self, *args, **kwargs):
+        if self.lat is not None and self.lon is not None:
+            self.geohash = encode_geohash(self.lat, self.lon)
+        else:
+            self.geohash = None
+        super().save(*args, **kwargs)
 
+    # Both counts come from annotate_friend_counts when the user was loaded with it
     def get_follower_count(self):
+        if hasattr(self, 'twitter_follower_count'):
+            return self.twitter_follower_count
         return self.twitter_followers.count()
 
     def get_follows_count(self):
+        if hasattr(self, 'twitter_follows_count'):
+            return self.twitter_follows_count
         return self.twitter_follows.count()
 
+
+# Annotates twitter_follower_count and twitter_follows_count on the users. Each is counted by a subquery on the
+# through table rather than a join so the two relations do not multiply each other, and only for the rows fetched.
+def annotate_friend_counts(queryset):
+    counts = {}
+    for name, relation in [('twitter_follower_count', SocialMediaUser.twitter_followers),
+                           ('twitter_follows_count', SocialMediaUser.twitter_follows)]:
+        count = relation.through.objects.filter(from_socialmediauser=OuterRef('pk')) \
+            .order_by().values('from_socialmediauser').annotate(count=Count('pk')).values('count')
+        counts[name] = Coalesce(Subquery(count, output_field=IntegerField()), 0)
+    return queryset.annotate(**counts)
+
+
+class TwitterCrawlState(models.Model):
+    """
+    Twitter Crawl State
+    Where a paged twitter crawl for a user resumes from
+    """
+
+    class Meta:
+        db_table = 'twittercrawlstate'
+        unique_together = ('user', 'crawl')
+
+    FOLLOWERS = 'followers'
+    CRAWL_CHOICES = [(FOLLOWERS, 'Followers')]
+
+    user = models.ForeignKey(SocialMediaUser, on_delete=models.CASCADE, related_name='crawl_states')
+    crawl = models.CharField(max_length=20, choices=CRAWL_CHOICES)
+    # Cursor of the next page to request, -1 is the first page and 0 means the pass is finished
+    next_cursor = models.BigIntegerField(default=-1)
+    pages = models.IntegerField(default=0)
+    started_at = models.DateTimeField(null=True)
+    completed_at = models.DateTimeField(null=True)
+    last_error = models.TextField(null=True)
+
+
+class GeocodeCache(models.Model):
+    """
+    Geocode Cache
+    Coordinates found for a normalized location string
+    """
+
+    class Meta:
+        db_table = 'geocodecache'
+
+    key = models.TextField(unique=True)
+    location = models.TextField()
+    # Both null when the location could not be geocoded, those are looked up again once they expire
+    lat = models.FloatField(null=True)
+    lon = models.FloatField(null=True)
+    provider = models.CharField(max_length=20, null=True)
+    updated_at = models.DateTimeField()
@@ -3,6 +3,9 @@ from rest_framework import serializers
 
 from socialmediauser.models import SocialMediaUser
 
+# Kept for the twitter ingest and the map queries, not returned by the api
+INGEST_FIELDS = ['is_stub', 'twitter_lookup_failures', 'twitter_since_id', 'twitter_max_id', 'geohash']
+
 
 class SocialMediaUserFullFriendsHyperLinkedSerializer(serializers.ModelSerializer):
     twitter_followers = serializers.HyperlinkedRelatedField(
@@ -25,7 +28,7 @@ class SocialMediaUserFullFriendsHyperLinkedSerializer(serializers.ModelSerialize
 
     class Meta:
         model = SocialMediaUser
-        fields = '__all__'
+        exclude = INGEST_FIELDS
 
 
 # Serializes full user info with no follower or follows data 'user'
@@ -40,7 +43,7 @@ class SocialMediaUserFullNoFriendsSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = SocialMediaUser
-        exclude = ['twitter_followers', 'twitter_follows']
+        exclude = ['twitter_followers', 'twitter_follows'] + INGEST_FIELDS
 
 
 # Serializes full user info with full follower and follows user info 'full'
@@ -57,7 +60,7 @@ class SocialMediaUserFullFriendsSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = SocialMediaUser
-        fields = '__all__'
+        exclude = INGEST_FIELDS
 
 
 # Serializes urls for users 'urls'
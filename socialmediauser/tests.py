@@ -1,12 +1,27 @@
+import functools
+import os
+import tempfile
+import threading
 from datetime import datetime
+from types import SimpleNamespace
+from unittest import mock
+
+import tweepy
 
 from django.contrib.postgres.search import SearchQuery, SearchVector
-from django.test import TestCase, Client
+from django.core.cache import cache
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, Client
 from django.urls import reverse
 from rest_framework import status
 from django.test.client import RequestFactory
+from django.test.utils import CaptureQueriesContext
 
-from socialmediauser.models import SocialMediaUser
+from background_services import location_finder, twitter_services
+from background_services.id_cache import IdCache
+from background_services.rate_limiter import RateLimiter, RateLimitedAPI
+from socialmediauser.geo import cover_bbox, encode_geohash
+from socialmediauser.models import SocialMediaUser, TwitterCrawlState
 
 # initialize the APIClient app
 from socialmediauser.serializers import SocialMediaUserHyperLinkListSerializer, \
@@ -201,9 +216,53 @@ class SocialMediaUserTest(TestCase):
         self.assertEqual(response.data, test_response)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
 
+    def test_friend_counts_query_count(self):
+        self.one.twitter_followers.add(self.two, self.three)
+        self.two.twitter_follows.add(self.one)
+        self.six.twitter_followers.add(self.four, self.five, self.one)
+        self.six.twitter_follows.add(self.one)
+
+        def count_queries(data_type, limit):
+            with CaptureQueriesContext(connection) as queries:
+                response = client.get(reverse('socialmedia-user-list'), data={'data-type': data_type, 'limit': limit})
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            return len(queries), {user['id']: user for user in response.data['data']}
+
+        # A full page takes as many queries as a page of one
+        for data_type in ['user', 'full', 'friend_urls']:
+            single, data = count_queries(data_type, 1)
+            self.assertEqual(len(data), 1)
+            page, data = count_queries(data_type, 100)
+            self.assertEqual(single, page)
+            self.assertEqual((data[self.one.pk]['twitter_follower_count'], data[self.one.pk]['twitter_follows_count']),
+                             (2, 0))
+            self.assertEqual((data[self.six.pk]['twitter_follower_count'], data[self.six.pk]['twitter_follows_count']),
+                             (3, 1))
+
+        # Retrieve uses the annotated counts too
+        with CaptureQueriesContext(connection) as queries:
+            response = client.get(reverse('socialmedia-user-detail', args=[self.one.pk]))
+        self.assertEqual(response.data['data']['twitter_follower_count'], 2)
+        self.assertEqual(len(queries), 1)
+
+    def test_cursor_pagination(self):
+        users = [self.one, self.two, self.three, self.four, self.five, self.six]
+
+        response = client.get(reverse('socialmedia-user-list'), data={'data-type': 'user', 'cursor': '', 'limit': 4})
+        self.assertEqual([user['id'] for user in response.data['data']], [user.pk for user in users[:4]])
+        self.assertEqual(response.data['records'], 4)
+
+        response = client.get(reverse('socialmedia-user-list'),
+                              data={'data-type': 'user', 'cursor': response.data['next_cursor'], 'limit': 4,
+                                    'count': 'true'})
+        self.assertEqual([user['id'] for user in response.data['data']], [user.pk for user in users[4:]])
+        self.assertEqual((response.data['records'], response.data['total'], response.data['next_cursor']),
+                         (2, 6, None))
+
     def test_get_user_invalid(self):
-        # from api
-        response = client.get(reverse('socialmedia-user-detail', kwargs={'pk': 99}),
+        # from api, ids keep counting up across tests so ask for one past the last
+        missing_pk = SocialMediaUser.objects.order_by('-pk').first().pk + 1
+        response = client.get(reverse('socialmedia-user-detail', kwargs={'pk': missing_pk}),
                               data={'data-type': 'user'})
         self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
 
@@ -250,4 +309,290 @@ class SocialMediaUserTest(TestCase):
             data=serializer.data
         )
         self.assertEqual(response.data, test_response)
-        self.assertEqual(response.status_code, status.HTTP_200_OK)
\ No newline at end of file
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_bbox(self):
+        self.six.lat = 51.5
+        self.six.lon = -0.1
+        self.six.save()
+
+        # from api
+        response = client.get(reverse('socialmedia-user-list'), data={'bbox': '-1,51,1,52'})
+
+        # Serializer
+        context = {'request': RequestFactory().get('/')}
+        serializer = SocialMediaUserHyperLinkListSerializer([self.six], many=True, context=context)
+
+        test_response = dict(
+            records=1,
+            next_offset=-1,
+            data=serializer.data
+        )
+        self.assertEqual(response.data, test_response)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_radius(self):
+        self.six.lat = 10.5
+        self.six.lon = 10.10
+        self.six.save()
+
+        # 10.10 to 10.5 is about 44km
+        response = client.get(reverse('socialmedia-user-list'), data={'near': '10.5,10.1', 'radius-km': 40})
+        self.assertEqual(response.data['records'], 1)
+
+        response = client.get(reverse('socialmedia-user-list'), data={'near': '10.5,10.1', 'radius-km': 50})
+        self.assertEqual(response.data['records'], 6)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_radius_antipodal(self):
+        self.six.lat = -88.17
+        self.six.lon = -176.7
+        self.six.save()
+
+        # Nearly opposite sides of the earth, the half chord rounds to just over 1 before it is capped
+        response = client.get(reverse('socialmedia-user-list'),
+                              data={'near': '88.17,3.3', 'radius-km': 20100, 'data-type': 'user'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn(self.six.pk, [user['id'] for user in response.data['data']])
+
+    def test_invalid_area(self):
+        response = client.get(reverse('socialmedia-user-list'), data={'bbox': '1,52,-1,51'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        response = client.get(reverse('socialmedia-user-list'), data={'near': '10.5,10.1'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_geohash(self):
+        self.assertEqual(self.one.geohash, encode_geohash(10.10, 10.10))
+        self.assertEqual(encode_geohash(57.64911, 10.40744, 11), 'u4pruydqqvj')
+        self.assertEqual(cover_bbox(57.6, 10.4, 57.64, 10.5, max_cells=1), ['u4pr'])
+
+    def test_clusters(self):
+        cache.clear()
+        self.six.lat = 51.5
+        self.six.lon = -0.1
+        self.six.save()
+
+        # from api
+        response = client.get(reverse('socialmedia-user-clusters'), data={'precision': 2})
+
+        test_response = dict(
+            records=2,
+            precision=2,
+            data=[
+                dict(cell=encode_geohash(51.5, -0.1, 2), count=1, lat=51.5, lon=-0.1),
+                dict(cell=encode_geohash(10.10, 10.10, 2), count=5, lat=10.10, lon=10.10),
+            ]
+        )
+        self.assertEqual(response.data, test_response)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        # Influencers only within a cell
+        response = client.get(reverse('socialmedia-user-clusters'),
+                              data={'zoom': 12, 'influencers-only': 'true', 'cell': self.one.geohash[:3]})
+        self.assertEqual(response.data['precision'], 5)
+        self.assertEqual([cluster['count'] for cluster in response.data['data']], [2])
+
+        response = client.get(reverse('socialmedia-user-clusters'), data={'precision': 9})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_ingest_fields_not_returned(self):
+        for data_type in ['user', 'full', 'friend_urls']:
+            response = client.get(reverse('socialmedia-user-detail', args=[self.one.pk]), data={'data-type': data_type})
+            self.assertEqual(response.data['data']['name'], 'Test One')
+            for field in ['is_stub', 'twitter_lookup_failures', 'twitter_since_id', 'twitter_max_id', 'geohash']:
+                self.assertNotIn(field, response.data['data'])
+
+    def test_hydrate_stub_users(self):
+        found = SocialMediaUser.objects.create(twitter_user_id=100, is_influencer=False, is_stub=True)
+        dead = SocialMediaUser.objects.create(twitter_user_id=101, is_influencer=False, is_stub=True)
+        lookup_users = mock.Mock(return_value=[SimpleNamespace(id=100, name='Found', screen_name='Found',
+                                                               location='Leeds', statuses_count=5)])
+
+        with mock.patch.object(twitter_services, 'api', mock.Mock(lookup_users=lookup_users)):
+            self.assertEqual(twitter_services.hydrate_stub_users(limit=100), 1)
+            found.refresh_from_db()
+            self.assertEqual((found.is_stub, found.twitter_screen_name), (False, 'Found'))
+
+            # The account the lookup leaves out is only asked for until it reaches the most failures
+            for i in range(twitter_services.USER_LOOKUP_MAX_FAILURES + 1):
+                twitter_services.hydrate_stub_users(limit=100)
+            self.assertEqual(lookup_users.call_count, twitter_services.USER_LOOKUP_MAX_FAILURES)
+
+        dead.refresh_from_db()
+        self.assertEqual((dead.is_stub, dead.twitter_lookup_failures),
+                         (True, twitter_services.USER_LOOKUP_MAX_FAILURES))
+
+    def test_no_geocode_only_when_every_provider_answered(self):
+        not_found = location_finder.GeocodeProvider('not_found', lambda location, session: (
+            location_finder.NO_GEOCODE, location_finder.NO_GEOCODE), 100)
+        error = location_finder.GeocodeProvider('error', lambda location, session: (None, None), 100)
+
+        with mock.patch.object(location_finder, 'GEOCODE_PROVIDERS', [not_found, error]):
+            self.assertEqual(location_finder.lookup_coords('Nowhere'), (None, None, None))
+        with mock.patch.object(location_finder, 'GEOCODE_PROVIDERS', [not_found, not_found]):
+            self.assertEqual(location_finder.lookup_coords('Nowhere'),
+                             (location_finder.NO_GEOCODE, location_finder.NO_GEOCODE, None))
+
+
+# Stands in for api.followers_ids, serving the follower ids newest first a page at a time. The cursor of a page
+# is its index plus one, the request for the page at fail_at raises once.
+class FollowerPages:
+
+    def __init__(self, follower_ids, fail_at=None):
+        self.follower_ids = follower_ids
+        self.fail_at = fail_at
+        self.cursors = []
+
+    def followers_ids(self, user_id, cursor, count):
+        self.cursors.append(cursor)
+        index = 0 if cursor == -1 else cursor - 1
+        if index == self.fail_at:
+            self.fail_at = None
+            raise tweepy.error.TweepError('Over capacity')
+        ids = self.follower_ids[index * count:(index + 1) * count]
+        next_cursor = index + 2 if (index + 1) * count < len(self.follower_ids) else 0
+        return ids, (index, next_cursor)
+
+
+class FollowerCrawlTest(TransactionTestCase):
+    """ Test Module for crawling the followers of an influencer """
+
+    def setUp(self):
+        self.influencer = SocialMediaUser.objects.create(name='Influencer', is_influencer=True, twitter_user_id=1)
+
+    # The stub users are committed here so the id cache is filled, it would point other tests at flushed rows
+    def tearDown(self):
+        twitter_services.user_id_cache.clear()
+
+    def crawl(self, pages):
+        with mock.patch.object(twitter_services, 'api', pages), \
+                mock.patch.object(twitter_services, 'FOLLOWER_PAGE_SIZE', 3):
+            return twitter_services.crawl_twitter_followers(self.influencer.pk)
+
+    def get_state(self):
+        return TwitterCrawlState.objects.get(user=self.influencer, crawl=TwitterCrawlState.FOLLOWERS)
+
+    def test_resume_and_refresh(self):
+        follower_ids = list(range(1009, 1000, -1))
+
+        # The crawl stops on the second page and keeps its cursor
+        self.assertEqual(self.crawl(FollowerPages(follower_ids, fail_at=1)), 3)
+        state = self.get_state()
+        self.assertEqual((state.next_cursor, state.pages, state.completed_at), (2, 1, None))
+        self.assertEqual(state.last_error, 'Over capacity')
+
+        # The next run picks up from the saved cursor and finishes the pass
+        pages = FollowerPages(follower_ids)
+        self.assertEqual(self.crawl(pages), 6)
+        self.assertEqual(pages.cursors, [2, 3])
+        state = self.get_state()
+        self.assertEqual((state.next_cursor, state.pages, state.last_error), (0, 3, None))
+        self.assertIsNotNone(state.completed_at)
+        self.assertEqual(sorted(self.influencer.twitter_followers.values_list('twitter_user_id', flat=True)),
+                         sorted(follower_ids))
+        self.assertEqual(SocialMediaUser.objects.filter(is_stub=True).count(), 9)
+
+        # A refresh stops at the first page with no new followers
+        completed_at = state.completed_at
+        pages = FollowerPages([1011, 1010] + follower_ids)
+        self.assertEqual(self.crawl(pages), 2)
+        self.assertEqual(pages.cursors, [-1, 2])
+        state = self.get_state()
+        self.assertEqual(state.next_cursor, 0)
+        self.assertGreater(state.completed_at, completed_at)
+        self.assertEqual(self.influencer.twitter_followers.count(), 11)
+        self.assertEqual(SocialMediaUser.objects.filter(is_stub=True).count(), 11)
+
+
+# Stands in for tweepy.API, which keeps the response of the last call on the api object
+class LastResponseAPI:
+
+    def __init__(self, barrier):
+        self.barrier = barrier
+
+    # Waits for the other threads to make their calls before returning
+    def call(self, remaining):
+        self.last_response = SimpleNamespace(headers={'x-rate-limit-limit': '900',
+                                                      'x-rate-limit-remaining': str(remaining)})
+        self.barrier.wait(5)
+        return remaining
+
+    @property
+    def user_timeline(self):
+        return functools.partial(self.call, 100)
+
+    @property
+    def followers_ids(self):
+        return functools.partial(self.call, 5)
+
+
+class RateLimitedAPITest(SimpleTestCase):
+    """ Test Module for the rate limited api """
+
+    def test_threads_update_from_own_response(self):
+        limiter = RateLimiter()
+        api = RateLimitedAPI(LastResponseAPI(threading.Barrier(2)), limiter)
+
+        threads = [threading.Thread(target=api.user_timeline), threading.Thread(target=api.followers_ids)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(limiter.get_stats(), {'statuses/user_timeline': 100, 'followers/ids': 5})
+
+
+class GazetteerTest(SimpleTestCase):
+    """ Test Module for the gazetteer """
+
+    def test_lookup(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'gazetteer.tsv')
+            location_finder.Gazetteer.write(path, [('Kyiv', 50.45, 30.52, ['Kiev', 'Kyïv, Ukraine']),
+                                                  ('Georgia', 42.0, 43.5, []),
+                                                  ('Georgia, US', 32.7, -83.4, ['Georgia']),
+                                                  ('Aarhus', 56.16, 10.2, []),
+                                                  ('Zurich', 47.37, 8.54, ['Zürich'])])
+            gazetteer = location_finder.Gazetteer(path)
+
+            self.assertEqual(gazetteer.lookup('kyiv ukraine'), (50.45, 30.52))
+            self.assertEqual(gazetteer.lookup('kiev'), (50.45, 30.52))
+            # The first place listed keeps a shared name
+            self.assertEqual(gazetteer.lookup('georgia'), (42.0, 43.5))
+            self.assertEqual(gazetteer.lookup('georgia us'), (32.7, -83.4))
+            # Keys before the first line, after the last and between two lines
+            for key in ['a', 'zzz', 'kyiv u', 'georgia u']:
+                self.assertIsNone(gazetteer.lookup(key))
+            gazetteer.map.close()
+
+    def test_bundled_keys_found(self):
+        with open(location_finder.GAZETTEER_PATH, encoding='utf-8') as f:
+            lines = [line.rstrip('\n').split('\t') for line in f]
+        gazetteer = location_finder.Gazetteer(location_finder.GAZETTEER_PATH)
+        for key, lat, lon, name in lines:
+            self.assertEqual(gazetteer.lookup(key), (float(lat), float(lon)), key)
+        gazetteer.map.close()
+
+
+class IdCacheTest(SimpleTestCase):
+    """ Test Module for the id cache """
+
+    def test_least_recently_used_evicted(self):
+        cache = IdCache('users', 3)
+        cache.set_many({1: 10, 2: 20, 3: 30})
+
+        # Reading a key makes it the most recently used
+        self.assertEqual(cache.get(1), 10)
+        cache.set(4, 40)
+        self.assertEqual(cache.get_many([1, 2, 3, 4]), ({1: 10, 3: 30, 4: 40}, [2]))
+
+        # Setting an existing key also moves it up
+        cache.set(3, 31)
+        cache.set_many({5: 50, 6: 60})
+        self.assertEqual(cache.get_many([1, 3, 4, 5, 6]), ({3: 31, 5: 50, 6: 60}, [1, 4]))
+        self.assertEqual(len(cache), 3)
+        self.assertEqual(cache.get_stats(), dict(size=3, hits=7, misses=3, hit_rate=0.7))
+
+        cache.clear()
+        self.assertIsNone(cache.get(3))
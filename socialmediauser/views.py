@@ -1,13 +1,19 @@
 from django.contrib.postgres.search import SearchQuery, SearchVector
+from django.core.cache import cache
+from django.db.models import Prefetch
 from django.shortcuts import render
 from drf_yasg import openapi
 from drf_yasg.utils import swagger_auto_schema
 from rest_framework import status, viewsets
+from rest_framework.decorators import action
 from rest_framework.views import APIView
 from rest_framework.response import Response
 
-from CMI_Service.settings import MAX_RECORDS_TO_RETURN
-from socialmediauser.models import SocialMediaUser
+from CMI_Service.pagination import get_pagination_parameters, paginate
+from CMI_Service.settings import MAX_RECORDS_TO_RETURN, CLUSTER_CACHE_SECONDS
+from socialmediauser.geo import filter_area_from_request, get_area_parameters, get_cluster_parameters, \
+    get_cluster_precision, get_clusters, get_clusters_cache_key
+from socialmediauser.models import SocialMediaUser, annotate_friend_counts
 from socialmediauser.serializers import SocialMediaUserHyperLinkListSerializer, SocialMediaUserFullFriendsSerializer, \
     SocialMediaUserFullFriendsHyperLinkedSerializer, SocialMediaUserFullNoFriendsSerializer
 
@@ -39,12 +45,7 @@ class SocialMediaUserViewSet(viewsets.ViewSet):
                              openapi.Parameter('search', openapi.IN_QUERY,
                                                description='Searches for a user that contains the string.',
                                                type=openapi.TYPE_STRING, default=''),
-                             openapi.Parameter('limit', openapi.IN_QUERY, description='Limits the return count.',
-                                               type=openapi.TYPE_INTEGER, default=''),
-                             openapi.Parameter('offset', openapi.IN_QUERY,
-                                               description='Offset to start at for the query.',
-                                               type=openapi.TYPE_INTEGER, default=''),
-                         ])
+                         ] + get_pagination_parameters() + get_area_parameters())
     def list(self, request):
         data_type = request.GET['data-type'] if 'data-type' in request.GET.keys() else None
         influencers_only = request.GET['influencers-only'] if 'influencers-only' in request.GET.keys() else None
@@ -113,8 +114,17 @@ class SocialMediaUserViewSet(viewsets.ViewSet):
             else:
                 users = SocialMediaUser.objects.all()
 
-        total_counts = users.count()
-        users = users[offset:offset + limit]
+        # Only those inside the map area
+        try:
+            users = filter_area_from_request(users, request)
+        except ValueError as e:
+            return Response(dict(error=str(e)), status=status.HTTP_400_BAD_REQUEST)
+
+        # The page is fetched once here and serialized from the rows
+        try:
+            users, page = paginate(prepare_users_for_data_type(users, data_type), ['id'], request, limit, offset)
+        except ValueError as e:
+            return Response(dict(error=str(e)), status=status.HTTP_400_BAD_REQUEST)
 
         many = True
 
@@ -128,18 +138,39 @@ class SocialMediaUserViewSet(viewsets.ViewSet):
         else:
             serializer = SocialMediaUserHyperLinkListSerializer(users, context={'request': request}, many=many)
 
-        next_offset = offset + limit
+        return Response(dict(page, data=serializer.data))
+
+    @swagger_auto_schema(operation_description="Retrieve the count of social media users per geohash cell.",
+                         manual_parameters=[
+                             openapi.Parameter('influencers-only', openapi.IN_QUERY,
+                                               description='If set to true will only count influencers.',
+                                               type=openapi.TYPE_BOOLEAN, default=False),
+                         ] + get_cluster_parameters())
+    @action(detail=False, methods=['get'])
+    def clusters(self, request):
+        influencers_only = request.GET.get('influencers-only', '').lower() == 'true'
 
-        if total_counts <= next_offset:
-            next_offset = -1
-        elif users.count == 0:
-            next_offset = -1
+        try:
+            precision = get_cluster_precision(request)
+            users = SocialMediaUser.objects.all()
+            if influencers_only:
+                users = users.filter(is_influencer=True)
+            users = filter_area_from_request(users, request)
+        except ValueError as e:
+            return Response(dict(error=str(e)), status=status.HTTP_400_BAD_REQUEST)
+
+        # Counted in the database once per tile and filters
+        key = get_clusters_cache_key('user', request)
+        clusters = cache.get(key)
+        if clusters is None:
+            clusters = get_clusters(users, precision)
+            cache.set(key, clusters, CLUSTER_CACHE_SECONDS)
 
         # Create return dict
         return_dict = dict(
-            records=users.count(),
-            next_offset=next_offset,
-            data=serializer.data
+            records=len(clusters),
+            precision=precision,
+            data=clusters
         )
 
         return Response(return_dict)
@@ -164,7 +195,7 @@ class SocialMediaUserViewSet(viewsets.ViewSet):
 
         # Grab the user
         try:
-            user = SocialMediaUser.objects.get(pk=pk)
+            user = prepare_users_for_data_type(SocialMediaUser.objects.all(), data_type or 'user').get(pk=pk)
         except SocialMediaUser.DoesNotExist:
             return Response(status=status.HTTP_404_NOT_FOUND)
 
@@ -193,3 +224,19 @@ class SocialMediaUserViewSet(viewsets.ViewSet):
 
     def destroy(self, request, pk=None):
         Response({})
+
+
+# Annotates the friend counts and prefetches the friends the data type serializes so the users are serialized in a
+# fixed number of queries however many there are
+def prepare_users_for_data_type(users, data_type):
+    if data_type == 'user':
+        return annotate_friend_counts(users)
+    elif data_type == 'full':
+        friends = annotate_friend_counts(SocialMediaUser.objects.all())
+        return annotate_friend_counts(users).prefetch_related(Prefetch('twitter_followers', queryset=friends),
+                                                              Prefetch('twitter_follows', queryset=friends))
+    elif data_type == 'friend_urls':
+        friends = SocialMediaUser.objects.only('pk')
+        return annotate_friend_counts(users).prefetch_related(Prefetch('twitter_followers', queryset=friends),
+                                                              Prefetch('twitter_follows', queryset=friends))
+    return users
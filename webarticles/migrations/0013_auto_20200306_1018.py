@@ -0,0 +1,28 @@
+# Generated by Django 3.0.3 on 2020-03-06 10:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('webarticles', '0012_url_canonical'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='url',
+            name='failure_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='url',
+            name='last_error',
+            field=models.TextField(null=True),
+        ),
+        migrations.AddField(
+            model_name='url',
+            name='next_attempt_at',
+            field=models.DateTimeField(null=True),
+        ),
+    ]
@@ -0,0 +1,53 @@
+# Generated by Django 3.0.3 on 2020-03-07 09:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('webarticles', '0013_auto_20200306_1018'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='site',
+            name='index_content_hash',
+            field=models.CharField(max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name='site',
+            name='index_etag',
+            field=models.CharField(max_length=255, null=True),
+        ),
+        migrations.AddField(
+            model_name='site',
+            name='index_last_modified',
+            field=models.CharField(max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name='site',
+            name='indexed_at',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AddField(
+            model_name='url',
+            name='content_hash',
+            field=models.CharField(max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name='url',
+            name='etag',
+            field=models.CharField(max_length=255, null=True),
+        ),
+        migrations.AddField(
+            model_name='url',
+            name='fetched_at',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AddField(
+            model_name='url',
+            name='last_modified',
+            field=models.CharField(max_length=64, null=True),
+        ),
+    ]
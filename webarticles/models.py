@@ -16,11 +16,26 @@ class Site(models.Model):
     ---------
     site <-- ONE TO MANY --> article
     site <-- ONE TO MANY --> urls
+
+    Columns
+    -------
+    index_etag : string
+        ETag of the index page from the last crawl, sent back as If-None-Match
+    index_last_modified : string
+        Last-Modified of the index page from the last crawl, sent back as If-Modified-Since
+    index_content_hash : string
+        SHA-256 of the index page from the last crawl
+    indexed_at : datetime
+        When the index page was last fetched
     """
     name = models.CharField(null=False, max_length=255, unique=True)
     domain = models.CharField(null=False, max_length=255, unique=True)
     base_url = models.CharField(null=False, max_length=511, unique=True)
     crawl = models.BooleanField(default=True)
+    index_etag = models.CharField(null=True, max_length=255)
+    index_last_modified = models.CharField(null=True, max_length=64)
+    index_content_hash = models.CharField(null=True, max_length=64)
+    indexed_at = models.DateTimeField(null=True)
 
 
 class Article(models.Model):
@@ -62,6 +77,20 @@ class Url(models.Model):
         The unshorten version of url that uses shorten service.
     scraped: bool
         True if the url has been scrapped for data
+    failure_count: int
+        Scrapes that failed in a row, the url is parked once it reaches the limit
+    last_error: string
+        Error from the last failed scrape
+    next_attempt_at: datetime
+        The url is not scraped again before this time
+    etag: string
+        ETag of the page from the last fetch, sent back as If-None-Match
+    last_modified: string
+        Last-Modified of the page from the last fetch, sent back as If-Modified-Since
+    content_hash: string
+        SHA-256 of the page from the last fetch, the article is not parsed again while it matches
+    fetched_at: datetime
+        When the page was last fetched
     """
 
     class Meta:
@@ -71,6 +100,13 @@ class Url(models.Model):
     expanded = models.CharField(null=True, max_length=MAX_URL_LEN, unique=True)
     canonical = models.CharField(null=True, max_length=MAX_URL_LEN, unique=True)
     scraped = models.BooleanField(default=False)
+    failure_count = models.IntegerField(default=0)
+    last_error = models.TextField(null=True)
+    next_attempt_at = models.DateTimeField(null=True)
+    etag = models.CharField(null=True, max_length=255)
+    last_modified = models.CharField(null=True, max_length=64)
+    content_hash = models.CharField(null=True, max_length=64)
+    fetched_at = models.DateTimeField(null=True)
 
     # relationships
     article = models.ForeignKey(Article, on_delete=models.CASCADE, null=True)
@@ -12,10 +12,11 @@ class SiteHyperlinkSerializer(serializers.HyperlinkedModelSerializer):
         fields = ['url']
 
 
+# The validators and hash of the index page are only kept for the crawler
 class SiteFullSerializer(serializers.ModelSerializer):
     class Meta:
         model = Site
-        fields = '__all__'
+        exclude = ['index_etag', 'index_last_modified', 'index_content_hash', 'indexed_at']
 
 
 class UrlSerializer(serializers.ModelSerializer):
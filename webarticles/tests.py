@@ -1,9 +1,14 @@
+import threading
+import time
+
 from django.contrib.postgres.search import SearchQuery, SearchVector
-from django.test import TestCase, RequestFactory
+from django.test import SimpleTestCase, TestCase, RequestFactory
 from django.urls import reverse
 from rest_framework import status
 from rest_framework.test import APIClient
 
+from background_services.crawl_scheduler import CrawlScheduler
+from background_services.retry_policy import RetryPolicy
 from webarticles.models import Site, Url, Article
 from webarticles.serializers import SiteHyperlinkSerializer, SiteFullSerializer
 
@@ -16,6 +21,27 @@ class NewsSiteTest(TestCase):
     def setUp(self):
         self.site_one = Site.objects.create(name='Site One', domain='Domain One', base_url='http://www.siteone.com')
 
+    def test_cursor_pagination(self):
+        site_two = Site.objects.create(name='Site Two', domain='Domain Two', base_url='http://www.sitetwo.com')
+
+        response = client.get(reverse('news-site-list'), data={'data-type': 'full', 'cursor': '', 'limit': 1})
+        self.assertEqual([site['id'] for site in response.data['data']], [self.site_one.pk])
+
+        response = client.get(reverse('news-site-list'),
+                              data={'data-type': 'full', 'cursor': response.data['next_cursor'], 'limit': 1})
+        self.assertEqual([site['id'] for site in response.data['data']], [site_two.pk])
+        self.assertIsNone(response.data['next_cursor'])
+
+        response = client.get(reverse('news-site-list'), data={'cursor': '', 'limit': 0})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_crawl_fields_not_returned(self):
+        response = client.get(reverse('news-site-detail', args=[self.site_one.pk]), data={'data-type': 'full'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['data']['name'], 'Site One')
+        for field in ['index_etag', 'index_last_modified', 'index_content_hash', 'indexed_at']:
+            self.assertNotIn(field, response.data['data'])
+
     def test_news_site_post(self):
 
         # Post data
@@ -163,3 +189,68 @@ class NewsArticleTest(TestCase):
 
     def test_get_single_full(self):
         pass
+
+
+class RetryPolicyTest(SimpleTestCase):
+    """ Test Module for the download retry policy """
+
+    def test_only_retryable_errors_back_off_the_domain(self):
+        policy = RetryPolicy(max_attempts=3, base_seconds=0, is_retryable=lambda error: not isinstance(error, KeyError))
+        calls = []
+
+        def fail(error):
+            calls.append(error)
+            raise error
+
+        # A dead link is given up on at once and the domain is left alone
+        with self.assertRaises(KeyError):
+            policy.call('site.com', fail, KeyError('gone'))
+        self.assertEqual((len(calls), policy.failures), (1, {}))
+
+        with self.assertRaises(ValueError):
+            policy.call('site.com', fail, ValueError('unavailable'))
+        self.assertEqual((len(calls), policy.failures), (4, {'site.com': 3}))
+
+
+class CrawlSchedulerTest(SimpleTestCase):
+    """ Test Module for the per host crawl scheduler """
+
+    def test_hosts_spaced_and_crawled_in_parallel(self):
+        started = []
+        in_flight = set()
+        lock = threading.Lock()
+
+        def handle(item, session):
+            host, page = item
+            with lock:
+                self.assertNotIn(host, in_flight)
+                in_flight.add(host)
+                started.append((host, page, time.time()))
+            if page == 'home':
+                scheduler.add(host, (host, 'article'))
+            time.sleep(0.01)
+            with lock:
+                in_flight.discard(host)
+            if page == 'broken':
+                raise ValueError('Not found')
+
+        scheduler = CrawlScheduler(handle, workers=4, delay_seconds=0.1)
+        for host in ['a.com', 'b.com']:
+            scheduler.add(host, (host, 'broken'), priority=1)
+            scheduler.add(host, (host, 'home'))
+        scheduler.start()
+        deadline = time.time() + 5
+        while not scheduler.is_idle() and time.time() < deadline:
+            time.sleep(0.01)
+        scheduler.stop()
+
+        self.assertEqual(scheduler.get_stats(), dict(requests=6, failed=2, hosts=2, queued=0, in_flight=0))
+        for host in ['a.com', 'b.com']:
+            pages = [(page, at) for item_host, page, at in started if item_host == host]
+            self.assertEqual([page for page, at in pages], ['home', 'article', 'broken'])
+            # Each request waits out the delay after the last one to the same host finished
+            for (page, at), (next_page, next_at) in zip(pages, pages[1:]):
+                self.assertGreaterEqual(next_at - at, 0.1)
+
+        # The other host did not wait for the delay of the first
+        self.assertLess(abs(started[0][2] - started[1][2]), 0.1)
@@ -6,6 +6,7 @@ from rest_framework import status, viewsets
 from rest_framework.views import APIView
 from rest_framework.response import Response
 
+from CMI_Service.pagination import get_pagination_parameters, paginate
 from CMI_Service.settings import MAX_RECORDS_TO_RETURN
 from webarticles.models import Site, Article
 from webarticles.serializers import SiteHyperlinkSerializer, SiteFullSerializer, ArticleFullSerializer
@@ -28,12 +29,7 @@ class NewsSiteViewSet(viewsets.ViewSet):
                              openapi.Parameter('search', openapi.IN_QUERY,
                                                description='Searches for a site that contains the specified string.',
                                                type=openapi.TYPE_STRING, default=''),
-                             openapi.Parameter('limit', openapi.IN_QUERY, description='Limits the return count.',
-                                               type=openapi.TYPE_INTEGER, default=''),
-                             openapi.Parameter('offset', openapi.IN_QUERY,
-                                               description='Offset to start at for the query.',
-                                               type=openapi.TYPE_INTEGER, default=''),
-                         ])
+                         ] + get_pagination_parameters())
     def list(self, request):
         data_type = request.GET['data-type'] if 'data-type' in request.GET.keys() else None
         limit = int(request.GET['limit']) if 'limit' in request.GET.keys() else MAX_RECORDS_TO_RETURN
@@ -47,8 +43,11 @@ class NewsSiteViewSet(viewsets.ViewSet):
         else:
             sites = Site.objects.all()
 
-        total_counts = sites.count()
-        sites = sites[offset:offset + limit]
+        # The page is fetched once here and serialized from the rows
+        try:
+            sites, page = paginate(sites, ['id'], request, limit, offset)
+        except ValueError as e:
+            return Response(dict(error=str(e)), status=status.HTTP_400_BAD_REQUEST)
 
         many = True
 
@@ -58,21 +57,7 @@ class NewsSiteViewSet(viewsets.ViewSet):
         else:  # 'urls'
             serializer = SiteHyperlinkSerializer(sites, context={'request': request}, many=many)
 
-        next_offset = offset + limit
-
-        if total_counts <= next_offset:
-            next_offset = -1
-        elif sites.count == 0:
-            next_offset = -1
-
-        # Create return dict
-        return_dict = dict(
-            records=sites.count(),
-            next_offset=next_offset,
-            data=serializer.data
-        )
-
-        return Response(return_dict)
+        return Response(dict(page, data=serializer.data))
 
     @swagger_auto_schema(operation_description="Create news site.",
                          request_body=openapi.Schema(